@@ -1,7 +1,17 @@
 from django.contrib import admin
-from .models import Mailing, Client, Message
+from .models import Mailing, MailingJob, Client, Message, MailingStat, RateLimit, DeliveryLog
 
 
 admin.site.register(Mailing)
 admin.site.register(Client)
 admin.site.register(Message)
+admin.site.register(MailingStat)
+admin.site.register(RateLimit)
+admin.site.register(MailingJob)
+
+
+@admin.register(DeliveryLog)
+class DeliveryLogAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'message_id', 'mailing_id', 'status', 'code', 'latency', 'attempt')
+    list_filter = ('status',)
+    search_fields = ('=message_id', '=mailing_id')
@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.db.models.signals import pre_delete
 
 
 class MailingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'mailing'
+
+    def ready(self):
+        from . import counters
+        from .models import Client
+
+        pre_delete.connect(counters.client_deleted, sender=Client, dispatch_uid='mailing.counters.client_deleted')
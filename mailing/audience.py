@@ -0,0 +1,173 @@
+import json
+import re
+
+from django.core.validators import ValidationError
+from django.db.models import Q
+
+# Язык фильтра клиентов рассылки:
+#   code in (916, 926) AND tag in (vip, beta) AND zone startswith Asia
+#   (tag = vip OR tag = "black friday") AND NOT code = 903
+# Поля клиента: number, code, tag, zone. Операции: =, !=, <, <=, >, >=, in (...), startswith.
+# Старый формат фильтра поддерживается: число-- код оператора (code = 916), любая другая строка, которая не
+# разбирается как фильтр,-- тег (tag = ...).
+
+# поля клиента, доступные в фильтре, и тип значений поля
+FIELDS = {'number': int, 'code': int, 'tag': str, 'zone': str}
+# операции сравнения фильтра --> lookup Django ORM
+LOOKUPS = {'=': 'exact', '!=': 'exact', '<': 'lt', '<=': 'lte', '>': 'gt', '>=': 'gte',
+           'in': 'in', 'startswith': 'startswith'}
+KEYWORDS = ('and', 'or', 'not', 'in', 'startswith')
+
+# начало фильтра с условием на поле клиента (возможно, после скобок и not): такая строка-- не старый тег
+FIELD_START = re.compile(r'(?:\(|\s|not\b)*(?:{})\b'.format('|'.join(FIELDS)), re.IGNORECASE)
+TOKEN = re.compile(r'''\s*(?:(?P<string>"[^"]*"|'[^']*')|(?P<op><=|>=|!=|=|<|>|\(|\)|,)|(?P<word>[^\s(),=<>!"']+))''')
+
+
+def tokenize(text):
+    """
+    Строка фильтра --> список токенов (тип, значение): string-- строка в кавычках, op-- оператор или скобка,
+    word-- слово (ключевое слово, имя поля, значение без кавычек).
+    """
+
+    tokens = list()
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        if match is None:
+            raise ValidationError('Unexpected symbol at position {}.'.format(position))
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'string':
+            value = value[1:-1]
+        elif kind == 'word' and value.lower() in KEYWORDS:
+            kind, value = 'op', value.lower()
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+
+class Parser:
+    """
+    Разбор фильтра рекурсивным спуском в дерево условий (json-совместимые словари):
+        {'op': 'and' | 'or', 'args': [...]}, {'op': 'not', 'args': [...]},
+        {'field': 'code', 'lookup': 'in', 'value': [916, 926]}
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self, *expected):
+        kind, value = self.peek()
+        if kind is None or (expected and value not in expected):
+            raise ValidationError('Expected {} in filter.'.format(' or '.join(expected) or 'value'))
+        self.position += 1
+        return kind, value
+
+    def parse(self):
+        tree = self.expression()
+        if self.position != len(self.tokens):
+            raise ValidationError('Unexpected "{}" in filter.'.format(self.peek()[1]))
+        return tree
+
+    def expression(self):
+        args = [self.term()]
+        while self.peek() == ('op', 'or'):
+            self.take('or')
+            args.append(self.term())
+        return args[0] if len(args) == 1 else {'op': 'or', 'args': args}
+
+    def term(self):
+        args = [self.factor()]
+        while self.peek() == ('op', 'and'):
+            self.take('and')
+            args.append(self.factor())
+        return args[0] if len(args) == 1 else {'op': 'and', 'args': args}
+
+    def factor(self):
+        if self.peek() == ('op', 'not'):
+            self.take('not')
+            return {'op': 'not', 'args': [self.factor()]}
+        if self.peek() == ('op', '('):
+            self.take('(')
+            tree = self.expression()
+            self.take(')')
+            return tree
+        return self.comparison()
+
+    def comparison(self):
+        kind, field = self.take()
+        if kind != 'word' or field not in FIELDS:
+            raise ValidationError('Unknown client field "{}", use one of: {}.'.format(field, ', '.join(FIELDS)))
+        _, operator = self.take(*LOOKUPS)
+        if operator == 'in':
+            self.take('(')
+            value = [self.value(field)]
+            while self.peek() == ('op', ','):
+                self.take(',')
+                value.append(self.value(field))
+            self.take(')')
+        else:
+            value = self.value(field)
+        condition = {'field': field, 'lookup': LOOKUPS[operator], 'value': value}
+        if operator == '!=':
+            return {'op': 'not', 'args': [condition]}
+        return condition
+
+    def value(self, field):
+        kind, value = self.take()
+        if kind == 'op':
+            raise ValidationError('Expected value of "{}" in filter.'.format(field))
+        try:
+            return FIELDS[field](value)
+        except ValueError:
+            raise ValidationError('Invalid value "{}" of "{}" in filter.'.format(value, field))
+
+
+def parse(text):
+    """
+    Фильтр рассылки --> дерево условий. Число-- код оператора, строка без операций фильтра-- тег клиента.
+    Строка, которая не разбирается как фильтр (старый тег с '!', кавычками или словами and, or, not), тоже тег
+    клиента, если она не начинается с имени поля: тогда это фильтр с ошибкой, и ошибка разбора передается дальше.
+    """
+
+    text = text.strip()
+    if text.isnumeric():
+        return {'field': 'code', 'lookup': 'exact', 'value': int(text)}
+    try:
+        tokens = tokenize(text)
+        if not any(kind == 'op' for kind, _ in tokens):
+            return {'field': 'tag', 'lookup': 'exact', 'value': text}
+        return Parser(tokens).parse()
+    except ValidationError:
+        if FIELD_START.match(text):
+            raise
+        return {'field': 'tag', 'lookup': 'exact', 'value': text}
+
+
+def compile_filter(text):
+    """
+    Разбор фильтра рассылки один раз при сохранении рассылки: дерево условий в json для Mailing.audience.
+    """
+
+    return json.dumps(parse(text), ensure_ascii=False)
+
+
+def to_q(tree):
+    """
+    Дерево условий --> Q объект для одного запроса к модели Client (поля code, tag, number с индексами).
+    """
+
+    if 'field' in tree:
+        return Q(**{'{}__{}'.format(tree['field'], tree['lookup']): tree['value']})
+    args = [to_q(arg) for arg in tree['args']]
+    if tree['op'] == 'not':
+        return ~args[0]
+    q = args[0]
+    for arg in args[1:]:
+        q = q & arg if tree['op'] == 'and' else q | arg
+    return q
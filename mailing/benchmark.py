@@ -0,0 +1,224 @@
+import asyncio
+import queue
+import random
+import threading
+from datetime import timedelta
+from time import perf_counter
+
+from aiohttp import web
+from django.db.models import Count, Sum
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory
+
+from project.celery import app
+from . import delivery
+from .models import Client, DeliveryLog, MailingJob, Message
+from .priority import PRIORITY
+from .views import MailingView
+from .writeback import buffer
+
+# Нагрузочный тест всего пути рассылки (python manage.py benchmark): создание рассылок через MailingView.post,
+# таски build_audience (fan-out сообщений), таски send (захват сообщений и постановка пачек в очередь), таски
+# send_batch (отправка на заглушку принимающего сервера и запись статусов). Celery работает через брокер в памяти
+# (memory://), таски из очереди выполняет этот же процесс.
+
+# очереди Celery: срочные пачки и очередь по умолчанию (./priority.py)
+TASK_QUEUES = (PRIORITY['urgent_queue'], PRIORITY['bulk_queue'])
+# размер пачки при создании клиентов
+SEED_BATCH = 10_000
+
+
+class StubServer:
+    """
+    Заглушка принимающего сервера https://probe.fbrq.cloud/v1/send/<id> в отдельном потоке: отвечает с задержкой
+    latency сек (в среднем, равномерно от 0 до 2 * latency) и с вероятностью error_rate-- кодом 500.
+    """
+
+    def __init__(self, latency=0.01, error_rate=0.0, host='127.0.0.1'):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.host = host
+        self.loop = asyncio.new_event_loop()
+        self.runner = None
+        self.url = None
+
+    async def handle(self, request):
+        await asyncio.sleep(random.uniform(0, 2 * self.latency))
+        if random.random() < self.error_rate:
+            return web.json_response({'code': 1, 'message': 'Stub error'}, status=500)
+        return web.json_response({'code': 0, 'message': 'OK'})
+
+    async def _start(self):
+        application = web.Application()
+        application.router.add_post('/v1/send/{id}', self.handle)
+        self.runner = web.AppRunner(application, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return 'http://{}:{}/v1/send/'.format(self.host, port)
+
+    def start(self):
+        self.url = self.loop.run_until_complete(self._start())
+        threading.Thread(target=self.loop.run_forever, name='fbrq-stub', daemon=True).start()
+        return self.url
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def percentile(samples, q):
+    """
+    Перцентиль q (0..100) выборки samples методом ближайшего ранга
+    """
+
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered))) - 1))]
+
+
+def stage(samples, seconds, **extra):
+    """
+    Сводка этапа: количество замеров, общее время, p50/p99 длительности замера в секундах
+    """
+
+    summary = {'samples': len(samples), 'seconds': round(seconds, 6),
+               'p50': percentile(samples, 50), 'p99': percentile(samples, 99)}
+    summary.update(extra)
+    return summary
+
+
+def seed_clients(clients):
+    """
+    Создание clients клиентов с тегом 'bench' (номера подряд, коды операторов 900..999)
+    """
+
+    for start in range(0, clients, SEED_BATCH):
+        Client.objects.bulk_create([
+            Client(number=79000000000 + i, code=900 + i // 10_000_000 % 100, tag='bench')
+            for i in range(start, min(start + SEED_BATCH, clients))
+        ])
+
+
+def create_stage(mailings, duration):
+    """
+    Создание mailings рассылок на всех клиентов запросами POST /api/mailing/ (MailingView.post). Запрос только
+    сохраняет рассылку и ставит в очередь таск build_audience (fan-out сообщений, ./jobs.py), который запускает
+    рассылку.
+    """
+
+    factory = APIRequestFactory()
+    view = MailingView.as_view()
+    samples = list()
+    for i in range(mailings):
+        now = timezone.now()
+        data = {'starts_at': now.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'expired_at': (now + timedelta(seconds=duration)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'text': 'Benchmark mailing {}'.format(i), 'filter': 'bench'}
+        started = perf_counter()
+        response = view(factory.post('/api/mailing/', data, format='json'))
+        samples.append(perf_counter() - started)
+        if response.status_code != 200:
+            raise RuntimeError('Mailing is not created: {}'.format(response.content))
+    return stage(samples, sum(samples))
+
+
+def run_tasks(queues, timings):
+    """
+    Выполнение тасков из очередей брокера queues в этом процессе, срочная очередь первой, пока очереди не опустеют
+    (включая таски, поставленные в очередь выполненными тасками). Длительности выполнения в секундах добавляются в
+    timings ({имя таска: список}). Возвращает количество выполненных тасков.
+    """
+
+    executed = 0
+    while True:
+        for events in queues:
+            try:
+                message = events.get(block=False)
+                break
+            except queue.Empty:
+                continue
+        else:
+            return executed
+        args, kwargs, _ = message.payload
+        name = message.headers['task']
+        started = perf_counter()
+        app.tasks[name].apply(args=args, kwargs=kwargs)
+        timings.setdefault(name, list()).append(perf_counter() - started)
+        message.ack()
+        executed += 1
+
+
+def run_beat(queues, timings):
+    """
+    Выполнение тасков и обходов Celery Beat (таск send без рассылки), пока обход ставит в очередь новые пачки:
+    диспетчер не захватывает несрочные сообщения, пока в работе слишком много сообщений (./priority.py).
+    """
+
+    run_tasks(queues, timings)
+    while True:
+        buffer.flush()
+        started = perf_counter()
+        app.tasks['send'].apply()
+        timings['send'].append(perf_counter() - started)
+        if not run_tasks(queues, timings):
+            return timings
+
+
+def run(clients=1000, mailings=1, latency=0.01, error_rate=0.0, rate=None, duration=3600):
+    """
+    Нагрузочный тест на пустой БД: clients клиентов, mailings рассылок на всех клиентов, заглушка сервера с
+    задержкой latency сек и долей ошибок error_rate. rate-- зафиксировать лимит скорости отправки (сообщений в
+    секунду), иначе работает адаптивный лимит из настроек. Возвращает результаты этапов (json-совместимый словарь).
+    """
+
+    app.conf.task_always_eager = False
+    app.conf.broker_url = app.conf.broker_read_url = app.conf.broker_write_url = 'memory://'
+    if rate is not None:
+        delivery.CELERY_SETTINGS_FBRQ['rate_limit'].update(initial=rate, min=rate, max=rate, burst=1.0)
+
+    server = StubServer(latency=latency, error_rate=error_rate)
+    delivery.URL = server.start()
+    try:
+        started = perf_counter()
+        seed_clients(clients)
+        seed_seconds = perf_counter() - started
+
+        with app.connection_for_read() as connection:
+            with connection.SimpleQueue(TASK_QUEUES[0]) as urgent, connection.SimpleQueue(TASK_QUEUES[1]) as bulk:
+                create = create_stage(mailings, duration)
+
+                timings = run_beat((urgent, bulk), {'send': list()})
+                started = perf_counter()
+                buffer.flush()
+                flush_seconds = perf_counter() - started
+    finally:
+        server.stop()
+
+    # таски выполняются по очереди: время этапа-- сумма времени его тасков (отправка-- вместе с записью статусов)
+    fan_out, dispatch = timings.get('build_audience', []), timings.get('send', [])
+    batches = timings.get('send_batch', [])
+    # получатели рассылок: созданные сообщения и получатели снимков аудитории
+    rows = MailingJob.objects.aggregate(rows=Sum('done'))['rows'] or 0
+    fan_out_seconds = sum(fan_out)
+    dispatch_seconds = sum(dispatch)
+    delivery_seconds = sum(batches) + flush_seconds
+
+    statuses = dict(Message.objects.order_by().values_list('status').annotate(Count('id')))
+    sent = statuses.get('sent', 0)
+    latencies = list(DeliveryLog.objects.filter(latency__isnull=False).values_list('latency', flat=True))
+    return {
+        'params': {'clients': clients, 'mailings': mailings, 'latency': latency, 'error_rate': error_rate,
+                   'rate': rate, 'concurrency': delivery.CONCURRENCY},
+        'seed': {'clients': clients, 'seconds': round(seed_seconds, 6)},
+        'create': create,
+        'fan_out': stage(fan_out, fan_out_seconds, rows=rows,
+                         rows_per_sec=round(rows / fan_out_seconds, 1) if fan_out_seconds else None),
+        'dispatch': stage(dispatch, dispatch_seconds, messages=sum(statuses.values())),
+        'delivery': stage(batches, delivery_seconds, sent=sent,
+                          msgs_per_sec=round(sent / delivery_seconds, 1) if delivery_seconds else None),
+        'http': stage(latencies, sum(latencies)),
+        'statuses': statuses,
+    }
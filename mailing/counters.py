@@ -0,0 +1,96 @@
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+
+from .models import AudienceBlock, MailingStat, Message
+
+
+def add(mailing_id, status, count):
+    """
+    Изменить счетчик сообщений рассылки mailing_id в статусе status на count (count может быть отрицательным).
+    """
+
+    if not count:
+        return None
+    counter = MailingStat.objects.filter(mailing_id=mailing_id, status=status)
+    if counter.update(count=F('count') + count):
+        return None
+    try:
+        with transaction.atomic():
+            MailingStat.objects.create(mailing_id=mailing_id, status=status, count=count)
+    except IntegrityError:
+        # счетчик успел создать параллельный воркер
+        counter.update(count=F('count') + count)
+
+
+def move(moved, status):
+    """
+    Перенос сообщений между счетчиками: moved-- список (id рассылки, прежний статус, количество сообщений),
+    status-- новый статус. Счетчики обновляются в одном порядке, чтобы параллельные транзакции не ждали друг друга
+    по кругу (deadlock).
+    """
+
+    changes = dict()
+    for mailing_id, old_status, count in moved:
+        changes[mailing_id, old_status] = changes.get((mailing_id, old_status), 0) - count
+        changes[mailing_id, status] = changes.get((mailing_id, status), 0) + count
+    for (mailing_id, counter_status), count in sorted(changes.items()):
+        add(mailing_id, counter_status, count)
+
+
+def update_status(messages, status, **fields):
+    """
+    Перевод сообщений выборки messages (QuerySet Message) в статус status вместе с обновлением счетчиков, в одной
+    транзакции. fields-- другие поля сообщений, которые нужно обновить.
+    Одна команда UPDATE на каждую пару (рассылка, прежний статус) выборки: счетчики меняются на количество строк,
+    которое обновила сама команда, поэтому сообщения, которые параллельный воркер успел перевести в другой статус,
+    не учитываются дважды. Возвращает количество обновленных сообщений.
+    """
+
+    with transaction.atomic():
+        if not fields:
+            messages = messages.exclude(status=status)
+        pairs = messages.order_by().values_list('mailing', 'status').distinct()
+        # сначала сообщения, которые уже в статусе status: иначе их UPDATE задел бы только что переведенные
+        moved = list()
+        for mailing_id, old_status in sorted(pairs, key=lambda pair: (pair[0], pair[1] != status, pair[1])):
+            rows = messages.filter(mailing=mailing_id, status=old_status).update(status=status, **fields)
+            moved.append((mailing_id, old_status, rows))
+        move(moved, status)
+        return sum(rows for mailing_id, old_status, rows in moved)
+
+
+def client_deleted(sender, instance, **kwargs):
+    """
+    Обработчик pre_delete модели Client: сообщения клиента удаляются каскадом без update_status(), поэтому
+    счетчики рассылок уменьшаются здесь, в транзакции удаления.
+    """
+
+    removed = Message.objects.filter(client=instance.pk).order_by().values_list('mailing', 'status')
+    for mailing_id, status, count in sorted(removed.annotate(count=Count('id'))):
+        add(mailing_id, status, -count)
+
+
+def rebuild(mailing_id=None):
+    """
+    Пересчет счетчиков с нуля по таблице сообщений: всех рассылок либо одной рассылки mailing_id. Получатели
+    снимков аудитории, сообщения которых еще не созданы (AudienceBlock), учитываются в счетчике 'new'.
+    """
+
+    messages = Message.objects.all()
+    counters = MailingStat.objects.all()
+    blocks = AudienceBlock.objects.all()
+    if mailing_id is not None:
+        messages = messages.filter(mailing=mailing_id)
+        counters = counters.filter(mailing=mailing_id)
+        blocks = blocks.filter(mailing=mailing_id)
+    with transaction.atomic():
+        counters.delete()
+        rows = dict()
+        for mailing, status, count in messages.order_by().values_list('mailing', 'status').annotate(Count('id')):
+            rows[mailing, status] = count
+        for mailing, count in blocks.order_by().values_list('mailing').annotate(Sum('count')):
+            rows[mailing, 'new'] = rows.get((mailing, 'new'), 0) + count
+        stats = [MailingStat(mailing_id=mailing, status=status, count=count)
+                 for (mailing, status), count in sorted(rows.items())]
+        MailingStat.objects.bulk_create(stats)
+    return len(stats)
@@ -0,0 +1,421 @@
+import asyncio
+import json
+import random
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from time import perf_counter, time
+
+import aiohttp
+from django.db import connections
+from django.db.models import F
+from django.utils import timezone
+
+from project.settings import CELERY_SETTINGS_FBRQ
+from . import metrics
+from .counters import update_status
+from .models import DeliveryLog, Mailing, Message, window_starts_at
+from .ratelimit import TokenBucket
+
+# подгружаем настройки запроса, чтобы сервер https://probe.fbrq.cloud точно принял данные
+URL = CELERY_SETTINGS_FBRQ['url']
+HEADERS = CELERY_SETTINGS_FBRQ['headers']
+# максимальное количество одновременных запросов (in-flight) к принимающему серверу
+CONCURRENCY = CELERY_SETTINGS_FBRQ.get('concurrency', 100)
+# время, в течение которого ожидается прием с сервера
+CONNECT_TIMEOUT = 2
+# время, в течение которого ожидается чтение данных в буфер дескриптора сокета
+READ_TIMEOUT = 2
+# время жизни неиспользуемого keep-alive соединения в пуле
+KEEPALIVE_TIMEOUT = 30
+# как часто (сек) результаты отправки передаются в адаптивный лимит скорости
+FEEDBACK_INTERVAL = 1.0
+# настройки повторной отправки: количество попыток, задержка перед повтором
+RETRY = CELERY_SETTINGS_FBRQ['retry']
+# журнал попыток отправки (модель DeliveryLog)
+DELIVERY_LOG = CELERY_SETTINGS_FBRQ['delivery_log']
+# начало отсчета меток захвата сообщений пачки (claim_token())
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+async def post_messages(payloads, concurrency=CONCURRENCY, url=None, headers=HEADERS, limiter=None, latency=False):
+    """
+    Асинхронная отправка сообщений на принимающий сервер.
+    payloads-- список словарей спецификации json принимающего сервера: {'id': ..., 'phone': ..., 'text': ...}
+    Все запросы идут через один пул keep-alive соединений (aiohttp.ClientSession), одновременно в работе не более
+    concurrency запросов. Если задан limiter (ratelimit.TokenBucket), запросы запускаются по мере выдачи токенов.
+    Возвращает словарь {id сообщения: код ответа сервера}, None-- ошибка соединения или таймаут.
+    latency=True-- {id сообщения: (код ответа сервера, время ответа в секундах)}.
+    url-- адрес принимающего сервера, по умолчанию URL (текущее значение, например, заглушка бенчмарка).
+    """
+
+    if url is None:
+        url = URL
+
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency, keepalive_timeout=KEEPALIVE_TIMEOUT)
+    timeout = aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, headers=headers, timeout=timeout) as session:
+        if limiter is None:
+            results = await asyncio.gather(*(_post(session, semaphore, url, payload) for payload in payloads))
+        else:
+            results = await _post_limited(session, semaphore, url, payloads, limiter)
+    if latency:
+        return {message_id: (status, seconds) for message_id, status, seconds in results}
+    return {message_id: status for message_id, status, seconds in results}
+
+
+async def _post_limited(session, semaphore, url, payloads, limiter):
+    """
+    Запуск запросов по мере выдачи токенов лимитом скорости. Раз в FEEDBACK_INTERVAL секунд результаты завершенных
+    запросов (ошибки, время ответа) передаются в лимит для подстройки скорости.
+    Обращения к лимиту-- запросы к БД, поэтому они идут в отдельном потоке (одном на вызов, со своим соединением
+    с БД) и не останавливают цикл событий: ответы сервера принимаются, пока лимит ждет блокировку строки.
+    """
+
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=1)
+    completed = list()
+    tasks = list()
+    pending = list(payloads)
+    reported = 0
+    reported_at = loop.time()
+    try:
+        while pending:
+            granted, wait = await loop.run_in_executor(executor, limiter.acquire, len(pending))
+            if wait is None:
+                # circuit breaker: сервер не справляется, оставшиеся сообщения не отправляем
+                break
+            for payload in pending[:granted]:
+                task = asyncio.ensure_future(_post(session, semaphore, url, payload))
+                task.add_done_callback(lambda t: completed.append(t.result()))
+                tasks.append(task)
+            pending = pending[granted:]
+            if loop.time() - reported_at >= FEEDBACK_INTERVAL:
+                await loop.run_in_executor(executor, _feedback, limiter, completed[reported:])
+                reported, reported_at = len(completed), loop.time()
+            await asyncio.sleep(wait)
+
+        results = await asyncio.gather(*tasks)
+        await loop.run_in_executor(executor, _feedback, limiter, completed[reported:])
+    finally:
+        # соединение с БД потока лимита закрывается в том же потоке, иначе оно останется открытым
+        await loop.run_in_executor(executor, connections.close_all)
+        executor.shutdown()
+    return results
+
+
+def _feedback(limiter, results):
+    """
+    Сводка результатов запросов для лимита скорости: ответы 200, ошибки и таймауты, среднее время ответа.
+    """
+
+    sent = sum(1 for message_id, status, latency in results if status == 200)
+    latency = sum(latency for message_id, status, latency in results) / len(results) if results else 0
+    limiter.feedback(sent, len(results) - sent, latency)
+
+
+async def _post(session, semaphore, url, payload):
+    """
+    Один POST запрос: url принимающего сервера + id сообщения. Возвращает (id, код ответа, время ответа).
+    """
+
+    async with semaphore:
+        started = perf_counter()
+        try:
+            async with session.post(url + str(payload['id']), data=json.dumps(payload)) as response:
+                await response.read()
+                return payload['id'], response.status, perf_counter() - started
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return payload['id'], None, perf_counter() - started
+
+
+def backoff(attempt, settings=RETRY):
+    """
+    Задержка (сек) перед повторной отправкой после attempt неудачных попыток: экспоненциальный рост от 'base_delay'
+    до 'max_delay' со случайным разбросом (jitter), чтобы повторы разных сообщений не приходили на сервер разом.
+    """
+
+    delay = min(settings['max_delay'], settings['base_delay'] * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def retry_status(attempts, settings=RETRY):
+    """
+    Статус сообщения после очередной неудачной попытки: attempts-- количество прежних неудачных попыток.
+    """
+
+    return 'dead' if attempts + 1 >= settings['attempts'] else 'new'
+
+
+def retry_later(failed, settings=RETRY):
+    """
+    Неудачная отправка: failed-- список (id сообщения, количество прежних неудачных попыток).
+    Сообщение возвращается в статус 'new' со временем следующей попытки next_attempt_at, после 'attempts' неудачных
+    попыток-- статус 'dead' (больше не отправляется). Одна команда UPDATE на каждое количество попыток.
+    Возвращает словарь {статус: список id сообщений}.
+    """
+
+    by_attempts = dict()
+    for message_id, attempts in failed:
+        by_attempts.setdefault(attempts, list()).append(message_id)
+
+    now = timezone.now()
+    outcome = {'new': [], 'dead': []}
+    for attempts, ids in sorted(by_attempts.items()):
+        messages = Message.objects.filter(pk__in=ids, status='active')
+        if retry_status(attempts, settings) == 'dead':
+            update_status(messages, 'dead', attempts=F('attempts') + 1, next_attempt_at=None)
+            outcome['dead'].extend(ids)
+        else:
+            next_attempt_at = now + timedelta(seconds=backoff(attempts, settings))
+            update_status(messages, 'new', attempts=F('attempts') + 1, next_attempt_at=next_attempt_at)
+            outcome['new'].extend(ids)
+    return outcome
+
+
+def write_outcome(statuses, failed=(), log=()):
+    """
+    Запись результатов отправки: statuses-- {статус: список id сообщений}, одна команда UPDATE на статус (только
+    сообщения, которые еще в работе), failed-- неудачные попытки для retry_later(), log-- записи журнала отправки.
+    """
+
+    for status in sorted(statuses):
+        if statuses[status]:
+            update_status(Message.objects.filter(pk__in=statuses[status], status='active'), status)
+    if failed:
+        retry_later(failed)
+    write_log(log)
+
+
+def write_log(log):
+    """
+    Журнал отправки одной командой INSERT (в SQLite-- пачками по ограничению бэкенда): log-- список (id сообщения,
+    id рассылки, статус после попытки, код ответа сервера, время ответа, номер попытки, unix timestamp попытки).
+    """
+
+    if not log or not DELIVERY_LOG['enabled']:
+        return 0
+    entries = [
+        DeliveryLog(message_id=message_id, mailing_id=mailing_id, status=status, code=code, latency=latency,
+                    attempt=attempt, created_at=datetime.fromtimestamp(created_at, tz=timezone.utc))
+        for message_id, mailing_id, status, code, latency, attempt, created_at in log
+    ]
+    DeliveryLog.objects.bulk_create(entries)
+    return len(entries)
+
+
+def load_batch(messages):
+    """
+    Самодостаточная пачка для таска отправки: данные сообщений выборки messages (QuerySet Message), их клиентов и
+    рассылок загружаются одним запросом. Текст рассылки хранится в пачке один раз, а не в каждом сообщении:
+        {'mailings': {'<id рассылки>': [текст, время окончания рассылки, поколение расписания рассылки,
+                                         начало окна доставки, конец окна доставки]},
+         'messages': [[id сообщения, номер клиента, время отправки, количество попыток, id рассылки,
+                       часовой пояс клиента, метка захвата], ...]}
+    Время-- unix timestamp, окно доставки-- 'HH:MM:SS' либо None, метка захвата-- claimed_at сообщения в
+    микросекундах от начала эпохи (claim_token()), без потери точности при json сериализации Celery.
+    """
+
+    batch = {'mailings': dict(), 'messages': list()}
+    rows = messages.values_list('id', 'client__number', 'starts_at', 'attempts', 'mailing', 'client__zone',
+                                'claimed_at', 'mailing__text', 'mailing__expired_at', 'mailing__version',
+                                'mailing__window_start', 'mailing__window_end')
+    with metrics.span('load_batch'):
+        for message_id, number, starts_at, attempts, mailing_id, zone, claimed_at, *mailing in rows:
+            if str(mailing_id) not in batch['mailings']:
+                text, expired_at, version, *window = mailing
+                window = [value.strftime('%H:%M:%S') if value is not None else None for value in window]
+                batch['mailings'][str(mailing_id)] = [text, expired_at.timestamp(), version, *window]
+            batch['messages'].append([message_id, number, starts_at.timestamp(), attempts, mailing_id, zone,
+                                      claim_token(claimed_at)])
+    return batch
+
+
+def claim_token(claimed_at):
+    """
+    Метка захвата сообщения для пачки: время захвата claimed_at в микросекундах от начала эпохи либо None
+    """
+
+    return None if claimed_at is None else (claimed_at - EPOCH) // timedelta(microseconds=1)
+
+
+def renew_lease(batch, stale=()):
+    """
+    Продление аренды сообщений пачки batch (load_batch()) перед отправкой: новое время захвата получают только
+    сообщения, которые еще 'active' с тем же временем захвата, что и при загрузке пачки. Если пачка ждала в очереди
+    дольше аренды, sweeper.reap_stale() уже вернул ее сообщения в 'new', и их могла захватить и отправить другая
+    пачка. Сообщения устаревших рассылок stale (stale_mailings()) пачка не отправит: если они все еще захвачены этой
+    пачкой (например, рассылку приостановили), они сразу возвращаются в 'new', не дожидаясь окончания аренды, а
+    сообщения отмененных рассылок получают статус 'failure'.
+    Одна команда UPDATE на метку захвата (обычно одна на пачку). Возвращает множество id сообщений, аренда
+    которых потеряна.
+    """
+
+    cancelled = set()
+    if stale:
+        cancelled = set(Mailing.objects.filter(pk__in=stale, state='cancelled').values_list('id', flat=True))
+    groups = dict()
+    for message in batch['messages']:
+        if len(message) > 6:
+            released = ('failure' if message[4] in cancelled else 'new') if message[4] in stale else ''
+            groups.setdefault((released, message[6]), list()).append(message[0])
+    now = timezone.now()
+    lost = set()
+    for (released, token), ids in sorted(groups.items(), key=lambda item: (item[0][0], item[0][1] is not None,
+                                                                           item[0][1] or 0)):
+        claimed_at = None if token is None else EPOCH + timedelta(microseconds=token)
+        messages = Message.objects.filter(pk__in=ids, status='active', claimed_at=claimed_at)
+        if released:
+            update_status(messages, released, claimed_at=None)
+        elif messages.update(claimed_at=now) < len(ids):
+            renewed = Message.objects.filter(pk__in=ids, status='active', claimed_at=now).values_list('id', flat=True)
+            lost.update(set(ids) - set(renewed))
+    return lost
+
+
+def window_opens_at(mailing, zone, now):
+    """
+    Окно доставки рассылки mailing (запись пачки load_batch()) по местному времени клиента часового пояса zone:
+    None-- в момент now (unix timestamp) окна нет или оно идет, иначе unix timestamp ближайшего начала окна.
+    Время отправки сообщения уже попадает в окно (Mailing.local_starts_at), но сообщение могут захватить и отправить
+    позже: после очереди, circuit breaker или повтора с задержкой окно может закончиться.
+    """
+
+    if len(mailing) < 5 or mailing[3] is None or zone is None:
+        return None
+    start, end = (datetime.strptime(value, '%H:%M:%S').time() for value in mailing[3:5])
+    at = datetime.fromtimestamp(now, tz=timezone.utc)
+    opens_at = window_starts_at(at, zone, start, end)
+    return None if opens_at == at else opens_at.timestamp()
+
+
+def defer(deferred):
+    """
+    Сообщения вне окна доставки: deferred-- {unix timestamp начала окна: список id сообщений}. Сообщение возвращается
+    в статус 'new' с временем отправки, равным началу окна, попытка не засчитывается. Одна команда UPDATE на время.
+    """
+
+    for opens_at, ids in sorted(deferred.items()):
+        starts_at = datetime.fromtimestamp(opens_at, tz=timezone.utc)
+        update_status(Message.objects.filter(pk__in=ids, status='active'), 'new', starts_at=starts_at)
+
+
+def stale_mailings(batch):
+    """
+    Рассылки пачки batch (load_batch()), отправлять которые уже не нужно: после загрузки пачки расписание рассылки
+    изменилось (другое поколение Mailing.version), рассылку приостановили, отменили или удалили.
+    Один запрос на пачку, а не на сообщение. Возвращает множество id рассылок.
+    """
+
+    versions = {int(mailing_id): mailing[2] for mailing_id, mailing in batch['mailings'].items() if len(mailing) > 2}
+    if not versions:
+        return set()
+    current = dict(Mailing.objects.filter(pk__in=versions, state='active').values_list('id', 'version'))
+    return {mailing_id for mailing_id, version in versions.items() if current.get(mailing_id) != version}
+
+
+def deliver_batch(message_ids=None, id_range=None, batch=None, concurrency=CONCURRENCY, buffer=None):
+    """
+    Отправка пачки сообщений одним вызовом (например, из одного Celery таска на всю пачку).
+    Пачка-- готовые данные сообщений batch (load_batch()), тогда БД нужна только для записи статусов. Иначе пачка
+    задается списком id сообщений message_ids либо диапазоном id_range: (первый id, последний id) и загружается
+    одним запросом (только сообщения в статусе 'active').
+    Отправляются сообщения, время отправки которых не вышло за время окончания рассылки. Если у клиента закончилось
+    окно доставки рассылки, сообщение переносится на начало следующего окна (defer()), а если оно начнется после
+    окончания рассылки-- 'failure'.
+    Скорость отправки ограничена общим для всех воркеров лимитом (ratelimit.TokenBucket).
+    Статусы меняются так же, как в tasks.send_message(): 200-- 'sent', время вышло-- 'failure', ошибка или таймаут--
+    повтор позже (retry_later()): снова 'new' либо 'dead' после последней попытки. Сообщения, которые не были
+    отправлены из-за circuit breaker, возвращаются в 'new' без учета попытки.
+    Статусы и журнал отправки (модель DeliveryLog) записываются в БД сразу (write_outcome()), либо, если задан
+    buffer (writeback.StatusBuffer), позже вместе с результатами других пачек воркера.
+    Сообщения устаревших рассылок готовой пачки (stale_mailings()) не отправляются: их уже перепланировали,
+    приостановили или отменили (./lifecycle.py), захваченные сообщения приостановленной рассылки возвращаются в 'new'
+    (renew_lease()). Также отбрасываются сообщения, аренду которых
+    не удалось продлить (renew_lease()): их вернул в работу sweeper, пока пачка ждала в очереди.
+    Возвращает словарь {статус: список id сообщений}, 'stale'-- отброшенные сообщения, 'deferred'-- перенесенные.
+    """
+
+    if batch is None:
+        stale = set()
+        if id_range is not None:
+            batch = load_batch(Message.objects.filter(pk__range=id_range, status='active'))
+        else:
+            batch = load_batch(Message.objects.filter(pk__in=message_ids, status='active'))
+    else:
+        stale = stale_mailings(batch)
+    lost = renew_lease(batch, stale)
+
+    now = timezone.now().timestamp()
+    outcome = {'sent': [], 'new': [], 'failure': []}
+    payloads = list()
+    attempts = dict()
+    mailings = dict()
+    starts = dict()
+    log = list()
+    dropped = list()
+    deferred = dict()
+    for message_id, number, starts_at, message_attempts, mailing_id, *client in batch['messages']:
+        mailing = batch['mailings'][str(mailing_id)]
+        text, expired_at = mailing[:2]
+        opens_at = window_opens_at(mailing, client[0] if client else None, now)
+        if mailing_id in stale or message_id in lost:
+            dropped.append(message_id)
+        elif starts_at <= now < expired_at and opens_at is None:
+            payloads.append({'id': message_id, 'phone': number, 'text': text})
+            attempts[message_id] = message_attempts
+            mailings[message_id] = mailing_id
+            starts[message_id] = starts_at
+        elif starts_at <= now and opens_at is not None and opens_at < expired_at:
+            # окно доставки клиента закончилось: отправка в начале следующего окна
+            deferred.setdefault(opens_at, list()).append(message_id)
+        else:
+            # не успели отправить сообщение вовремя
+            outcome['failure'].append(message_id)
+            log.append((message_id, mailing_id, 'failure', None, None, message_attempts, now))
+
+    failed = list()
+    latencies, lags = list(), list()
+    if payloads:
+        with metrics.span('post', messages=len(payloads)):
+            responses = asyncio.run(post_messages(payloads, concurrency=concurrency, limiter=TokenBucket(),
+                                                  latency=True))
+        finished = time()
+        for payload in payloads:
+            message_id = payload['id']
+            if message_id not in responses:
+                # не отправлено из-за circuit breaker, попытки не было
+                outcome['new'].append(message_id)
+                continue
+            code, seconds = responses[message_id]
+            latencies.append(seconds)
+            if code == 200:
+                outcome['sent'].append(message_id)
+                status = 'sent'
+                lags.append(finished - starts[message_id])
+            else:
+                failed.append((message_id, attempts[message_id]))
+                status = retry_status(attempts[message_id])
+            log.append((message_id, mailings[message_id], status, code, seconds, attempts[message_id] + 1, finished))
+
+    metrics.inc('mailing_messages_delivered_total', len(outcome['sent']))
+    metrics.inc('mailing_messages_failed_total', len(failed))
+    metrics.inc('mailing_messages_expired_total', len(outcome['failure']))
+    metrics.inc('mailing_messages_stale_total', len(dropped))
+    metrics.inc('mailing_messages_deferred_total', sum(len(ids) for ids in deferred.values()))
+    metrics.observe('mailing_http_latency_seconds', latencies)
+    metrics.observe('mailing_queue_lag_seconds', lags)
+
+    defer(deferred)
+    if buffer is None:
+        write_outcome(outcome, failed, log)
+    else:
+        buffer.add(outcome, failed, log)
+
+    summary = {status: list(ids) for status, ids in outcome.items()}
+    summary['dead'] = list()
+    summary['stale'] = dropped
+    summary['deferred'] = [message_id for ids in deferred.values() for message_id in ids]
+    for message_id, message_attempts in failed:
+        summary[retry_status(message_attempts)].append(message_id)
+    return summary
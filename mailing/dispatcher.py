@@ -0,0 +1,136 @@
+import logging
+import math
+import os
+import signal
+import socket
+import threading
+from datetime import timedelta
+
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from project.settings import CELERY_SETTINGS_FBRQ
+from . import metrics
+from .models import Dispatcher, ShardLease
+
+logger = logging.getLogger(__name__)
+
+# настройки шардированных диспетчеров: количество шардов, время аренды шарда (сек), пауза (сек) между проходами
+# диспетчера, если захватывать нечего
+DISPATCH = CELERY_SETTINGS_FBRQ['dispatch']
+
+
+class ShardedDispatcher:
+    """
+    Один из нескольких параллельных диспетчеров (python manage.py run_dispatcher): сообщения делятся на shards шардов
+    по id сообщения (id % shards), каждый диспетчер захватывает и ставит в очередь сообщения только своих шардов,
+    поэтому скорость диспетчеризации растет вместе с количеством диспетчеров.
+    Шарды распределяются через БД: диспетчер арендует шарды на lease секунд (модель ShardLease) и продлевает аренду
+    каждый проход. Живые диспетчеры отмечаются в модели Dispatcher, каждый держит не больше
+    ceil(shards / живых диспетчеров) шардов: новый диспетчер получает шарды, которые отпускают остальные, а шарды
+    упавшего диспетчера после окончания аренды забирают живые.
+    Аренда распределяет работу, но не отвечает за единственность отправки: захват сообщений (tasks.claim_messages())
+    атомарный, поэтому кратковременное пересечение шардов при перераспределении не приводит к повторной отправке.
+    """
+
+    def __init__(self, dispatch, shards=DISPATCH['shards'], lease=DISPATCH['lease'], name=None):
+        # dispatch(shards)-- один проход диспетчера по своим шардам ((свои шарды, всего шардов)), возвращает
+        # количество захваченных и созданных из снимков аудитории сообщений
+        self.dispatch = dispatch
+        self.shards = shards
+        self.lease = timedelta(seconds=lease)
+        self.name = name or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.owned = list()
+        # остановка по SIGTERM: текущий проход заканчивается, затем шарды отпускаются
+        self.stopping = threading.Event()
+
+    def heartbeat(self, now):
+        """
+        Отметка живого диспетчера. Возвращает количество живых диспетчеров.
+        """
+
+        alive = Dispatcher.objects.filter(pk=self.name)
+        if not alive.update(expires_at=now + self.lease):
+            try:
+                with transaction.atomic():
+                    Dispatcher.objects.create(pk=self.name, expires_at=now + self.lease)
+            except IntegrityError:
+                alive.update(expires_at=now + self.lease)
+        Dispatcher.objects.filter(expires_at__lte=now - self.lease).delete()
+        return Dispatcher.objects.filter(expires_at__gt=now).count()
+
+    def balance(self):
+        """
+        Продление аренды своих шардов и перераспределение: лишние шарды отпускаются, недостающие берутся из свободных
+        и просроченных (условным UPDATE, поэтому один шард не достанется двум диспетчерам). Возвращает свои шарды.
+        """
+
+        now = timezone.now()
+        fair = math.ceil(self.shards / max(self.heartbeat(now), 1))
+        leases = ShardLease.objects.filter(shard__lt=self.shards)
+        if leases.count() < self.shards:
+            ShardLease.objects.bulk_create([ShardLease(shard=shard) for shard in range(self.shards)],
+                                           ignore_conflicts=True)
+
+        leases.filter(owner=self.name).update(expires_at=now + self.lease)
+        owned = list(leases.filter(owner=self.name).order_by('shard').values_list('shard', flat=True))
+        if len(owned) > fair:
+            leases.filter(owner=self.name, shard__in=owned[fair:]).update(owner='', expires_at=None)
+            owned = owned[:fair]
+        free = Q(expires_at__isnull=True) | Q(expires_at__lte=now)
+        for shard in leases.filter(free).order_by('shard').values_list('shard', flat=True):
+            if len(owned) >= fair:
+                break
+            if leases.filter(free, shard=shard).update(owner=self.name, expires_at=now + self.lease):
+                owned.append(shard)
+
+        owned.sort()
+        if owned != self.owned:
+            logger.info('Dispatcher %s owns shards %s of %s', self.name, owned, self.shards)
+        self.owned = owned
+        return owned
+
+    def release(self):
+        """
+        Штатная остановка: шарды сразу отпускаются другим диспетчерам
+        """
+
+        ShardLease.objects.filter(owner=self.name).update(owner='', expires_at=None)
+        Dispatcher.objects.filter(pk=self.name).delete()
+
+    def stop(self, signum=None, frame=None):
+        """
+        Остановка основного цикла после текущего прохода (обработчик SIGTERM)
+        """
+
+        self.stopping.set()
+
+    def run(self, interval=DISPATCH['interval']):
+        """
+        Основной цикл: перераспределение шардов и проход по своим шардам. Если захватывать нечего, диспетчер спит
+        interval секунд. Проход захватывает ограниченную порцию сообщений, поэтому аренда продлевается чаще, чем
+        истекает. По SIGTERM (остановка контейнера, systemd) цикл заканчивается после текущего прохода и шарды
+        сразу отпускаются: без обработчика процесс завершился бы, не выполнив finally, и шарды ждали бы окончания
+        аренды.
+        """
+
+        handler = None
+        if threading.current_thread() is threading.main_thread():
+            handler = signal.signal(signal.SIGTERM, self.stop)
+        try:
+            while not self.stopping.is_set():
+                owned = self.balance()
+                dispatched = 0
+                if owned:
+                    with metrics.span('shard_dispatch'):
+                        dispatched = self.dispatch((owned, self.shards))
+                metrics.flush(interval=metrics.METRICS['interval'])
+                close_old_connections()
+                if not dispatched:
+                    self.stopping.wait(interval)
+        finally:
+            if handler is not None:
+                signal.signal(signal.SIGTERM, handler)
+            self.release()
+            metrics.flush()
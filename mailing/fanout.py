@@ -0,0 +1,195 @@
+import logging
+from time import perf_counter
+
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import counters, metrics
+from .lifecycle import new_version
+from .models import AudienceBlock, Client, Mailing, Message
+from .ratelimit import TokenBucket
+from .snapshot import SNAPSHOT, pack, unpack
+
+logger = logging.getLogger(__name__)
+
+# Количество сообщений в одном INSERT при пакетной вставке (Message.objects.bulk_create)
+FANOUT_BATCH = 5000
+# Бэкенды БД, которые создают сообщения одним запросом INSERT ... SELECT прямо из выборки клиентов
+INSERT_SELECT_VENDORS = ('postgresql', 'sqlite', 'mysql')
+
+
+def insert_method():
+    return 'insert_select' if connection.vendor in INSERT_SELECT_VENDORS else 'bulk_create'
+
+
+def insert_messages(mailing, clients, method):
+    """
+    Вставка сообщений 'new' рассылки mailing для клиентов выборки clients: по одной команде на часовой пояс клиентов
+    (INSERT ... SELECT) либо пачками (bulk_create). Счетчики рассылки не меняются. Возвращает количество сообщений.
+    """
+
+    rows = 0
+    for zone, starts_at in zone_buckets(mailing, clients).items():
+        bucket = clients if zone is None else clients.filter(zone=zone)
+        if method == 'insert_select':
+            rows += _insert_select(mailing, bucket, starts_at)
+        else:
+            rows += _bulk_create(mailing, bucket, starts_at)
+    return rows
+
+
+def materialize(mailing_id=None, limit=SNAPSHOT['block'], shards=None):
+    """
+    Создание сообщений получателей из снимков аудитории (AudienceBlock) начавшихся, незакончившихся и не
+    приостановленных рассылок: блоки по порядку, пока не создано limit сообщений (доля захвата рассылки, из блока
+    берется не больше оставшейся доли, остаток блока сохраняется). Блок удаляется либо уменьшается в одной
+    транзакции с созданием его сообщений, поэтому параллельные диспетчеры не создадут сообщения одного блока дважды.
+    Клиенты, удаленные после создания снимка, пропускаются (счетчик 'new' рассылки уменьшается).
+    mailing_id-- только блоки этой рассылки, shards-- (свои шарды, всего шардов): только блоки с id % всего шардов из
+    своих шардов (./dispatcher.py). Пока circuit breaker приостановил отправку, сообщения не создаются.
+    Возвращает количество созданных сообщений.
+    """
+
+    now = timezone.now()
+    blocks = AudienceBlock.objects.filter(mailing__state='active', mailing__starts_at__lte=now,
+                                          mailing__expired_at__gte=now)
+    if mailing_id is not None:
+        blocks = blocks.filter(mailing=mailing_id)
+    if shards is not None:
+        owned, total = shards
+        blocks = blocks.annotate(shard=F('id') % total).filter(shard__in=owned)
+    if not blocks.exists() or TokenBucket().is_open():
+        return 0
+
+    started = perf_counter()
+    rows = 0
+    method = insert_method()
+    with metrics.span('materialize', mailing=mailing_id):
+        for block_id, block_mailing in blocks.order_by('id').values_list('id', 'mailing'):
+            with transaction.atomic():
+                block = AudienceBlock.objects.filter(pk=block_id).values_list('clients', 'count').first()
+                if block is None:
+                    # блок забрал параллельный диспетчер
+                    continue
+                ids = unpack(block[0])
+                taken, rest = ids[:limit - rows], ids[limit - rows:]
+                # count-- версия блока: параллельный диспетчер, который успел забрать блок или его часть, его изменил
+                current = AudienceBlock.objects.filter(pk=block_id, count=block[1])
+                if not (current.update(clients=pack(rest), count=len(rest)) if rest else current.delete()[0]):
+                    continue
+                mailing = Mailing.objects.get(pk=block_mailing)
+                created = _insert_clients(mailing, taken, method)
+                counters.add(block_mailing, 'new', created - len(taken))
+            rows += created
+            if rows >= limit:
+                break
+    metrics.inc('mailing_messages_fanned_out_total', rows)
+    if rows:
+        log_rate('Materialize', mailing_id, rows, perf_counter() - started, method)
+    return rows
+
+
+def log_rate(stage, mailing_id, rows, seconds, method):
+    """
+    Запись в лог количества созданных сообщений этапа stage ('Fan-out' либо 'Materialize'), времени и скорости
+    вставки (строк в секунду). Возвращает статистику.
+    """
+
+    stats = {
+        'stage': stage,
+        'mailing': mailing_id,
+        'method': method,
+        'rows': rows,
+        'seconds': round(seconds, 3),
+        'rows_per_sec': round(rows / seconds) if seconds > 0 else rows,
+    }
+    logger.info('%(stage)s mailing %(mailing)s: %(rows)s messages in %(seconds)s s (%(rows_per_sec)s rows/sec, '
+                '%(method)s)', stats)
+    return stats
+
+
+def _insert_clients(mailing, ids, method):
+    """
+    Сообщения рассылки mailing для клиентов со списком id ids: выборка клиентов по частям, не больше параметров
+    запроса, чем допускает бэкенд (connection.ops.bulk_batch_size(), в SQLite-- 999). Возвращает количество сообщений.
+    """
+
+    size = max(connection.ops.bulk_batch_size(['id'], ids), 1)
+    return sum(insert_messages(mailing, Client.objects.filter(pk__in=ids[i:i + size]), method)
+               for i in range(0, len(ids), size))
+
+
+def zone_buckets(mailing, clients):
+    """
+    Время отправки сообщений по часовым поясам клиентов: {часовой пояс: время отправки}.
+    Без окна доставки все клиенты в одной группе: {None: начало рассылки}.
+    """
+
+    if mailing.window_start is None:
+        return {None: mailing.starts_at}
+    zones = clients.order_by().values_list('zone', flat=True).distinct()
+    return {zone: mailing.local_starts_at(zone) for zone in zones}
+
+
+def reschedule(mailing):
+    """
+    Новое время отправки всех неотправленных сообщений рассылки после изменения начала рассылки или окна доставки:
+    одна команда UPDATE на каждый часовой пояс клиентов. Новое поколение расписания рассылки (Mailing.version):
+    пачки сообщений со старым расписанием, которые уже в очереди, воркеры не отправят. У захваченных сообщений
+    ('active') меняется только время отправки: пачку, которая еще ждет в очереди, воркер отбросит и сам вернет ее
+    сообщения в 'new' (delivery.renew_lease()), а пачка, которую воркер уже отправляет, запишет настоящие результаты
+    отправки, как и при паузе рассылки (lifecycle.pause()). Вызывать в транзакции. Возвращает количество сообщений.
+    """
+
+    new_version(mailing)
+    messages = Message.objects.filter(mailing=mailing.pk).exclude(status='sent')
+    # новое расписание-- попытки отправки начинаются заново, в том числе у сообщений в статусе 'dead'
+    retry = {'attempts': 0, 'next_attempt_at': None}
+    if mailing.window_start is None:
+        return _reschedule(messages, mailing.starts_at, retry)
+    rows = 0
+    zones = messages.order_by().values_list('client__zone', flat=True).distinct()
+    for zone in list(zones):
+        rows += _reschedule(messages.filter(client__zone=zone), mailing.local_starts_at(zone), retry)
+    return rows
+
+
+def _reschedule(messages, starts_at, retry):
+    claimed = messages.filter(status='active').update(starts_at=starts_at)
+    return claimed + counters.update_status(messages.exclude(status='active'), 'new', starts_at=starts_at, **retry)
+
+
+def _insert_select(mailing, clients, starts_at):
+    """
+    INSERT INTO mailing_message (...) SELECT ... FROM (выборка клиентов): одна команда на всю рассылку.
+    """
+
+    table = connection.ops.quote_name(Message._meta.db_table)
+    columns = ', '.join(connection.ops.quote_name(Message._meta.get_field(name).column)
+                        for name in ('starts_at', 'status', 'attempts', 'mailing', 'client'))
+    query, params = clients.order_by().values('id').query.sql_with_params()
+    sql = 'INSERT INTO {} ({}) SELECT %s, %s, %s, %s, audience.id FROM ({}) audience'.format(table, columns, query)
+    starts_at = connection.ops.adapt_datetimefield_value(starts_at)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, (starts_at, 'new', 0, mailing.pk, *params))
+        return cursor.rowcount
+
+
+def _bulk_create(mailing, clients, starts_at):
+    """
+    Потоковое чтение id клиентов и вставка сообщений пачками по FANOUT_BATCH.
+    """
+
+    rows = 0
+    batch = list()
+    for client_id in clients.order_by().values_list('id', flat=True).iterator(chunk_size=FANOUT_BATCH):
+        batch.append(Message(starts_at=starts_at, mailing_id=mailing.pk, client_id=client_id))
+        if len(batch) == FANOUT_BATCH:
+            Message.objects.bulk_create(batch, batch_size=FANOUT_BATCH)
+            rows += len(batch)
+            batch.clear()
+    if batch:
+        Message.objects.bulk_create(batch, batch_size=FANOUT_BATCH)
+        rows += len(batch)
+    return rows
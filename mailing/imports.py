@@ -0,0 +1,145 @@
+import csv
+import json
+from itertools import chain
+
+from django.db import connection, transaction
+
+from .models import Client, operator_code
+
+# Количество строк, проверяемых и записываемых в БД за один раз
+IMPORT_BATCH = 5000
+# Максимальное количество отклоненных строк, которые перечисляются в ответе (всего отклоненных-- счетчик rejected)
+MAX_REJECTS = 1000
+# допустимые часовые пояса клиента, см. models.Client.TIMEZONES
+ZONES = {zone for zone, _ in Client.TIMEZONES}
+# поля клиента в CSV без заголовка
+CSV_FIELDS = ('number', 'tag', 'zone')
+# строка не в UTF-8: вместо словаря полей клиента, отклоняется с номером строки
+NOT_UTF8 = object()
+
+
+def read_csv(lines):
+    """
+    Строки CSV (байты UTF-8, возможно с BOM) --> (номер строки, словарь полей клиента). Первая строка-- заголовок, если
+    в ней есть 'number'. Строка не в UTF-8-- (номер строки, NOT_UTF8).
+    """
+
+    undecodable = set()
+
+    def decode():
+        for line_num, line in enumerate(lines, start=1):
+            try:
+                yield line.decode('utf-8-sig')
+            except UnicodeDecodeError:
+                undecodable.add(line_num)
+                yield '\n'
+
+    reader = csv.reader(decode())
+    fields = CSV_FIELDS
+    for row in reader:
+        if reader.line_num in undecodable:
+            yield reader.line_num, NOT_UTF8
+            continue
+        if reader.line_num == 1 and 'number' in row:
+            fields = tuple(name.strip() for name in row)
+            continue
+        if row:
+            yield reader.line_num, dict(zip(fields, row))
+
+
+def read_ndjson(lines):
+    """
+    Строки NDJSON (байты, один json объект клиента на строку) --> (номер строки, словарь полей клиента).
+    Строка не в UTF-8-- (номер строки, NOT_UTF8).
+    """
+
+    for line_num, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line.decode('utf-8-sig'))
+        except UnicodeDecodeError:
+            yield line_num, NOT_UTF8
+            continue
+        except ValueError:
+            row = None
+        yield line_num, row if isinstance(row, dict) else None
+
+
+def validate(row):
+    """
+    Проверка полей клиента (те же ограничения, что у models.Client). Возвращает (поля клиента, текст ошибки).
+    """
+
+    if row is NOT_UTF8:
+        return None, 'Line is not UTF-8 text.'
+    if row is None:
+        return None, 'Invalid row format.'
+    try:
+        number = int(row.get('number'))
+    except (TypeError, ValueError):
+        return None, 'Invalid number.'
+    if not 70000000000 <= number <= 79999999999:
+        return None, 'Number must be in range 70000000000..79999999999.'
+    code = operator_code(number)
+    if not 900 <= code <= 999:
+        return None, 'Operator code must be in range 900..999.'
+    tag = str(row.get('tag') or '').strip()
+    if not tag or len(tag) > 100:
+        return None, 'Tag is required, max 100 characters.'
+    zone = str(row.get('zone') or 'Europe/Moscow').strip()
+    if zone not in ZONES:
+        return None, 'Unknown time zone.'
+    return {'number': number, 'code': code, 'tag': tag, 'zone': zone}, None
+
+
+def upsert(clients):
+    """
+    Запись пачки клиентов {номер: поля клиента}: новые номера-- bulk_create, существующие-- bulk_update.
+    Существующие клиенты ищутся по частям, не больше параметров запроса, чем допускает бэкенд
+    (connection.ops.bulk_batch_size(), в SQLite-- 999). Возвращает (количество добавленных, количество обновленных).
+    """
+
+    numbers = list(clients)
+    size = max(connection.ops.bulk_batch_size(['number'], numbers), 1)
+    with transaction.atomic():
+        existing = chain.from_iterable(Client.objects.filter(number__in=numbers[i:i + size]).only('id', 'number')
+                                       for i in range(0, len(numbers), size))
+        updated = list()
+        for client in existing:
+            fields = clients.pop(client.number)
+            client.code, client.tag, client.zone = fields['code'], fields['tag'], fields['zone']
+            updated.append(client)
+        Client.objects.bulk_update(updated, ['code', 'tag', 'zone'], batch_size=IMPORT_BATCH)
+        # размер команды INSERT выбирает бэкенд БД: в SQLite не более 500 строк в одной команде
+        Client.objects.bulk_create([Client(**fields) for fields in clients.values()])
+    return len(clients), len(updated)
+
+
+def import_clients(rows):
+    """
+    Массовый импорт клиентов: rows-- поток (номер строки, словарь полей клиента) из read_csv() или read_ndjson().
+    Строки проверяются и записываются пачками по IMPORT_BATCH, повтор номера в пачке-- последняя строка побеждает.
+    Возвращает сводку: количество добавленных, обновленных и отклоненных строк, номера отклоненных строк с ошибками.
+    """
+
+    summary = {'inserted': 0, 'updated': 0, 'rejected': 0, 'errors': []}
+    batch = dict()
+    for line_num, row in rows:
+        client, error = validate(row)
+        if error is not None:
+            summary['rejected'] += 1
+            if len(summary['errors']) < MAX_REJECTS:
+                summary['errors'].append({'line': line_num, 'error': error})
+            continue
+        batch[client['number']] = client
+        if len(batch) == IMPORT_BATCH:
+            inserted, updated = upsert(batch)
+            summary['inserted'] += inserted
+            summary['updated'] += updated
+            batch = dict()
+    if batch:
+        inserted, updated = upsert(batch)
+        summary['inserted'] += inserted
+        summary['updated'] += updated
+    return summary
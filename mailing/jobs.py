@@ -0,0 +1,192 @@
+import hashlib
+import json
+from datetime import timedelta
+from time import perf_counter
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import counters, metrics
+from .fanout import insert_messages, insert_method, log_rate
+from .models import AudienceBlock, Mailing, MailingJob
+from .snapshot import SNAPSHOT, pack
+from .sweeper import LEASE
+
+# Фоновое создание аудитории рассылки: запрос POST /api/mailing/ только сохраняет рассылку и задание MailingJob,
+# а выборка клиентов и создание сообщений идут в таске tasks.build_audience пачками по BATCH клиентов в порядке
+# возрастания id. Каждая пачка-- отдельная транзакция вместе с позицией задания и счетчиком 'new' рассылки, поэтому
+# задание можно продолжить с места остановки, а прогресс виден сразу (GET /api/mailing/job/<id>/).
+# Большая аудитория (не меньше SNAPSHOT['min_audience'] клиентов) сохраняется блоками снимка (./snapshot.py).
+
+# клиентов в одной пачке задания: одна пачка-- один блок снимка аудитории
+BATCH = SNAPSHOT['block']
+# задание закончено
+FINISHED = ('done', 'cancelled', 'failed')
+# попыток задания до статуса 'failed' и задержка (сек) перед повтором после ошибки
+ATTEMPTS = 5
+RETRY_DELAY = 30
+
+
+def fingerprint(data):
+    """
+    Отпечаток данных запроса создания рассылки: повтор с тем же ключом идемпотентности и другими данными отклоняется
+    """
+
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def find(key):
+    """
+    Задание создания рассылки с ключом идемпотентности key либо None
+    """
+
+    if not key:
+        return None
+    return MailingJob.objects.select_related('mailing').filter(key=key).first()
+
+
+def submit(serializer, key=None):
+    """
+    Создание рассылки (serializer.save()) и задания ее аудитории в одной транзакции. key-- ключ идемпотентности:
+    если задание с этим ключом уже есть (повтор запроса клиентом, в том числе параллельный), новая рассылка
+    не создается. Отпечаток задания-- по данным запроса (serializer.initial_data), чтобы повтор можно было сверить
+    до проверки данных. Возвращает (задание, создано ли задание).
+    """
+
+    job = find(key)
+    if job is not None:
+        return job, False
+    try:
+        with transaction.atomic():
+            mailing = serializer.save()
+            job = MailingJob.objects.create(mailing=mailing, key=key or None,
+                                            fingerprint=fingerprint(serializer.initial_data))
+    except IntegrityError:
+        if not key:
+            raise
+        # задание с этим ключом успел создать параллельный запрос
+        return MailingJob.objects.select_related('mailing').get(key=key), False
+    return job, True
+
+
+def finish(job_id, status, error=''):
+    now = timezone.now()
+    MailingJob.objects.filter(pk=job_id).exclude(status__in=FINISHED).update(status=status, error=error,
+                                                                             updated_at=now, finished_at=now)
+
+
+def step(job_id, batch=BATCH):
+    """
+    Одна пачка задания: следующие batch клиентов выборки рассылки после позиции задания получают сообщения (или блок
+    снимка аудитории). Позиция задания сдвигается условным UPDATE первой командой транзакции, поэтому пачку не
+    обработают дважды два исполнителя одного задания (повторный запуск после tasks.sweep). Если рассылку отменили,
+    задание останавливается. Возвращает количество клиентов пачки, 0-- задание закончено.
+    """
+
+    job = MailingJob.objects.select_related('mailing').filter(pk=job_id).first()
+    if job is None or job.status in FINISHED:
+        return 0
+    mailing = job.mailing
+    if mailing.state == 'cancelled':
+        finish(job.pk, 'cancelled')
+        return 0
+    clients = mailing.clients()
+    if job.total is None:
+        total = clients.count()
+        method = 'snapshot' if SNAPSHOT['enabled'] and total >= SNAPSHOT['min_audience'] else insert_method()
+        now = timezone.now()
+        MailingJob.objects.filter(pk=job.pk, total__isnull=True).update(status='running', total=total, method=method,
+                                                                        started_at=now, updated_at=now)
+        job.refresh_from_db()
+
+    ids = list(clients.filter(id__gt=job.cursor).order_by('id').values_list('id', flat=True)[:batch])
+    if not ids:
+        finish(job.pk, 'done')
+        return 0
+    started = perf_counter()
+    with metrics.span('fan_out', mailing=mailing.pk), transaction.atomic():
+        moved = MailingJob.objects.filter(pk=job.pk, cursor=job.cursor).exclude(status__in=FINISHED)
+        if not moved.update(cursor=ids[-1], updated_at=timezone.now()):
+            # пачку забрал параллельный исполнитель задания
+            return len(ids)
+        state = Mailing.objects.select_for_update().filter(pk=mailing.pk).values_list('state', flat=True).first()
+        if state == 'cancelled':
+            transaction.set_rollback(True)
+            rows = 0
+        elif job.method == 'snapshot':
+            rows = AudienceBlock.objects.create(mailing=mailing, clients=pack(ids), count=len(ids)).count
+        else:
+            rows = insert_messages(mailing, clients.filter(id__gte=ids[0], id__lte=ids[-1]), job.method)
+        if rows:
+            counters.add(mailing.pk, 'new', rows)
+            MailingJob.objects.filter(pk=job.pk).update(done=F('done') + rows)
+    if state == 'cancelled':
+        finish(job.pk, 'cancelled')
+        return 0
+    if job.method != 'snapshot':
+        metrics.inc('mailing_messages_fanned_out_total', rows)
+    log_rate('Fan-out', mailing.pk, rows, perf_counter() - started, job.method)
+    return len(ids)
+
+
+def fail(job_id, error, attempts=ATTEMPTS):
+    """
+    Ошибка задания: задание остается незаконченным, его продолжит повтор таска или tasks.sweep (позиция задания
+    сохранена вместе с последней удачной пачкой). После attempts ошибок задание получает статус 'failed'.
+    Возвращает True, если задание закончено.
+    """
+
+    MailingJob.objects.filter(pk=job_id).exclude(status__in=FINISHED).update(
+        attempts=F('attempts') + 1, error=error, updated_at=timezone.now())
+    if MailingJob.objects.filter(pk=job_id, attempts__gte=attempts).exists():
+        finish(job_id, 'failed', error=error)
+    return MailingJob.objects.filter(pk=job_id, status__in=FINISHED).exists()
+
+
+def stale(lease=LEASE):
+    """
+    Задания, исполнитель которых пропал (упал воркер или таск не дошел до брокера): не закончены и не менялись
+    дольше lease секунд. Задание отмечается условным UPDATE, чтобы параллельный обход не запустил его повторно.
+    Возвращает список id заданий для повторного запуска.
+    """
+
+    now = timezone.now()
+    before = now - timedelta(seconds=lease)
+    jobs = MailingJob.objects.exclude(status__in=FINISHED)
+    jobs = jobs.filter(Q(updated_at__lt=before) | Q(updated_at__isnull=True, created_at__lt=before))
+    resumed = list()
+    for job_id, updated_at in jobs.order_by('id').values_list('id', 'updated_at'):
+        if MailingJob.objects.filter(pk=job_id, updated_at=updated_at).update(updated_at=now):
+            resumed.append(job_id)
+    return resumed
+
+
+def progress(job):
+    """
+    Прогресс задания: обработано получателей, скорость (получателей в секунду) и оценка оставшегося времени (сек)
+    """
+
+    end = job.finished_at or timezone.now()
+    seconds = (end - job.started_at).total_seconds() if job.started_at else 0
+    rate = job.done / seconds if seconds > 0 else None
+    if job.status in FINISHED:
+        eta = 0
+    elif rate and job.total is not None:
+        eta = round(max(job.total - job.done, 0) / rate, 1)
+    else:
+        eta = None
+    return {
+        'id': job.pk,
+        'mailing': job.mailing_id,
+        'status': job.status,
+        'method': job.method,
+        'total': job.total,
+        'done': job.done,
+        'rate': round(rate, 1) if rate is not None else None,
+        'eta': eta,
+        'created_at': job.created_at,
+        'started_at': job.started_at,
+        'finished_at': job.finished_at,
+        'error': job.error,
+    }
@@ -0,0 +1,81 @@
+from django.db import transaction
+from django.db.models import F
+
+from . import counters
+from .models import AudienceBlock, Mailing, Message
+from .snapshot import close
+
+# Управление запущенной рассылкой: поколение расписания (Mailing.version), пауза, возобновление и отмена.
+# Все изменения сообщений-- одна команда UPDATE на рассылку, а не сохранение каждого сообщения. Пачки сообщений,
+# которые уже ждут в очереди брокера или отправляются воркером, не отменяются по одной: воркер сравнивает поколение
+# рассылки из пачки с текущим одним запросом на пачку (delivery.stale_mailings()) и отбрасывает устаревшие пачки.
+
+# действие --> состояния рассылки, из которых оно допустимо
+TRANSITIONS = {
+    'pause': ('active',),
+    'resume': ('paused',),
+    'cancel': ('active', 'paused'),
+}
+
+
+def new_version(mailing):
+    """
+    Следующее поколение расписания рассылки: пачки сообщений прежнего поколения воркеры не отправляют.
+    Возвращает новое поколение.
+    """
+
+    Mailing.objects.filter(pk=mailing.pk).update(version=F('version') + 1)
+    mailing.refresh_from_db(fields=['version'])
+    return mailing.version
+
+
+def _set_state(mailing, state):
+    Mailing.objects.filter(pk=mailing.pk).update(state=state)
+    mailing.state = state
+
+
+def pause(mailing):
+    """
+    Приостановка рассылки: новые сообщения не захватываются, пока рассылка не возобновлена. Сообщения, уже
+    захваченные диспетчером ('active'), здесь не меняются: пачку, которая еще ждет в очереди, воркер отбросит по
+    поколению рассылки и сам вернет ее сообщения в 'new' (delivery.renew_lease()), а пачка, которую воркер уже
+    отправляет, запишет настоящие результаты отправки. Если вернуть в 'new' и такие сообщения, после возобновления
+    их отправили бы второй раз. Сообщения упавшего воркера вернет sweeper.reap_stale() после окончания аренды.
+    Возвращает 0: статусы сообщений не меняются.
+    """
+
+    with transaction.atomic():
+        _set_state(mailing, 'paused')
+        new_version(mailing)
+    return 0
+
+
+def resume(mailing):
+    """
+    Возобновление приостановленной рассылки: сообщения 'new' снова захватываются для отправки.
+    """
+
+    _set_state(mailing, 'active')
+    return 0
+
+
+def cancel(mailing):
+    """
+    Отмена рассылки: сообщения 'new' одной командой получают статус 'failure', снимок аудитории рассылки удаляется
+    без создания сообщений (./snapshot.py). Захваченные сообщения ('active') здесь не меняются, как и при паузе:
+    пачка, которая еще ждет в очереди, отбрасывается воркером, и он сам переводит ее сообщения в 'failure'
+    (delivery.renew_lease()), а пачка, которую воркер уже отправляет, запишет настоящие результаты отправки
+    (delivery.write_outcome() меняет только сообщения 'active'). Сообщения, которые после отмены вернулись в 'new'
+    (повтор после ошибки, брошенные упавшим воркером), закрывает sweeper.expire(). Возвращает количество отмененных
+    сообщений.
+    """
+
+    with transaction.atomic():
+        _set_state(mailing, 'cancelled')
+        new_version(mailing)
+        messages = Message.objects.filter(mailing=mailing.pk, status='new')
+        cancelled = counters.update_status(messages, 'failure', next_attempt_at=None)
+        return cancelled + close(AudienceBlock.objects.filter(mailing=mailing.pk), 'failure')
+
+
+ACTIONS = {'pause': pause, 'resume': resume, 'cancel': cancel}
@@ -0,0 +1,46 @@
+import json
+import subprocess
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+
+class Command(BaseCommand):
+    help = ('Нагрузочный тест рассылки на отдельной тестовой БД: fan-out, диспетчеризация и отправка на заглушку '
+            'принимающего сервера. Результаты-- json для сравнения между коммитами.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=1000, help='количество клиентов')
+        parser.add_argument('--mailings', type=int, default=1, help='количество рассылок (на всех клиентов)')
+        parser.add_argument('--latency', type=float, default=0.01, help='средняя задержка ответа заглушки, сек')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов заглушки с кодом 500')
+        parser.add_argument('--rate', type=float, default=None,
+                            help='фиксированный лимит скорости отправки, сообщений в секунду')
+        parser.add_argument('--output', default=None, help='файл для результатов (по умолчанию stdout)')
+
+    def handle(self, *args, **options):
+        # отдельная пустая БД, рабочая БД не изменяется
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            from mailing.benchmark import run
+            result = run(clients=options['clients'], mailings=options['mailings'], latency=options['latency'],
+                         error_rate=options['error_rate'], rate=options['rate'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        result['commit'] = self.commit()
+
+        report = json.dumps(result, indent=2)
+        if options['output'] is None:
+            self.stdout.write(report)
+        else:
+            with open(options['output'], 'w') as output:
+                output.write(report)
+
+    @staticmethod
+    def commit():
+        try:
+            return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                  check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
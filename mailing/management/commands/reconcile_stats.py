@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from mailing.counters import rebuild
+
+
+class Command(BaseCommand):
+    help = 'Пересчет счетчиков сообщений рассылок (MailingStat) с нуля по таблице сообщений.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mailing', type=int, default=None, help='id рассылки (по умолчанию все рассылки)')
+
+    def handle(self, *args, **options):
+        rows = rebuild(options['mailing'])
+        self.stdout.write(self.style.SUCCESS('Rebuilt {} mailing counters.'.format(rows)))
@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from project.settings import CELERY_SETTINGS_FBRQ
+from mailing.sweeper import rotate_log
+
+
+class Command(BaseCommand):
+    help = 'Ротация журнала отправки (DeliveryLog): удаление записей старше срока хранения с выгрузкой в NDJSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=CELERY_SETTINGS_FBRQ['delivery_log']['retention_days'],
+                            help='срок хранения записей, дней (по умолчанию CELERY_SETTINGS_FBRQ)')
+        parser.add_argument('--archive', default=None, help='файл для выгрузки удаляемых записей (NDJSON, дописывается)')
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options['days'])
+        if options['archive'] is None:
+            rows = rotate_log(before)
+        else:
+            with open(options['archive'], 'a', encoding='utf-8') as archive:
+                rows = rotate_log(before, archive)
+        self.stdout.write(self.style.SUCCESS('Rotated {} delivery log entries.'.format(rows)))
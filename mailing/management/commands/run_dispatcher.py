@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from mailing.dispatcher import DISPATCH, ShardedDispatcher
+from mailing.tasks import dispatch_shards
+
+
+class Command(BaseCommand):
+    help = ('Диспетчер отправки одного шарда сообщений: несколько процессов делят сообщения по шардам с арендой '
+            'в БД и захватывают их параллельно.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shards', type=int, default=DISPATCH['shards'],
+                            help='количество шардов (одинаковое у всех диспетчеров)')
+        parser.add_argument('--name', default=None, help='имя диспетчера (по умолчанию хост:pid)')
+
+    def handle(self, *args, **options):
+        dispatcher = ShardedDispatcher(dispatch=dispatch_shards, shards=options['shards'], name=options['name'])
+        dispatcher.run()
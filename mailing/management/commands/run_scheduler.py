@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from project.celery import app
+from mailing.scheduler import SCHEDULE_QUEUE, DeadlineScheduler
+from mailing.tasks import send
+
+
+class Command(BaseCommand):
+    help = 'Планировщик запуска рассылок: запускает отправку сообщений рассылки ровно во время ее начала.'
+
+    def handle(self, *args, **options):
+        scheduler = DeadlineScheduler(dispatch=send.delay)
+        with app.connection_for_read() as connection:
+            with connection.SimpleQueue(SCHEDULE_QUEUE) as events:
+                scheduler.run(events)
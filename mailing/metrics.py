@@ -0,0 +1,200 @@
+import logging
+import threading
+from contextlib import contextmanager
+from time import monotonic, perf_counter
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Min, Sum
+from django.utils import timezone
+
+from project.settings import CELERY_SETTINGS_FBRQ
+from .models import MailingStat, Message, Metric, RateLimit
+
+logger = logging.getLogger(__name__)
+# отдельный логгер для временных отрезков этапов рассылки (spans), включается CELERY_SETTINGS_FBRQ['metrics']
+span_logger = logging.getLogger('mailing.spans')
+
+# настройки метрик: сбор метрик, запись временных отрезков этапов в лог
+METRICS = CELERY_SETTINGS_FBRQ['metrics']
+
+# границы корзин гистограмм, сек
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LAG_BUCKETS = (1, 5, 15, 30, 60, 300, 900, 3600, 21600, 86400)
+
+# метрики: имя --> (тип Prometheus, описание, границы корзин гистограммы)
+REGISTRY = {
+    'mailing_messages_fanned_out_total': ('counter', 'Messages created by mailing fan-out.', None),
+    'mailing_messages_claimed_total': ('counter', 'Messages claimed for delivery.', None),
+    'mailing_messages_delivered_total': ('counter', 'Messages accepted by the provider (HTTP 200).', None),
+    'mailing_messages_failed_total': ('counter', 'Failed delivery attempts (errors and timeouts).', None),
+    'mailing_messages_expired_total': ('counter', 'Messages not sent before the mailing end.', None),
+    'mailing_messages_stale_total': ('counter', 'Queued messages dropped after mailing reschedule, pause or cancel.',
+                                     None),
+    'mailing_messages_deferred_total': ('counter', 'Messages moved to the next delivery window of the client.', None),
+    'mailing_batches_queued_total': ('counter', 'Batch tasks queued for delivery, by broker queue.', None),
+    'mailing_http_latency_seconds': ('histogram', 'Provider response time.', LATENCY_BUCKETS),
+    'mailing_queue_lag_seconds': ('histogram', 'Delay between message starts_at and its delivery.', LAG_BUCKETS),
+    'mailing_stage_seconds': ('histogram', 'Pipeline stage duration.', LATENCY_BUCKETS),
+    'mailing_stage_db_seconds': ('histogram', 'Database time of pipeline stage.', LATENCY_BUCKETS),
+}
+
+_lock = threading.Lock()
+# накопленные в процессе изменения метрик: (имя серии, метки) --> прибавка
+_pending = dict()
+# время последней записи метрик процесса
+_flushed = [0.0]
+
+
+def _labels(**labels):
+    return ','.join('{}="{}"'.format(key, value) for key, value in sorted(labels.items()))
+
+
+def _add(name, labels, value):
+    key = (name, labels)
+    _pending[key] = _pending.get(key, 0) + value
+
+
+def inc(name, value=1, **labels):
+    """
+    Увеличить счетчик name на value
+    """
+
+    if not METRICS['enabled'] or not value:
+        return None
+    with _lock:
+        _add(name, _labels(**labels), value)
+
+
+def observe(name, values, **labels):
+    """
+    Добавить в гистограмму name значения values (список секунд)
+    """
+
+    if not METRICS['enabled'] or not values:
+        return None
+    buckets = REGISTRY[name][2]
+    with _lock:
+        for le in buckets:
+            _add(name + '_bucket', _labels(le=le, **labels), sum(1 for value in values if value <= le))
+        _add(name + '_bucket', _labels(le='+Inf', **labels), len(values))
+        _add(name + '_sum', _labels(**labels), sum(values))
+        _add(name + '_count', _labels(**labels), len(values))
+
+
+@contextmanager
+def span(stage, **labels):
+    """
+    Временной отрезок этапа рассылки: длительность этапа и время запросов к БД внутри него попадают в гистограммы
+    mailing_stage_seconds и mailing_stage_db_seconds, при METRICS['spans']-- еще и в лог 'mailing.spans' вместе с
+    метками (например, id рассылки), чтобы найти этап, который тормозит конкретную рассылку.
+    """
+
+    if not METRICS['enabled']:
+        yield
+        return None
+    db_time = [0.0]
+
+    def timer(execute, sql, params, many, context):
+        started = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            db_time[0] += perf_counter() - started
+
+    started = perf_counter()
+    try:
+        with connection.execute_wrapper(timer):
+            yield
+    finally:
+        seconds = perf_counter() - started
+        observe('mailing_stage_seconds', [seconds], stage=stage)
+        observe('mailing_stage_db_seconds', [db_time[0]], stage=stage)
+        if METRICS['spans']:
+            span_logger.info('span stage=%s seconds=%.6f db_seconds=%.6f %s', stage, seconds, db_time[0],
+                             ' '.join('{}={}'.format(key, value) for key, value in sorted(labels.items())))
+
+
+def flush(interval=0):
+    """
+    Запись накопленных изменений метрик процесса в общую для всех процессов таблицу Metric: одна команда UPDATE
+    на серию (в одном порядке во всех процессах), новая серия-- INSERT. Вызывается в конце тасков, запросов API и
+    тактов планировщика. interval-- не записывать, если с прошлой записи прошло меньше interval секунд.
+    Возвращает количество записанных серий.
+    """
+
+    with _lock:
+        if not _pending or monotonic() - _flushed[0] < interval:
+            return 0
+        _flushed[0] = monotonic()
+        pending = dict(_pending)
+        _pending.clear()
+    try:
+        with transaction.atomic():
+            for (name, labels), value in sorted(pending.items()):
+                series = Metric.objects.filter(name=name, labels=labels)
+                if series.update(value=F('value') + value):
+                    continue
+                try:
+                    with transaction.atomic():
+                        Metric.objects.create(name=name, labels=labels, value=value)
+                except IntegrityError:
+                    # серию успел создать параллельный процесс
+                    series.update(value=F('value') + value)
+    except Exception:
+        logger.exception('Metrics are not flushed')
+        with _lock:
+            for (name, labels), value in pending.items():
+                _add(name, labels, value)
+        return 0
+    return len(pending)
+
+
+def _family(name):
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and name[:-len(suffix)] in REGISTRY:
+            return name[:-len(suffix)]
+    return name
+
+
+def render():
+    """
+    Все метрики в текстовом формате Prometheus: накопленные счетчики и гистограммы (таблица Metric) и текущее
+    состояние рассылок, читаемое при каждом запросе (счетчики сообщений по статусам, лимит скорости, circuit breaker,
+    задержка самого старого неотправленного сообщения).
+    """
+
+    families = dict()
+    for name, labels, value in Metric.objects.order_by('name', 'labels').values_list('name', 'labels', 'value'):
+        families.setdefault(_family(name), list()).append((name, labels, value))
+
+    lines = list()
+    for family in sorted(families):
+        kind, description, _ = REGISTRY.get(family, ('untyped', '', None))
+        lines.append('# HELP {} {}'.format(family, description))
+        lines.append('# TYPE {} {}'.format(family, kind))
+        for name, labels, value in families[family]:
+            lines.append('{}{} {}'.format(name, '{' + labels + '}' if labels else '', _number(value)))
+
+    now = timezone.now()
+    statuses = MailingStat.objects.order_by().values_list('status').annotate(count=Sum('count'))
+    lines += ['# HELP mailing_messages Messages by status.', '# TYPE mailing_messages gauge']
+    lines += ['mailing_messages{{status="{}"}} {}'.format(status, count) for status, count in statuses]
+
+    limits = list(RateLimit.objects.values_list('name', 'rate', 'open_until'))
+    lines += ['# HELP mailing_rate_limit Delivery rate limit, messages per second.', '# TYPE mailing_rate_limit gauge']
+    lines += ['mailing_rate_limit{{name="{}"}} {}'.format(name, _number(rate)) for name, rate, _ in limits]
+    lines += ['# HELP mailing_circuit_breaker_open Delivery is paused by circuit breaker.',
+              '# TYPE mailing_circuit_breaker_open gauge']
+    lines += ['mailing_circuit_breaker_open{{name="{}"}} {}'.format(name, int(bool(open_until) and open_until > now))
+              for name, _, open_until in limits]
+
+    pending = Message.objects.filter(status='new', starts_at__lte=now, mailing__state='active')
+    oldest = pending.aggregate(oldest=Min('starts_at'))['oldest']
+    lines += ['# HELP mailing_pending_lag_seconds Age of the oldest due message not yet claimed.',
+              '# TYPE mailing_pending_lag_seconds gauge',
+              'mailing_pending_lag_seconds {}'.format(_number((now - oldest).total_seconds() if oldest else 0))]
+    return '\n'.join(lines) + '\n'
+
+
+def _number(value):
+    return int(value) if float(value).is_integer() else value
@@ -1,18 +1,107 @@
+import json
+from datetime import datetime, timedelta
+
+import pytz
 from django.db import models
+from django.db.models.functions import Coalesce
 from django.core.validators import MaxValueValidator, MinValueValidator, ValidationError
 
+from .audience import compile_filter, to_q
+
+
+def operator_code(number):
+    """
+    Код оператора из номера телефона: 79161234567 --> 916
+    """
+
+    return int(number) // 10_000_000 - 7_000
+
+
+# часовой пояс клиента по умолчанию
+DEFAULT_ZONE = 'Europe/Moscow'
+
+
+def window_starts_at(at, zone, start, end):
+    """
+    Ближайшее к моменту at время внутри окна доставки с start до end по местному времени часового пояса zone: at, если
+    в этот момент идет окно доставки, иначе ближайшее начало окна. Окно может переходить через полночь: с 22:00 до
+    06:00. Неизвестный часовой пояс-- часовой пояс клиента по умолчанию (DEFAULT_ZONE).
+    """
+
+    try:
+        tz = pytz.timezone(zone)
+    except pytz.UnknownTimeZoneError:
+        tz = pytz.timezone(DEFAULT_ZONE)
+    local = at.astimezone(tz)
+    now = local.time().replace(tzinfo=None)
+    inside = start <= now < end if start < end else (now >= start or now < end)
+    if inside:
+        return at
+    day = local.date() if now < start else local.date() + timedelta(days=1)
+    return tz.normalize(tz.localize(datetime.combine(day, start))).astimezone(pytz.utc)
+
+
+class MailingQuerySet(models.QuerySet):
+
+    def with_messages_status(self):
+        """
+        Количество сообщений каждой рассылки по каждому статусу из счетчиков MailingStat (не более одной строки
+        на статус, независимо от размера рассылки): атрибуты messages_total, messages_new, messages_active,
+        messages_sent, messages_failure.
+        """
+
+        counts = {'messages_total': Coalesce(models.Sum('stats__count'), 0)}
+        for status, _ in Message.STATUS:
+            counts['messages_' + status] = Coalesce(models.Sum('stats__count', filter=models.Q(stats__status=status)), 0)
+        return self.annotate(**counts)
+
 
 class Mailing(models.Model):
+    STATE = (('active', 'запущена'), ('paused', 'приостановлена'), ('cancelled', 'отменена'))
+
     starts_at = models.DateTimeField(verbose_name='Дата запуска рассылки')
     expired_at = models.DateTimeField(verbose_name='Дата окончания рассылки')
     text = models.TextField(max_length=500, verbose_name='Текст сообщения')
     filter = models.CharField(max_length=100, verbose_name='Фильтр: код оператора, теги')
+    audience = models.TextField(default='', editable=False, verbose_name='Разобранный фильтр клиентов (json)')
+    # окно доставки по местному времени клиента (Client.zone), например с 10:00 до 20:00
+    window_start = models.TimeField(null=True, blank=True, verbose_name='Начало окна доставки (время клиента)')
+    window_end = models.TimeField(null=True, blank=True, verbose_name='Конец окна доставки (время клиента)')
+    # состояние рассылки: приостановленная и отмененная рассылки не отправляются, см. ./lifecycle.py
+    state = models.CharField(max_length=20, choices=STATE, default='active', editable=False, verbose_name='Состояние')
+    # поколение расписания рассылки: растет при изменении расписания, паузе и отмене, пачки сообщений с прежним
+    # поколением воркеры не отправляют
+    version = models.PositiveIntegerField(default=0, editable=False, verbose_name='Поколение расписания')
+
+    objects = MailingQuerySet.as_manager()
 
     def save(self, *args, **kwargs):
         if self.expired_at < self.starts_at:
             raise ValidationError("Дата и время окончания рассылки не может быть меньше времени начала рассылки!")
+        if (self.window_start is None) != (self.window_end is None) or \
+                (self.window_start is not None and self.window_start == self.window_end):
+            raise ValidationError("Окно доставки задается временем начала и окончания, которые не совпадают!")
+        # фильтр разбирается один раз при сохранении рассылки, см. ./audience.py
+        self.audience = compile_filter(self.filter)
         super(Mailing, self).save(*args, **kwargs)
 
+    def clients(self):
+        """
+        Клиенты рассылки по фильтру: один запрос к модели Client
+        """
+
+        return Client.objects.filter(to_q(json.loads(self.audience or compile_filter(self.filter))))
+
+    def local_starts_at(self, zone):
+        """
+        Время отправки сообщений клиентам часового пояса zone: начало рассылки, если в этот момент у клиента идет
+        окно доставки, иначе ближайшее начало окна доставки по местному времени клиента.
+        """
+
+        if self.window_start is None:
+            return self.starts_at
+        return window_starts_at(self.starts_at, zone, self.window_start, self.window_end)
+
     def __str__(self):
         return "id: {}, text: {}".format(self.id, self.text[:100])
 
@@ -34,25 +123,34 @@ class Client(models.Model):
     code = models.PositiveSmallIntegerField(validators=[MinValueValidator(900), MaxValueValidator(999)],
                                             verbose_name='Код оператора')
     tag = models.CharField(max_length=100, verbose_name='Тег, произвольная метка')
-    zone = models.CharField(max_length=32, choices=TIMEZONES, default='Europe/Moscow', verbose_name='Часовой пояс')
+    zone = models.CharField(max_length=32, choices=TIMEZONES, default=DEFAULT_ZONE, verbose_name='Часовой пояс')
 
     def __str__(self):
         return "id: {}, number: {}".format(self.id, self.number)
 
     def __save__(self, *args, **kwargs):
-        self.code = int(self.number) // 10_000_000 - 7_000
+        self.code = operator_code(self.number)
         super(Client, self).save(*args, **kwargs)
 
     class Meta:
         verbose_name = 'Клиент'
         verbose_name_plural = 'Клиенты'
+        indexes = [
+            # выборка клиентов рассылки по тегу и коду оператора (фильтр рассылки)
+            models.Index(fields=['tag'], name='client_tag_idx'),
+            models.Index(fields=['code'], name='client_code_idx'),
+        ]
 
 
 class Message(models.Model):
-    STATUS = (('new', 'новый'), ('active', 'в обработке'), ('sent', 'отправлено'), ('failure', 'неудачная отправка'))
+    STATUS = (('new', 'новый'), ('active', 'в обработке'), ('sent', 'отправлено'), ('failure', 'неудачная отправка'),
+              ('dead', 'исчерпаны попытки отправки'))
 
     starts_at = models.DateTimeField(verbose_name='Дата отправки')
     status = models.CharField(max_length=20, choices=STATUS, default='new', verbose_name='Статус отправки')
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name='Количество неудачных попыток отправки')
+    next_attempt_at = models.DateTimeField(null=True, blank=True, verbose_name='Время следующей попытки отправки')
+    claimed_at = models.DateTimeField(null=True, blank=True, verbose_name='Время захвата сообщения в работу')
     mailing = models.ForeignKey('Mailing', related_name='messages', on_delete=models.CASCADE, verbose_name='id рассылки')
     client = models.ForeignKey('Client', related_name='clients', on_delete=models.CASCADE, verbose_name='id клиента')
 
@@ -62,3 +160,193 @@ class Message(models.Model):
     class Meta:
         verbose_name = 'Сообщение'
         verbose_name_plural = 'Сообщения'
+        indexes = [
+            # поиск сообщений для отправки: статус и время отправки (tasks.claim_messages)
+            models.Index(fields=['status', 'starts_at'], name='message_status_starts_idx'),
+            # частичный индекс только по неотправленным сообщениям: не растет вместе с историей отправленных
+            models.Index(fields=['starts_at'], name='message_pending_idx', condition=models.Q(status='new')),
+            # сообщения рассылки по статусу: детальная статистика, перепланирование и счетчики рассылки
+            models.Index(fields=['mailing', 'status'], name='message_mailing_status_idx'),
+            # поиск брошенных сообщений в работе по времени захвата (sweeper.reap_stale)
+            models.Index(fields=['claimed_at'], name='message_active_claimed_idx', condition=models.Q(status='active')),
+        ]
+
+
+class AudienceBlock(models.Model):
+    """
+    Блок замороженного снимка аудитории большой рассылки: отсортированные id клиентов, упакованные диапазонами
+    (см. ./snapshot.py). Сообщения получателей блока создаются только тогда, когда до них доходит диспетчер, после
+    чего блок удаляется.
+    """
+
+    mailing = models.ForeignKey('Mailing', related_name='audience_blocks', on_delete=models.CASCADE,
+                                verbose_name='id рассылки')
+    clients = models.BinaryField(verbose_name='Упакованные id клиентов')
+    count = models.PositiveIntegerField(verbose_name='Количество получателей')
+
+    def __str__(self):
+        return "mailing: {}, recipients: {}".format(self.mailing_id, self.count)
+
+    class Meta:
+        verbose_name = 'Блок снимка аудитории'
+        verbose_name_plural = 'Снимки аудитории'
+
+
+class MailingJob(models.Model):
+    """
+    Фоновое создание аудитории рассылки (см. ./jobs.py): клиенты выборки рассылки обрабатываются пачками по
+    возрастанию id, позиция (cursor) и прогресс сохраняются в одной транзакции с каждой пачкой сообщений.
+    """
+
+    STATUS = (('pending', 'в очереди'), ('running', 'выполняется'), ('done', 'выполнено'),
+              ('cancelled', 'рассылка отменена'), ('failed', 'ошибка'))
+
+    mailing = models.ForeignKey('Mailing', related_name='jobs', on_delete=models.CASCADE, verbose_name='id рассылки')
+    # ключ идемпотентности запроса создания рассылки (заголовок Idempotency-Key) и отпечаток данных запроса
+    key = models.CharField(max_length=255, unique=True, null=True, blank=True, verbose_name='Ключ идемпотентности')
+    fingerprint = models.CharField(max_length=64, blank=True, default='', verbose_name='Отпечаток запроса')
+    status = models.CharField(max_length=20, choices=STATUS, default='pending', verbose_name='Статус')
+    method = models.CharField(max_length=20, blank=True, default='', verbose_name='Способ создания сообщений')
+    total = models.BigIntegerField(null=True, blank=True, verbose_name='Получателей в выборке')
+    done = models.BigIntegerField(default=0, verbose_name='Обработано получателей')
+    # id последнего обработанного клиента выборки
+    cursor = models.BigIntegerField(default=0, verbose_name='Позиция')
+    error = models.TextField(blank=True, default='', verbose_name='Ошибка')
+    # неудачные попытки задания: после jobs.ATTEMPTS ошибок задание получает статус 'failed'
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name='Неудачных попыток')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Время создания')
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name='Время начала')
+    updated_at = models.DateTimeField(null=True, blank=True, verbose_name='Время последней пачки')
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name='Время окончания')
+
+    def __str__(self):
+        return "job: {}, mailing: {}, {}: {}/{}".format(self.pk, self.mailing_id, self.status, self.done, self.total)
+
+    class Meta:
+        verbose_name = 'Создание аудитории рассылки'
+        verbose_name_plural = 'Создание аудиторий рассылок'
+
+
+class MailingStat(models.Model):
+    """
+    Счетчик сообщений рассылки в одном статусе. Обновляется в той же транзакции, что и статусы сообщений
+    (см. ./counters.py), поэтому статистика рассылки читается без подсчета строк Message.
+    """
+
+    mailing = models.ForeignKey('Mailing', related_name='stats', on_delete=models.CASCADE, verbose_name='id рассылки')
+    status = models.CharField(max_length=20, choices=Message.STATUS, verbose_name='Статус отправки')
+    count = models.BigIntegerField(default=0, verbose_name='Количество сообщений')
+
+    def __str__(self):
+        return "mailing: {}, {}: {}".format(self.mailing_id, self.status, self.count)
+
+    class Meta:
+        verbose_name = 'Счетчик сообщений рассылки'
+        verbose_name_plural = 'Счетчики сообщений рассылок'
+        unique_together = ('mailing', 'status')
+
+
+class RateLimit(models.Model):
+    """
+    Общий для всех воркеров лимит скорости отправки сообщений на принимающий сервер: token bucket (см. ./ratelimit.py)
+    """
+
+    name = models.CharField(max_length=50, primary_key=True, verbose_name='Имя лимита')
+    rate = models.FloatField(verbose_name='Скорость, сообщений в секунду')
+    tokens = models.FloatField(verbose_name='Доступно токенов')
+    updated_at = models.DateTimeField(verbose_name='Время последнего пополнения')
+    # circuit breaker: доля ошибок сервера в текущем окне и время, до которого отправка приостановлена
+    window_started_at = models.DateTimeField(null=True, blank=True, verbose_name='Начало окна подсчета ошибок')
+    window_requests = models.PositiveIntegerField(default=0, verbose_name='Запросов в окне')
+    window_errors = models.PositiveIntegerField(default=0, verbose_name='Ошибок в окне')
+    open_until = models.DateTimeField(null=True, blank=True, verbose_name='Отправка приостановлена до')
+
+    def __str__(self):
+        return "{}: {:.1f} msg/sec".format(self.name, self.rate)
+
+    class Meta:
+        verbose_name = 'Лимит скорости отправки'
+        verbose_name_plural = 'Лимиты скорости отправки'
+
+
+class Dispatcher(models.Model):
+    """
+    Живой процесс диспетчера (python manage.py run_dispatcher): продлевает свою запись каждый такт, запись с
+    истекшим временем-- упавший диспетчер (см. ./dispatcher.py)
+    """
+
+    name = models.CharField(max_length=100, primary_key=True, verbose_name='Имя диспетчера')
+    expires_at = models.DateTimeField(verbose_name='Активен до')
+
+    def __str__(self):
+        return "{}: {}".format(self.name, self.expires_at)
+
+    class Meta:
+        verbose_name = 'Диспетчер'
+        verbose_name_plural = 'Диспетчеры'
+
+
+class ShardLease(models.Model):
+    """
+    Аренда шарда сообщений диспетчером: шард-- сообщения с id % количество шардов == shard. Аренда ограничена
+    по времени, шард упавшего диспетчера забирает другой диспетчер после окончания аренды.
+    """
+
+    shard = models.PositiveIntegerField(primary_key=True, verbose_name='Номер шарда')
+    owner = models.CharField(max_length=100, blank=True, default='', verbose_name='Диспетчер')
+    expires_at = models.DateTimeField(null=True, blank=True, verbose_name='Аренда до')
+
+    def __str__(self):
+        return "shard {}: {} until {}".format(self.shard, self.owner, self.expires_at)
+
+    class Meta:
+        verbose_name = 'Аренда шарда'
+        verbose_name_plural = 'Аренды шардов'
+
+
+class DeliveryLog(models.Model):
+    """
+    Журнал попыток отправки сообщений: одна короткая строка на попытку, только добавление, записывается пачками
+    (см. ./writeback.py) вместо результата Celery таска на каждое сообщение. Старые записи удаляются командой
+    python manage.py rotate_delivery_log.
+    """
+
+    message_id = models.BigIntegerField(verbose_name='id сообщения')
+    mailing_id = models.BigIntegerField(verbose_name='id рассылки')
+    status = models.CharField(max_length=20, choices=Message.STATUS, verbose_name='Статус после попытки')
+    code = models.PositiveSmallIntegerField(null=True, blank=True, verbose_name='Код ответа сервера')
+    latency = models.FloatField(null=True, blank=True, verbose_name='Время ответа сервера, сек')
+    attempt = models.PositiveSmallIntegerField(default=0, verbose_name='Номер попытки')
+    created_at = models.DateTimeField(verbose_name='Время попытки')
+
+    def __str__(self):
+        return "message: {}, {}: {}".format(self.message_id, self.status, self.code)
+
+    class Meta:
+        verbose_name = 'Запись журнала отправки'
+        verbose_name_plural = 'Журнал отправки'
+        indexes = [
+            # история отправки сообщения и рассылки (аудит), удаление старых записей (ротация)
+            models.Index(fields=['message_id'], name='deliverylog_message_idx'),
+            models.Index(fields=['mailing_id', 'created_at'], name='deliverylog_mailing_idx'),
+            models.Index(fields=['created_at'], name='deliverylog_created_idx'),
+        ]
+
+
+class Metric(models.Model):
+    """
+    Серия метрики Prometheus (счетчик или корзина гистограммы), общая для всех процессов: процессы копят изменения
+    в памяти и прибавляют их к значению серии пачками (см. ./metrics.py), эндпоинт /metrics читает таблицу целиком.
+    """
+
+    name = models.CharField(max_length=100, verbose_name='Имя серии')
+    labels = models.CharField(max_length=200, blank=True, verbose_name='Метки серии')
+    value = models.FloatField(default=0, verbose_name='Значение')
+
+    def __str__(self):
+        return "{}{{{}}}: {}".format(self.name, self.labels, self.value)
+
+    class Meta:
+        verbose_name = 'Метрика'
+        verbose_name_plural = 'Метрики'
+        unique_together = ('name', 'labels')
@@ -0,0 +1,47 @@
+from django.db.models import Sum
+
+from project.settings import CELERY_SETTINGS_FBRQ
+from .models import MailingStat
+
+# Очередность отправки рассылок (earliest deadline first): диспетчер захватывает сообщения рассылок по возрастанию
+# времени окончания, каждой рассылке-- равная доля порции захвата, поэтому большая рассылка не занимает всю порцию.
+# Пачки срочных рассылок (до окончания осталось не больше PRIORITY['urgent'] сек) идут в отдельную очередь брокера
+# и не ждут за пачками больших рассылок, которые уже стоят в общей очереди. Пока в работе много сообщений, несрочные
+# сообщения не захватываются, чтобы общая очередь не разрасталась на весь объем большой рассылки.
+
+# настройки очередности: порог срочности (сек), очереди срочных и остальных пачек, предел сообщений в работе
+PRIORITY = CELERY_SETTINGS_FBRQ['priority']
+
+
+def due_mailings(now, mailing_id=None):
+    """
+    Начавшиеся, незакончившиеся и не приостановленные рассылки с неотправленными сообщениями (счетчик 'new', в том
+    числе получатели снимков аудитории) по возрастанию времени окончания. Возвращает список (id рассылки, время
+    окончания). mailing_id-- только эта рассылка.
+    """
+
+    stats = MailingStat.objects.filter(status='new', count__gt=0, mailing__state='active', mailing__starts_at__lte=now,
+                                       mailing__expired_at__gte=now)
+    if mailing_id is not None:
+        stats = stats.filter(mailing=mailing_id)
+    return list(stats.order_by('mailing__expired_at', 'mailing').values_list('mailing', 'mailing__expired_at'))
+
+
+def is_urgent(expired_at, now):
+    return (expired_at - now).total_seconds() <= PRIORITY['urgent']
+
+
+def queue(expired_at, now):
+    """
+    Очередь брокера для пачки рассылки, которая заканчивается в expired_at
+    """
+
+    return PRIORITY['urgent_queue'] if is_urgent(expired_at, now) else PRIORITY['bulk_queue']
+
+
+def in_flight():
+    """
+    Количество сообщений в работе ('active'): захвачены, но еще не отправлены
+    """
+
+    return MailingStat.objects.filter(status='active').aggregate(active=Sum('count'))['active'] or 0
@@ -0,0 +1,111 @@
+import logging
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from project.settings import CELERY_SETTINGS_FBRQ
+from .models import RateLimit
+
+logger = logging.getLogger(__name__)
+
+# настройки адаптивного лимита скорости и circuit breaker, см. project/settings.py
+RATE_LIMIT = CELERY_SETTINGS_FBRQ['rate_limit']
+BREAKER = CELERY_SETTINGS_FBRQ['circuit_breaker']
+# имя общего лимита для принимающего сервера https://probe.fbrq.cloud
+BUCKET = 'fbrq'
+
+
+class TokenBucket:
+    """
+    Token bucket, общий для всех воркеров: состояние хранится в БД (модель RateLimit), поэтому суммарная скорость
+    отправки всех воркеров не превышает rate сообщений в секунду.
+    Скорость подстраивается под принимающий сервер (AIMD): при ошибках и таймаутах уменьшается в 'decrease' раз,
+    при быстрых ответах без ошибок увеличивается на 'increase' сообщений в секунду.
+    В той же строке БД работает circuit breaker: если доля ошибок сервера за окно 'window' секунд превышает
+    'threshold', вся отправка всех воркеров приостанавливается на 'cooldown' секунд.
+    """
+
+    def __init__(self, name=BUCKET, settings=RATE_LIMIT, breaker=BREAKER):
+        self.name = name
+        self.settings = settings
+        self.breaker = breaker
+
+    def is_open(self):
+        """
+        Отправка приостановлена circuit breaker
+        """
+
+        return RateLimit.objects.filter(pk=self.name, open_until__gt=timezone.now()).exists()
+
+    def _lock(self):
+        """
+        Блокировка строки лимита до конца транзакции. Пустой UPDATE блокирует строку в PostgreSQL и сразу берет
+        блокировку на запись в SQLite, поэтому параллельные воркеры не перезапишут состояние друг друга.
+        """
+
+        if not RateLimit.objects.filter(pk=self.name).update(name=F('name')):
+            RateLimit.objects.get_or_create(pk=self.name, defaults={
+                'rate': self.settings['initial'],
+                'tokens': self.settings['initial'] * self.settings['burst'],
+                'updated_at': timezone.now(),
+            })
+        return RateLimit.objects.get(pk=self.name)
+
+    def acquire(self, tokens):
+        """
+        Взять до tokens токенов (одно сообщение-- один токен).
+        Возвращает (выданное количество токенов, сколько секунд ждать следующего токена, если не выдано ни одного).
+        Если отправка приостановлена circuit breaker, возвращает (0, None).
+        """
+
+        with transaction.atomic():
+            bucket = self._lock()
+            now = timezone.now()
+            if bucket.open_until is not None and bucket.open_until > now:
+                return 0, None
+            elapsed = max((now - bucket.updated_at).total_seconds(), 0)
+            capacity = max(bucket.rate * self.settings['burst'], 1)
+            bucket.tokens = min(capacity, bucket.tokens + bucket.rate * elapsed)
+            granted = min(int(bucket.tokens), tokens)
+            bucket.tokens -= granted
+            bucket.updated_at = now
+            bucket.save()
+        wait = 0 if granted else (1 - bucket.tokens) / bucket.rate
+        return granted, wait
+
+    def feedback(self, sent, errors, latency):
+        """
+        Подстройка скорости по результатам отправки: sent-- количество ответов 200, errors-- количество ошибок и
+        таймаутов, latency-- среднее время ответа сервера в секундах.
+        """
+
+        if not sent and not errors:
+            return None
+        with transaction.atomic():
+            bucket = self._lock()
+            if errors:
+                bucket.rate = max(self.settings['min'], bucket.rate * self.settings['decrease'])
+            elif latency < self.settings['latency']:
+                bucket.rate = min(self.settings['max'], bucket.rate + self.settings['increase'])
+            self._count_errors(bucket, sent, errors)
+            bucket.save(update_fields=['rate', 'window_started_at', 'window_requests', 'window_errors', 'open_until'])
+        return bucket.rate
+
+    def _count_errors(self, bucket, sent, errors):
+        """
+        Circuit breaker: подсчет запросов и ошибок в окне, приостановка отправки при большой доле ошибок
+        """
+
+        now = timezone.now()
+        window = timedelta(seconds=self.breaker['window'])
+        if bucket.window_started_at is None or now - bucket.window_started_at > window:
+            bucket.window_started_at, bucket.window_requests, bucket.window_errors = now, 0, 0
+        bucket.window_requests += sent + errors
+        bucket.window_errors += errors
+        if bucket.window_requests >= self.breaker['min_requests'] and \
+                bucket.window_errors / bucket.window_requests >= self.breaker['threshold']:
+            bucket.open_until = now + timedelta(seconds=self.breaker['cooldown'])
+            bucket.window_started_at, bucket.window_requests, bucket.window_errors = now, 0, 0
+            logger.warning('Circuit breaker %s is open until %s', self.name, bucket.open_until)
@@ -0,0 +1,148 @@
+import heapq
+import logging
+import queue
+
+from django.db.models import Min
+from kombu.exceptions import OperationalError
+from django.utils import timezone
+
+from project.celery import app
+from . import metrics
+from .models import AudienceBlock, Message
+
+logger = logging.getLogger(__name__)
+
+# очередь брокера, через которую views.MailingView сообщает планировщику о новом или измененном расписании рассылки
+SCHEDULE_QUEUE = 'mailing.schedule'
+# максимальное время ожидания (сек) без событий, после которого расписание полностью перечитывается из БД
+MAX_IDLE = 300
+
+
+class DeadlineScheduler:
+    """
+    Планировщик запуска рассылок по времени: min-heap из (время ближайшего неотправленного сообщения, id рассылки).
+    Расписание загружается из БД при старте и обновляется по событиям из очереди SCHEDULE_QUEUE, планировщик
+    просыпается ровно тогда, когда наступает время ближайшей рассылки (или приходит событие), и запускает
+    tasks.send(mailing_id). Celery Beat остается только страховочным периодическим обходом.
+    """
+
+    def __init__(self, dispatch):
+        self.dispatch = dispatch
+        self.heap = list()
+        # актуальное время запуска каждой рассылки: устаревшие записи heap пропускаются, а не удаляются из heap
+        self.planned = dict()
+
+    def push(self, mailing_id, starts_at):
+        if starts_at is None:
+            self.planned.pop(mailing_id, None)
+            return None
+        self.planned[mailing_id] = starts_at
+        heapq.heappush(self.heap, (starts_at, mailing_id))
+
+    def load(self):
+        """
+        Полная загрузка расписания из БД: время ближайшего неотправленного сообщения каждой незакончившейся и
+        не приостановленной рассылки. Рассылка со снимком аудитории (сообщения еще не созданы) запускается в момент
+        начала рассылки.
+        """
+
+        self.heap, self.planned = list(), dict()
+        now = timezone.now()
+        messages = Message.objects.filter(status='new', mailing__expired_at__gt=now, mailing__state='active')
+        planned = dict(messages.order_by().values_list('mailing').annotate(Min('starts_at')))
+        blocks = AudienceBlock.objects.filter(mailing__expired_at__gt=now, mailing__state='active')
+        for mailing_id, starts_at in blocks.order_by().values_list('mailing', 'mailing__starts_at').distinct():
+            planned[mailing_id] = min(planned.get(mailing_id, starts_at), starts_at)
+        for mailing_id, starts_at in planned.items():
+            self.push(mailing_id, starts_at)
+        logger.info('Scheduler loaded %s mailings', len(self.planned))
+
+    def refresh(self, mailing_id, after=None):
+        """
+        Перечитать из БД время ближайшего неотправленного сообщения рассылки. after-- только сообщения позже этого
+        времени (после запуска рассылки: наступившие сообщения уже переданы в tasks.send()).
+        """
+
+        now = timezone.now()
+        messages = Message.objects.filter(mailing=mailing_id, status='new', mailing__expired_at__gt=now,
+                                          mailing__state='active')
+        blocks = AudienceBlock.objects.filter(mailing=mailing_id, mailing__expired_at__gt=now, mailing__state='active')
+        if after is not None:
+            messages = messages.filter(starts_at__gt=after)
+            blocks = blocks.filter(mailing__starts_at__gt=after)
+        starts = [messages.aggregate(starts_at=Min('starts_at'))['starts_at'],
+                  blocks.aggregate(starts_at=Min('mailing__starts_at'))['starts_at']]
+        starts = [starts_at for starts_at in starts if starts_at is not None]
+        self.push(mailing_id, min(starts) if starts else None)
+
+    def due(self, now):
+        """
+        Достать из heap все рассылки, время запуска которых наступило
+        """
+
+        mailings = list()
+        while self.heap and self.heap[0][0] <= now:
+            starts_at, mailing_id = heapq.heappop(self.heap)
+            if self.planned.get(mailing_id) == starts_at:
+                del self.planned[mailing_id]
+                mailings.append(mailing_id)
+        return mailings
+
+    def timeout(self, now):
+        """
+        Сколько секунд спать до ближайшей рассылки
+        """
+
+        while self.heap and self.planned.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return MAX_IDLE
+        return min(max((self.heap[0][0] - now).total_seconds(), 0), MAX_IDLE)
+
+    def tick(self):
+        """
+        Запуск всех наступивших рассылок. Возвращает время сна до следующей рассылки.
+        """
+
+        now = timezone.now()
+        with metrics.span('scheduler_tick'):
+            for mailing_id in self.due(now):
+                logger.info('Scheduler dispatches mailing %s', mailing_id)
+                self.dispatch(mailing_id)
+                self.refresh(mailing_id, after=now)
+        metrics.flush()
+        return self.timeout(timezone.now())
+
+    def run(self, events):
+        """
+        Основной цикл: events-- очередь событий kombu SimpleQueue с сообщениями {'mailing': id рассылки}.
+        """
+
+        self.load()
+        while True:
+            timeout = self.tick()
+            try:
+                event = events.get(block=True, timeout=timeout)
+            except queue.Empty:
+                if timeout >= MAX_IDLE:
+                    self.load()
+                continue
+            self.refresh(event.payload['mailing'])
+            event.ack()
+
+
+def notify(mailing_id):
+    """
+    Сообщить планировщику, что расписание рассылки создано или изменено.
+    Без брокера (task_always_eager) или при его недоступности событие не отправляется: рассылку подберет
+    планировщик при полной перезагрузке расписания либо страховочный обход Celery Beat.
+    """
+
+    if app.conf.task_always_eager:
+        return None
+    try:
+        with app.connection_for_write() as connection:
+            with connection.SimpleQueue(SCHEDULE_QUEUE) as events:
+                events.put({'mailing': mailing_id})
+    except OperationalError as error:
+        logger.warning('Scheduler is not notified about mailing %s: %s', mailing_id, error)
@@ -1,7 +1,9 @@
 from rest_framework import serializers
+from django.core.validators import ValidationError
 from django.utils import timezone
 
-from .models import Client, Mailing, Message
+from .audience import parse
+from .models import Client, Mailing, Message, operator_code
 
 
 class ClientSerializer(serializers.Serializer):
@@ -15,12 +17,19 @@ class ClientSerializer(serializers.Serializer):
     tag = serializers.CharField(max_length=100)
     zone = serializers.CharField(max_length=30)
 
+    def validate_zone(self, value):
+        # часовой пояс нужен для окна доставки рассылок (Mailing.local_starts_at)
+        if value not in dict(Client.TIMEZONES):
+            raise serializers.ValidationError('Unknown time zone, use one of Europe/*, Asia/*, Etc/*.')
+        return value
+
     def create(self, validated_data):
 
         return Client.objects.create(**validated_data)
 
     def update(self, instance, validated_data):
         instance.number = validated_data.get('number', instance.number)
+        instance.code = operator_code(instance.number)
         instance.tag = validated_data.get('tag', instance.tag)
         instance.zone = validated_data.get('zone', instance.zone)
         instance.save()
@@ -38,6 +47,27 @@ class MailingSerializer(serializers.Serializer):
     expired_at = serializers.DateTimeField()
     text = serializers.CharField(max_length=500)
     filter = serializers.CharField(max_length=100)
+    # окно доставки по местному времени клиента: '10:00'-- '20:00'
+    window_start = serializers.TimeField(required=False, allow_null=True)
+    window_end = serializers.TimeField(required=False, allow_null=True)
+    # состояние и поколение расписания рассылки меняются только через паузу, возобновление и отмену
+    state = serializers.CharField(read_only=True)
+    version = serializers.IntegerField(read_only=True)
+
+    def validate_filter(self, value):
+        # проверка синтаксиса фильтра клиентов, см. ./audience.py
+        try:
+            parse(value)
+        except ValidationError as error:
+            raise serializers.ValidationError(error.messages)
+        return value
+
+    def validate(self, data):
+        start = data.get('window_start', getattr(self.instance, 'window_start', None))
+        end = data.get('window_end', getattr(self.instance, 'window_end', None))
+        if (start is None) != (end is None) or (start is not None and start == end):
+            raise serializers.ValidationError('Delivery window needs different window_start and window_end.')
+        return data
 
     def create(self, validated_data):
 
@@ -48,25 +78,13 @@ class MailingSerializer(serializers.Serializer):
         instance.expired_at = validated_data.get('expired_at', instance.expired_at)
         instance.text = validated_data.get('text', instance.text)
         instance.filter = validated_data.get('filter', instance.filter)
+        instance.window_start = validated_data.get('window_start', instance.window_start)
+        instance.window_end = validated_data.get('window_end', instance.window_end)
         instance.save()
 
         return instance
 
 
-class MessagesSerializer(serializers.ModelSerializer):
-
-    client = serializers.SerializerMethodField()
-
-    class Meta:
-        model = Message
-        fields = ['id', 'client', 'status']
-
-    def get_client(self, obj):
-        number = obj.client.number
-
-        return number
-
-
 class StatsMailingSerializer(serializers.ModelSerializer):
     """
     Общая статистика по созданным рассылкам и количеству отправленных сообщений по ним с группировкой по статусам
@@ -88,37 +106,27 @@ class StatsMailingSerializer(serializers.ModelSerializer):
             return obj.text[:50] + '...'
         return obj.text
 
-    # Поля сообщений
+    # Поля сообщений: количество по каждому статусу, посчитанное одним запросом Mailing.objects.with_messages_status()
     def get_messages_status(self, obj):
-        stat = dict()
-        total = obj.messages.count()
-        stat.update({'total': total}) if total > 0 else None
-        new = obj.messages.filter(status='new').count()
-        stat.update({'new': new}) if new > 0 else None
-        sent = obj.messages.filter(status='sent').count()
-        stat.update({'sent': sent}) if sent > 0 else None
-        failure = obj.messages.filter(status='failure').count()
-        stat.update({'failure': failure}) if failure > 0 else None
+        stat = {'total': obj.messages_total}
+        for status, _ in Message.STATUS:
+            stat[status] = getattr(obj, 'messages_' + status)
         return stat
 
 
 class StatsMailingPKSerializer(StatsMailingSerializer):
     """
-    Получение детальной статистики отправленных сообщений по конкретной рассылке
+    Получение детальной статистики отправленных сообщений по конкретной рассылке.
+    Список сообщений рассылки не сериализуется целиком: views.MailingView отдает его потоком, постранично.
     """
 
     text = serializers.CharField()
     tag = serializers.SerializerMethodField()
 
-    messages = MessagesSerializer(many=True, read_only=True)
-
     class Meta:
         model = Mailing
-        fields = ['id', 'text', 'starts_at', 'expired_at', 'tag', 'messages_status', 'messages']
+        fields = ['id', 'text', 'starts_at', 'expired_at', 'state', 'tag', 'messages_status']
 
     def get_tag(self, obj):
-
-        if obj.messages.first() is not None:  # ищем клиентов по тегу либо отдаем None, если клиент не найден
-            tag = obj.messages.first().client.tag
-            return tag
-        return None
\ No newline at end of file
+        # ищем клиентов по тегу одним запросом либо отдаем None, если клиент не найден
+        return obj.messages.order_by('id').values_list('client__tag', flat=True).first()
@@ -0,0 +1,76 @@
+import sys
+import zlib
+from array import array
+
+from django.db import transaction
+
+from project.settings import CELERY_SETTINGS_FBRQ
+from . import counters
+from .models import AudienceBlock
+
+# Замороженный снимок аудитории большой рассылки: вместо строки Message на каждого получателя при создании
+# рассылки сохраняются только отсортированные id клиентов, упакованные диапазонами, блоками по SNAPSHOT['block']
+# получателей. Сообщения создаются из блоков по мере отправки (fanout.materialize()), поэтому рассылка, которую
+# отменили или которая закончилась до начала отправки, не оставляет после себя миллион строк.
+
+# настройки снимка аудитории: включен ли, с какого размера аудитории, получателей в одном блоке
+SNAPSHOT = CELERY_SETTINGS_FBRQ['snapshot']
+
+
+def pack(ids):
+    """
+    Упаковка отсортированных по возрастанию id клиентов: диапазоны подряд идущих id в виде пар (расстояние от конца
+    предыдущего диапазона, длина диапазона), int64 little-endian, сжатие zlib. Сплошная выборка клиентов занимает
+    несколько байт, разреженная-- единицы байт на получателя.
+    """
+
+    runs = array('q')
+    previous, start, length = 0, None, 0
+    for client_id in ids:
+        if length and client_id == start + length:
+            length += 1
+            continue
+        if length:
+            runs.extend((start - previous, length))
+            previous = start + length
+        start, length = client_id, 1
+    if length:
+        runs.extend((start - previous, length))
+    if sys.byteorder == 'big':
+        runs.byteswap()
+    return zlib.compress(runs.tobytes())
+
+
+def unpack(data):
+    """
+    Список id клиентов из упакованного блока (pack())
+    """
+
+    runs = array('q')
+    runs.frombytes(zlib.decompress(data))
+    if sys.byteorder == 'big':
+        runs.byteswap()
+    ids = list()
+    previous = 0
+    for i in range(0, len(runs), 2):
+        start = previous + runs[i]
+        previous = start + runs[i + 1]
+        ids.extend(range(start, previous))
+    return ids
+
+
+def close(blocks, status):
+    """
+    Получатели блоков снимка blocks (QuerySet AudienceBlock), до которых не дошла отправка (рассылку отменили или она
+    закончилась): блоки удаляются, получатели переносятся из счетчика 'new' рассылки в счетчик status.
+    Возвращает количество получателей.
+    """
+
+    moved = list()
+    with transaction.atomic():
+        for block_id, mailing_id, count in blocks.order_by('id').values_list('id', 'mailing', 'count'):
+            # блок, который уже забрал диспетчер (fanout.materialize()), не учитывается
+            if AudienceBlock.objects.filter(pk=block_id).delete()[0]:
+                moved.append((mailing_id, 'new', count))
+        counters.move(moved, status)
+    return sum(count for _, _, count in moved)
@@ -0,0 +1,75 @@
+import json
+from datetime import timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+
+from project.settings import CELERY_SETTINGS_FBRQ
+from . import counters, metrics
+from .models import AudienceBlock, DeliveryLog, Message
+from .snapshot import close
+
+# время аренды (сек): сообщение в статусе 'active' дольше этого времени считается брошенным упавшим воркером
+LEASE = CELERY_SETTINGS_FBRQ.get('lease', 600)
+# записей журнала отправки, удаляемых одной командой при ротации
+ROTATE_BATCH = CELERY_SETTINGS_FBRQ['delivery_log']['batch']
+
+
+def reap_stale(lease=LEASE):
+    """
+    Брошенные сообщения: статус 'active' дольше lease секунд с момента захвата (claimed_at) одной командой
+    возвращаются в статус 'new', чтобы их снова захватил tasks.claim_messages(). Возвращает количество сообщений.
+    """
+
+    stale = Message.objects.filter(status='active', claimed_at__lt=timezone.now() - timedelta(seconds=lease))
+    return counters.update_status(stale, 'new', claimed_at=None)
+
+
+def expire():
+    """
+    Все новые и захваченные сообщения закончившихся рассылок одной командой получают статус 'failure', получатели
+    снимков аудитории, до которых не дошла отправка, учитываются там же без создания сообщений. Так же закрываются
+    сообщения 'new' отмененных рассылок: после отмены в 'new' возвращаются сообщения, отправка которых не удалась
+    (delivery.retry_later()), и сообщения упавшего воркера (reap_stale()). Возвращает количество сообщений.
+    """
+
+    now = timezone.now()
+    expired = Message.objects.filter(Q(status__in=('new', 'active'), mailing__expired_at__lt=now)
+                                     | Q(status='new', mailing__state='cancelled'))
+    failed = counters.update_status(expired, 'failure')
+    return failed + close(AudienceBlock.objects.filter(mailing__expired_at__lt=now), 'failure')
+
+
+def sweep(lease=LEASE):
+    """
+    Периодический обход (tasks.sweep): сначала закрываются закончившиеся рассылки, затем возвращаются в работу
+    брошенные сообщения. Возвращает {'failure': количество сообщений, 'new': количество сообщений}.
+    """
+
+    with metrics.span('sweep'):
+        swept = {'failure': expire(), 'new': reap_stale(lease)}
+    metrics.inc('mailing_messages_expired_total', swept['failure'])
+    return swept
+
+
+def rotate_log(before, archive=None):
+    """
+    Ротация журнала отправки: записи DeliveryLog старше before (datetime) удаляются пачками по ROTATE_BATCH, чтобы
+    не держать долгую блокировку таблицы. archive-- файл (текстовый поток), куда записи предварительно выгружаются
+    в формате NDJSON. Возвращает количество удаленных записей.
+    """
+
+    fields = ('id', 'message_id', 'mailing_id', 'status', 'code', 'latency', 'attempt', 'created_at')
+    old = DeliveryLog.objects.filter(created_at__lt=before).order_by('id')
+    rotated = 0
+    while True:
+        rows = list(old.values_list(*fields)[:ROTATE_BATCH])
+        if not rows:
+            return rotated
+        if archive is not None:
+            for row in rows:
+                entry = dict(zip(fields, row))
+                entry['created_at'] = entry['created_at'].isoformat()
+                archive.write(json.dumps(entry) + '\n')
+        DeliveryLog.objects.filter(pk__in=[row[0] for row in rows]).delete()
+        rotated += len(rows)
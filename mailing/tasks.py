@@ -1,23 +1,33 @@
 import requests
 import json
-from celery import Celery, shared_task, group, current_task
+from celery import shared_task, current_task
+from celery.signals import worker_process_shutdown
+from django.db import connection, transaction
+from django.db.models import F, Q
 from django.utils import timezone
-from time import sleep
+from time import perf_counter, sleep, time
 
 from project.settings import CELERY_SETTINGS_FBRQ
-from .models import Message
-
-# Количество тасков в одном асинхронном запросе (celery.task.group)
-CHUNK = 30
-# время ожидания после старта очередной группы тасков для запуска следующей группы
-SLEEP = 0.1
-# время, в течение которого ожидается прием с сервера
-CONNECT_TIMEOUT = 2
-# время, в течение которого ожидается чтение данных в буфер дескриптора сокета
-READ_TIMEOUT = 2
-
-
-def message_update_state(obj, status):
+from . import counters, jobs, metrics, priority
+from .models import Mailing, Message
+from .fanout import materialize
+from .delivery import (CONNECT_TIMEOUT, READ_TIMEOUT, defer, deliver_batch, load_batch, renew_lease, retry_status,
+                       stale_mailings, window_opens_at)
+from .ratelimit import TokenBucket
+from .scheduler import notify
+from .sweeper import sweep as sweep_messages
+from .writeback import buffer
+
+# Количество сообщений в одном таске send_batch (одна пачка-- один вызов воркера)
+CHUNK = CELERY_SETTINGS_FBRQ.get('chunk', 500)
+# максимальное количество сообщений, забираемых в работу за один захват (claim_messages)
+CLAIM_BATCH = 10_000
+# хранить результаты тасков отправки (send_message, send_batch) в CELERY_RESULT_BACKEND. По умолчанию отключено:
+# результат каждой попытки отправки записывается в компактный журнал mailing.models.DeliveryLog
+STORE_RESULTS = CELERY_SETTINGS_FBRQ.get('store_results', False)
+
+
+def message_update_state(message_id, status, log=()):
     """
     Актуализируем статусы у модели "Сообщение".
     Если сообщение имеет статус 'new' и таск взял в работу это сообщение, меняем статус на 'active'-- в работе.
@@ -26,54 +36,141 @@ def message_update_state(obj, status):
     на "новое" (new), позволяя снова пробовать отправить сообщение либо этим же таском (Task.retry(),
     либо новым таском, который найдет его по этому статусу "new", как еще не отправленное сообщение)
     Ecли Сообщение взято в работу 'active' и его не успели отправить по времени, меняем статус на 'failure'
+    Неудачные попытки отправки учитываются в delivery.retry_later(): повтор позже либо статус 'dead'
     """
-    # смотри .models.Message status field: new, active, sent, failure
+    # смотри .models.Message status field: new, active, sent, failure, dead
+    # Статус попадает в буфер воркера (writeback.StatusBuffer) и записывается в БД вместе со статусами других
+    # сообщений одной командой UPDATE, только если сообщение все еще в работе. log-- записи журнала отправки
 
-    if obj.status != status:
-        obj.status = status
-        obj.save()
-    else:
-        return None
+    buffer.add({status: [message_id]}, log=log)
+
+
+def task_state(state, meta):
+    """
+    Статус таска отправки в CELERY_RESULT_BACKEND, только если результаты тасков отправки хранятся (STORE_RESULTS)
+    """
+
+    if STORE_RESULTS:
+        current_task.update_state(state=state, meta=json.dumps(meta))
+
+
+def claim_messages(mailing_id=None, limit=CLAIM_BATCH, shards=None):
+    """
+    Атомарный захват сообщений для отправки: не более limit новых ('new') сообщений, время отправки (и время
+    повторной попытки) которых наступило, а рассылка еще не закончилась и не приостановлена, одной командой
+    переводятся в статус 'active'.
+    Пока circuit breaker приостановил отправку (ratelimit.TokenBucket), сообщения не захватываются.
+    Возвращает только id захваченных сообщений по возрастанию. Время захвата (claimed_at)-- начало аренды
+    сообщения, см. sweeper.
+    PostgreSQL: UPDATE ... WHERE id IN (SELECT ... FOR UPDATE SKIP LOCKED) RETURNING id-- несколько диспетчеров
+    параллельно забирают разные сообщения, не дожидаясь друг друга и не отправляя одно сообщение дважды.
+    SQLite: UPDATE ... RETURNING id (SQLite >= 3.35), запись в SQLite и так выполняется строго по очереди.
+    Остальные бэкенды: select_for_update() и UPDATE по найденным id внутри одной транзакции.
+    Счетчики сообщений рассылок (MailingStat) обновляются в той же транзакции.
+    shards-- (свои шарды, всего шардов): только сообщения с id % всего шардов из своих шардов (./dispatcher.py).
+    """
+
+    if TokenBucket().is_open():
+        return list()
+
+    now = timezone.now()
+    due = Message.objects.filter(status='new', starts_at__lte=now, mailing__expired_at__gte=now,
+                                 mailing__state='active')
+    due = due.filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now))
+    if mailing_id is not None:
+        due = due.filter(mailing=mailing_id)
+    if shards is not None:
+        owned, total = shards
+        due = due.annotate(shard=F('id') % total).filter(shard__in=owned)
+    due = due.order_by('id')
+
+    with metrics.span('claim'), transaction.atomic():
+        if connection.vendor == 'postgresql':
+            due = due.select_for_update(skip_locked=True, of=('self',))
+            claimed = _update_returning(due, limit, now)
+        elif connection.vendor == 'sqlite' and connection.Database.sqlite_version_info >= (3, 35):
+            claimed = _update_returning(due, limit, now)
+        else:
+            # простой вариант без UPDATE ... RETURNING
+            if connection.features.has_select_for_update_skip_locked:
+                due = due.select_for_update(skip_locked=True, of=('self',))
+            elif connection.features.has_select_for_update:
+                due = due.select_for_update()
+            claimed = list(due.values_list('id', 'mailing')[:limit])
+            Message.objects.filter(pk__in=[message_id for message_id, _ in claimed]).update(status='active',
+                                                                                            claimed_at=now)
+
+        per_mailing = dict()
+        for _, message_mailing in claimed:
+            per_mailing[message_mailing] = per_mailing.get(message_mailing, 0) + 1
+        counters.move([(message_mailing, 'new', count) for message_mailing, count in per_mailing.items()], 'active')
+    metrics.inc('mailing_messages_claimed_total', len(claimed))
+    # RETURNING не гарантирует порядок строк: пачки (batch_signature) режутся из отсортированных id
+    return sorted(message_id for message_id, _ in claimed)
+
+
+def _update_returning(due, limit, now):
+    """
+    UPDATE mailing_message SET status = 'active', claimed_at = now WHERE id IN (выборка due) RETURNING id, mailing_id
+    """
 
+    qn = connection.ops.quote_name
+    query, params = due.values('id')[:limit].query.sql_with_params()
+    sql = 'UPDATE {table} SET {status} = %s, {claimed_at} = %s WHERE {id} IN ({query}) RETURNING {id}, {mailing}'
+    sql = sql.format(
+        table=qn(Message._meta.db_table), status=qn('status'), claimed_at=qn('claimed_at'), id=qn('id'), query=query,
+        mailing=qn(Message._meta.get_field('mailing').column))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, ('active', connection.ops.adapt_datetimefield_value(now), *params))
+        return [(row[0], row[1]) for row in cursor.fetchall()]
 
-app = Celery('tasks')
 
 # подгружаем настройки запроса, чтобы сервер https://probe.fbrq.cloud точно принял данные
 URL = CELERY_SETTINGS_FBRQ['url']
 HEADERS = CELERY_SETTINGS_FBRQ['headers']
 
 
-# экземпляр таска self.retry() некорректно работает в celery==5.2.0- 5.2.3
-# Поэтому views.django_rest_framework_func() --> tasks.task.retry(eta=start_time, expires=expire_time) не работает!
-# Пришлось делать через celery beat: views.django_rest_framework_func() --> tasks.task(run_every=timedelta(seconds=60))
-# см project.settings.py
-# загружаем из mailing.tasks, а не из корневого каталога celery.py, поэтому @app.on_after_configure.connect не работает!
-@app.on_after_finalize.connect
-def setup_periodic_tasks(sender, **kwargs):
-    sender.add_periodic_task(10.0, send.s(), name='send')
+# Рассылки запускает планировщик mailing.scheduler.DeadlineScheduler (python manage.py run_scheduler) ровно во время
+# начала рассылки. Celery Beat запускает send() только как страховочный обход, см. CELERY_BEAT_SCHEDULE в
+# project/settings.py
 
 
-@shared_task(name='send_message')
-def send_message(message_id):
+@shared_task(name='send_message', ignore_result=not STORE_RESULTS)
+def send_message(message_id, batch=None):
     """
     Основной таск для отправки данных на сервер https://probe.fbrq.cloud
+    batch-- готовые данные сообщения (delivery.load_batch()), тогда БД нужна только для записи статуса.
     """
 
-    message = Message.objects.get(pk=message_id)
+    if batch is None:
+        # Проверка статуса. Если не active, значит это сообщение либо пришло не из основного таска (неизвестная
+        # валидация), либо происходит дублирование этого сообщения в другом таске. Исключаем эти ситуации.
+        batch = load_batch(Message.objects.filter(pk=message_id, status='active'))
+        if not batch['messages']:
+            return 'Failed send message with not active status.', {'message id': message_id}
+        stale = set()
+    else:
+        stale = stale_mailings(batch)
+    lost = renew_lease(batch, stale)
+    if stale:
+        # пока таск ждал в очереди, расписание рассылки изменили, рассылку приостановили или отменили
+        metrics.inc('mailing_messages_stale_total')
+        return 'Dropped. Mailing has been rescheduled, paused or cancelled.', {'message id': message_id}
+    if lost:
+        # пока таск ждал в очереди, аренда сообщения закончилась и sweeper вернул его в работу
+        metrics.inc('mailing_messages_stale_total')
+        return 'Dropped. Message lease has expired.', {'message id': message_id}
+    message_id, number, starts_at, attempts, mailing_id, *client = batch['messages'][0]
+    text, expired_at = batch['mailings'][str(mailing_id)][:2]
 
     # дополнительная информация, лог выполнения Celery
     meta = {
-        'mailing id': message.mailing.pk,
+        'mailing id': mailing_id,
         'message id': message_id,
-        'number': message.client.number,
+        'number': number,
     }
 
-    # Проверка статуса. Если не active, значит это сообщение либо пришло не из основного таска (неизвестная валидация),
-    # либо происходит дублирование этого сообщения в другом таске. Исключаем эти ситуации.
-    if message.status != 'active':
-        return 'Failed send message with not active status.', meta
-
-    current_task.update_state(state='PROGRESS', meta=json.dumps(meta))  # меняем статус у таска на "в работе"
+    task_state('PROGRESS', meta)  # меняем статус у таска на "в работе"
 
     # спецификация url принимающего сервера:
     url = URL + str(message_id)
@@ -81,42 +178,154 @@ def send_message(message_id):
     # спецификация json принимающего сервера
     data = {
         'id': message_id,
-        'phone': message.client.number,
-        'text': message.mailing.text,
+        'phone': number,
+        'text': text,
     }
 
     # настройка, если принимающий сервер подтупливает, либо трафик идет через vpn
     connect_timeout, read_timeout = CONNECT_TIMEOUT, READ_TIMEOUT
 
     # проверяем актуальное время, чтобы успеть отработать до окончания рассылки
-    now = timezone.now()
-    if message.starts_at <= now < message.mailing.expired_at:
-        response = requests.post(url=url,
-                                 data=json.dumps(data),
-                                 headers=HEADERS,
-                                 verify=True,
-                                 timeout=(connect_timeout, read_timeout),
-                                 )
-        status = response.status_code
+    now = timezone.now().timestamp()
+    opens_at = window_opens_at(batch['mailings'][str(mailing_id)], client[0] if client else None, now)
+    if starts_at <= now and opens_at is not None and opens_at < expired_at:
+        # окно доставки клиента закончилось: отправка в начале следующего окна, попытка не засчитывается
+        defer({opens_at: [message_id]})
+        metrics.inc('mailing_messages_deferred_total')
+        return 'Deferred. Delivery window of client is over. ', meta
+    if starts_at <= now < expired_at and opens_at is None:
+        # ждем токен общего для всех воркеров лимита скорости отправки
+        limiter = TokenBucket()
+        granted, wait = limiter.acquire(1)
+        while not granted and wait is not None:
+            sleep(wait)
+            granted, wait = limiter.acquire(1)
+        if not granted:
+            # circuit breaker приостановил отправку, попытка не засчитывается
+            message_update_state(message_id, status='new')
+            return 'Failure. Sending is paused by circuit breaker. ', meta
+
+        started = perf_counter()
+        status = None
+        try:
+            response = requests.post(url=url,
+                                     data=json.dumps(data),
+                                     headers=HEADERS,
+                                     verify=True,
+                                     timeout=(connect_timeout, read_timeout),
+                                     )
+            status = response.status_code
+        except requests.RequestException:
+            pass
+        latency = perf_counter() - started
+        limiter.feedback(int(status == 200), int(status != 200), latency)
+        metrics.observe('mailing_http_latency_seconds', [latency])
+        metrics.inc('mailing_messages_delivered_total' if status == 200 else 'mailing_messages_failed_total')
+        metrics.flush(interval=metrics.METRICS['interval'])
 
         if status == 200:
             # сервер вернул "хорошие" данные
-            message_update_state(message, status='sent')  # меняем статус у модели "Сообщение" на "исполнено"
-            current_task.update_state(state='SUCCESS', meta=json.dumps(meta))  # меняем статус у таска на "исполнено"
+            log = [(message_id, mailing_id, 'sent', status, latency, attempts + 1, time())]
+            message_update_state(message_id, status='sent', log=log)  # меняем статус у модели "Сообщение"
+            task_state('SUCCESS', meta)  # меняем статус у таска на "исполнено"
             return 'Success. Message has been sent. ', meta  # возвращаем ответ от сервера: статус, отправленное сообщение
         else:
-            # сервер не смог принять данные
-            message_update_state(message, status='new')  # меняем статус у сообщения, снова возвращаем в работу
-            current_task.update_state(state='FAILURE', meta=json.dumps(meta))  # меняем статус на "неудачное исполнение"
+            # сервер не смог принять данные: повтор с задержкой либо 'dead' после последней попытки
+            log = [(message_id, mailing_id, retry_status(attempts), status, latency, attempts + 1, time())]
+            buffer.add({}, [(message_id, attempts)], log)
+            task_state('FAILURE', meta)  # меняем статус на "неудачное исполнение"
             # возвращаем общую информацию о неудачной попытке передачи сообщения
             return 'Failure. Server not asked in time. ', meta
     else:
         # не успели отправить сообщение вовремя
-        message_update_state(message, status='failure')  # неудачное исполнение по времени
-        current_task.update_state(state='FAILURE', meta=json.dumps(meta))  # неудачное исполнение по времени
+        log = [(message_id, mailing_id, 'failure', None, None, attempts, time())]
+        message_update_state(message_id, status='failure', log=log)  # неудачное исполнение по времени
+        metrics.inc('mailing_messages_expired_total')
+        task_state('FAILURE', meta)  # неудачное исполнение по времени
         return 'Failure. Expired time is more than now. ', meta
 
 
+@shared_task(name='send_batch', ignore_result=not STORE_RESULTS)
+def send_batch(message_ids=None, id_range=None, batch=None):
+    """
+    Отправка пачки сообщений на сервер https://probe.fbrq.cloud одним таском: вместо таска send_message на каждое
+    сообщение один воркер отправляет всю пачку через mailing.delivery.deliver_batch().
+    batch-- готовые данные сообщений пачки (delivery.load_batch()), воркер не читает сообщения из БД.
+    Для совместимости пачку можно задать message_ids-- списком id сообщений, либо id_range-- [первый id, последний id].
+    Возвращает сводку результатов отправки по статусам сообщений.
+    """
+
+    outcome = deliver_batch(message_ids=message_ids, id_range=id_range, batch=batch, buffer=buffer)
+    metrics.flush()
+    return {status: len(ids) for status, ids in outcome.items()}
+
+
+def batch_signature(ids):
+    """
+    Таск send_batch для пачки захваченных id: номера клиентов, время отправки, тексты и поколения расписания рассылок
+    загружаются одним запросом (подряд идущие id-- по диапазону) и передаются брокеру вместе с таском. Сообщения,
+    которые после захвата успели перепланировать, приостановить или отменить (уже не 'active'), в пачку не попадают.
+    """
+
+    ids = sorted(set(ids))
+    if ids[-1] - ids[0] + 1 == len(ids):
+        messages = Message.objects.filter(pk__range=(ids[0], ids[-1]), status='active')
+    else:
+        messages = Message.objects.filter(pk__in=ids, status='active')
+    return send_batch.s(batch=load_batch(messages))
+
+
+def dispatch(mailing_id=None, shards=None):
+    """
+    Один проход диспетчера по рассылкам в порядке возрастания времени окончания (./priority.py): для каждой рассылки
+    сообщения получателей из снимков аудитории создаются в пределах доли рассылки (fanout.materialize()), затем
+    захватываются сообщения (claim_messages), и их пачки ставятся тасками send_batch в очередь срочных или остальных
+    пачек. Порция захвата (CLAIM_BATCH) делится между рассылками поровну, недобранная рассылкой доля переходит
+    следующим, а остаток порции после прохода-- новым кругом рассылкам, которые забрали всю свою долю. Поэтому
+    порция не набрана, только если сообщений для захвата больше нет. Пока в работе не меньше PRIORITY['in_flight']
+    сообщений, захватываются только срочные рассылки.
+    mailing_id-- только сообщения одной рассылки, shards-- (свои шарды, всего шардов) диспетчера (./dispatcher.py).
+    Возвращает (количество созданных из снимков сообщений, количество захваченных сообщений, список AsyncResult
+    тасков send_batch).
+    """
+
+    now = timezone.now()
+    mailings = priority.due_mailings(now, mailing_id)
+    if mailings and priority.in_flight() >= priority.PRIORITY['in_flight']:
+        mailings = [(mailing, expired_at) for mailing, expired_at in mailings if priority.is_urgent(expired_at, now)]
+
+    materialized, claimed, results = 0, 0, list()
+    while mailings and claimed < CLAIM_BATCH:
+        # рассылки, которые забрали всю свою долю: у них могут остаться сообщения для следующего круга
+        filled = list()
+        for i, (mailing, expired_at) in enumerate(mailings):
+            share = max((CLAIM_BATCH - claimed) // (len(mailings) - i), 1)
+            materialized += materialize(mailing, limit=share, shards=shards)
+            ids = claim_messages(mailing, limit=share, shards=shards)
+            claimed += len(ids)
+            if len(ids) == share:
+                filled.append((mailing, expired_at))
+
+            # Все сообщения разбиваем на пачки по CHUNK сообщений: одна пачка-- один таск send_batch.
+            # Скорость отправки на принимающий сервер ограничивает общий лимит воркеров (ratelimit.TokenBucket)
+            batch_queue = priority.queue(expired_at, now)
+            results += [batch_signature(ids[j:j + CHUNK]).apply_async(queue=batch_queue)
+                        for j in range(0, len(ids), CHUNK)]
+            metrics.inc('mailing_batches_queued_total', len(ids[::CHUNK]), queue=batch_queue)
+        mailings = filled
+    return materialized, claimed, results
+
+
+def dispatch_shards(shards):
+    """
+    Проход шардированного диспетчера (dispatcher.ShardedDispatcher): возвращает количество созданных и захваченных
+    сообщений, 0-- работы нет.
+    """
+
+    materialized, claimed, _ = dispatch(shards=shards)
+    return materialized + claimed
+
+
 @shared_task(name='send')
 def send(mailing_id=None):
     """
@@ -126,63 +335,122 @@ def send(mailing_id=None):
 
     # отправить все новые сообщения с подходящим временным диапазоном
 
-    # приходит id рассылки mailing_id из .views.py
-    # отправить сейчас, время уже проверено в .views.py
-    if mailing_id is not None:
-        messages = Message.objects.filter(mailing=mailing_id)
-    # Получаем управление из celery_beat.
-    # Находим все сообщения (не отправленные, но которые нужно отправить), собираем их на отправку в tasks
-    else:
-        messages = Message.objects.filter(status='new',
-                                          starts_at__lte=timezone.now(),
-                                          mailing__expired_at__gte=timezone.now(),
-                                          )
+    # приходит id рассылки mailing_id из .views.py, иначе получаем управление из celery_beat.
+    # Забираем сообщения в работу ограниченными порциями (claim_messages): новые сообщения переводятся в статус
+    # 'active' одной командой, чтобы другие диспетчеры не забрали эти же сообщения. Данные сообщений каждой пачки
+    # загружаются одним запросом и уходят в таск, воркер обращается к БД только для записи статусов.
+    # Сообщения получателей из снимков аудитории больших рассылок создаются здесь же, блоками перед каждым захватом
+    # (fanout.materialize()), пока снимок не закончится.
+    # Рассылки обходятся по возрастанию времени окончания, пачки срочных рассылок идут в отдельную очередь. Когда в
+    # работе много сообщений, цикл останавливается, оставшиеся сообщения несрочных рассылок забирают следующие обходы
+    # (./priority.py).
+    # Несколько параллельных диспетчеров, которые делят сообщения по шардам, запускаются отдельно:
+    # python manage.py run_dispatcher (./dispatcher.py)
+    all_messages = 0
+    results = list()
+    # обход Celery Beat (без mailing_id) и запуск одной рассылки-- разные этапы в метриках
+    with metrics.span('dispatch' if mailing_id is not None else 'beat_tick', mailing=mailing_id):
+        while True:
+            materialized, claimed, batches = dispatch(mailing_id)
+            all_messages += claimed
+            results += batches
+            # порция не набрана: ни одна рассылка не забрала всю свою долю, захватывать больше нечего
+            if claimed < CLAIM_BATCH and not materialized:
+                break
+    metrics.flush()
+
     # Сообщения, которые нужно отправить, нет. Отдыхаем..
-    if len(messages) == 0:
+    if all_messages == 0:
         return 'Im not busy =)'
 
-    # Сообщения для отправки найдены. Отправляем!
-
-    # Забираем сообщения в работу, чтобы другие какие- либо таски не забрали эти сообщения, помеченные как 'new'
-    # Меняем на статус в работе: 'active'
-    for m in messages:
-        message_update_state(m, status='active')
-
-    # Все сообщения разбиваем на группы по кусочкам, равным CHUNK для того, чтобы принимающий сервер не принимал за DDOS
-
-    # id объектов Message() легче, чем сами объекты, поэтому дальше работаем только с id
-    # ids-- временное хранилище id сообщение
-    ids = list()
-    # group_ids-- полный список групп id
-    group_ids = list()
-    all_messages = len(messages)
-    for message in messages:
-        if len(ids) == CHUNK - 1:
-            ids.append(message.pk)
-            group_ids.append(tuple(ids))
-            ids.clear()
-        else:
-            ids.append(message.pk)
-    group_ids.append(tuple(ids))
-
-    # Каждую группу отправляем с небольшой задержкой SLEEP
-    results = list()
-    for ids in group_ids:
-        group_tasks = group(send_message.s(message_id) for message_id in ids)
-        result = group_tasks.delay()
-        results.append(result.save())
-        sleep(SLEEP)
-
     # Результаты групповой отправки
     str_mailing_id = ''
     if mailing_id is not None:
         str_mailing_id = 'Mailing id: {} \n'.format(str(mailing_id))
-    total = '\nTotal: \n{} sent messages, \n{} group tasks. \n'.format(all_messages, len(results))
+    total = '\nTotal: \n{} sent messages, \n{} batch tasks. \n'.format(all_messages, len(results))
     total += str_mailing_id
-    result = total + ' group task id.\n'.join(map(lambda x: x.id, results))
+    result = total + ' batch task id.\n'.join(map(lambda x: x.id, results))
     return result
 
 
+def start(mailing):
+    """
+    Запуск рассылки: если время начала наступило, а время окончания еще нет, сообщения сразу захватываются таском
+    send(), если рассылка начнется позже-- планировщик (./scheduler.py) узнает о ее расписании.
+    Приостановленные и отмененные рассылки не отправляются.
+    """
+
+    if mailing.state != 'active':
+        return None
+    now = timezone.now()
+    if mailing.starts_at <= now < mailing.expired_at:
+        send.delay(mailing.pk)
+    elif now < mailing.starts_at:
+        # отправить позже: планировщик проснется ко времени начала рассылки
+        notify(mailing.pk)
+
+
+@shared_task(name='build_audience', bind=True, max_retries=None)
+def build_audience(self, job_id):
+    """
+    Фоновое создание аудитории рассылки (задание MailingJob, ./jobs.py) пачками клиентов. Рассылка запускается после
+    первой пачки, не дожидаясь всей аудитории, и еще раз после последней.
+    После ошибки (например, БД недоступна) таск повторяется через jobs.RETRY_DELAY секунд с места остановки, задание
+    получает статус 'failed' только после jobs.ATTEMPTS ошибок. Если повтор потерялся, задание продолжит tasks.sweep.
+    Возвращает {'job': id задания, 'processed': количество обработанных клиентов}.
+    """
+
+    processed = 0
+    try:
+        while True:
+            rows = jobs.step(job_id)
+            if not rows:
+                break
+            if not processed:
+                _start(job_id)
+            processed += rows
+    except Exception as error:
+        if jobs.fail(job_id, repr(error)):
+            raise
+        raise self.retry(exc=error, countdown=jobs.RETRY_DELAY)
+    finally:
+        metrics.flush()
+    _start(job_id)
+    return {'job': job_id, 'processed': processed}
+
+
+def _start(job_id):
+    mailing = Mailing.objects.filter(jobs=job_id).first()
+    if mailing is not None:
+        start(mailing)
+
+
+@worker_process_shutdown.connect
+def flush_statuses(**kwargs):
+    """
+    Запись накопленных статусов сообщений при штатной остановке процесса воркера
+    """
+
+    buffer.flush()
+
+
+@shared_task(name='sweep')
+def sweep():
+    """
+    Периодический обход сообщений (Celery Beat, см. CELERY_BEAT_SCHEDULE): сообщения закончившихся рассылок
+    получают статус 'failure', брошенные упавшими воркерами сообщения в статусе 'active' возвращаются в 'new',
+    брошенные задания создания аудитории (./jobs.py) запускаются снова.
+    """
+
+    swept = sweep_messages()
+    # задания создания аудитории, брошенные упавшими воркерами, продолжаются с места остановки
+    swept['jobs'] = jobs.stale()
+    for job_id in swept['jobs']:
+        build_audience.delay(job_id)
+    metrics.flush()
+    return swept
+
+
 @shared_task
 def dummy():
     """
@@ -1,3 +1,943 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import re
+import signal
+import tempfile
+import threading
+from datetime import time, timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import pytz
+from celery.signals import worker_process_shutdown
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import counters, fanout, jobs, metrics, tasks
+from .audience import parse
+from .benchmark import StubServer
+from .delivery import RETRY, deliver_batch, load_batch, post_messages, renew_lease, write_log, write_outcome
+from .dispatcher import ShardedDispatcher
+from .fanout import materialize
+from .lifecycle import cancel
+from .sweeper import LEASE, expire, reap_stale, rotate_log
+from .models import (AudienceBlock, Client, DeliveryLog, Dispatcher, Mailing, MailingJob, MailingStat, Message,
+                     Metric, RateLimit, ShardLease, window_starts_at)
+from .ratelimit import TokenBucket
+from .scheduler import MAX_IDLE, DeadlineScheduler
+from .snapshot import SNAPSHOT, close, pack, unpack
+from .tasks import dispatch, send
+from .writeback import StatusBuffer
+
+# признаки полного просмотра таблицы в плане запроса (EXPLAIN)
+FULL_SCAN = {
+    'sqlite': re.compile(r'\bSCAN\b'),
+    'postgresql': re.compile(r'\bSeq Scan\b'),
+}
+
+
+def create_clients(count, **fields):
+    """
+    count клиентов с номерами подряд, по умолчанию с кодом оператора 916 и тегом 'tag'
+    """
+
+    fields = dict({'code': 916, 'tag': 'tag'}, **fields)
+    Client.objects.bulk_create([Client(number=79160000000 + i, **fields) for i in range(count)])
+
+
+def create_mailing(audience=True, **fields):
+    """
+    Начавшаяся рассылка по тегу 'tag' на час. audience-- сразу создать аудиторию рассылки (build_audience()).
+    """
+
+    now = timezone.now()
+    fields = dict({'starts_at': now, 'expired_at': now + timedelta(hours=1), 'text': 'text', 'filter': 'tag'},
+                  **fields)
+    mailing = Mailing.objects.create(**fields)
+    if audience:
+        build_audience(mailing)
+    return mailing
+
+
+def build_audience(mailing, batch=jobs.BATCH):
+    """
+    Аудитория рассылки так же, как в таске tasks.build_audience: задание MailingJob выполняется пачками до конца
+    """
+
+    job = MailingJob.objects.create(mailing=mailing)
+    while jobs.step(job.pk, batch=batch):
+        pass
+    return job
+
+
+class StatsMixin:
+    """
+    Счетчики сообщений рассылки self.mailing (MailingStat)
+    """
+
+    def stats(self):
+        return dict(MailingStat.objects.filter(mailing=self.mailing).exclude(count=0).values_list('status', 'count'))
+
+    def assertRebuilt(self):
+        stats = self.stats()
+        counters.rebuild(self.mailing.pk)
+        self.assertEqual(stats, self.stats())
+
+
+@skipUnless(connection.vendor in FULL_SCAN, 'EXPLAIN checks are written for SQLite and PostgreSQL')
+class QueryPlanTest(TestCase):
+    """
+    Основные запросы рассылки (поиск сообщений для отправки, выборка клиентов по фильтру, статистика) должны
+    идти по индексам. Тест падает, если план какого-либо запроса превратился в полный просмотр таблицы.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        Client.objects.bulk_create([
+            Client(number=79160000000 + i, code=916 + i % 3, tag='tag{}'.format(i % 10)) for i in range(500)
+        ])
+        for i in range(5):
+            cls.mailing = create_mailing(filter='tag{}'.format(i))
+
+    def setUp(self):
+        if connection.vendor == 'postgresql':
+            # на маленькой тестовой таблице PostgreSQL выберет Seq Scan и при наличии индекса
+            with connection.cursor() as cursor:
+                cursor.execute('SET enable_seqscan = off')
+
+    def assertIndexed(self, queryset):
+        plan = queryset.explain()
+        self.assertIsNone(FULL_SCAN[connection.vendor].search(plan), plan)
+
+    def test_due_messages(self):
+        now = timezone.now()
+        self.assertIndexed(Message.objects.filter(status='new', starts_at__lte=now, mailing__expired_at__gte=now)
+                           .order_by('id').values('id')[:100])
+
+    def test_clients_by_filter(self):
+        self.assertIndexed(Client.objects.filter(tag='tag1').values('id'))
+        self.assertIndexed(Client.objects.filter(code=916).values('id'))
+        self.assertIndexed(Client.objects.filter(number__gte=79160000000, number__lt=79170000000).values('id'))
+
+    def test_mailing_messages(self):
+        self.assertIndexed(Message.objects.filter(mailing=self.mailing.pk, status='new', id__gt=0).order_by('id')
+                           .values_list('id', 'client__number', 'status'))
+
+    def test_stale_messages(self):
+        leased = timezone.now() - timedelta(seconds=LEASE)
+        self.assertIndexed(Message.objects.filter(status='active', claimed_at__lt=leased).values('id'))
+
+    def test_mailing_stats(self):
+        self.assertIndexed(Mailing.objects.with_messages_status().filter(pk__in=[self.mailing.pk]))
+        self.assertIndexed(MailingStat.objects.filter(mailing=self.mailing.pk, status='new'))
+
+
+class CountersTest(StatsMixin, TestCase):
+    """
+    Счетчики сообщений рассылок (MailingStat) должны совпадать с пересчетом по таблице сообщений (counters.rebuild)
+    """
+
+    def setUp(self):
+        create_clients(10)
+        self.mailing = create_mailing()
+
+    def test_update_status(self):
+        ids = list(Message.objects.order_by('id').values_list('id', flat=True))
+        self.assertEqual(counters.update_status(Message.objects.filter(pk__in=ids[:4]), 'active'), 4)
+        self.assertEqual(self.stats(), {'new': 6, 'active': 4})
+        # сообщения в обоих статусах: 'active' переходят в 'new', поле attempts меняется у каждого сообщения один раз
+        updated = counters.update_status(Message.objects.filter(pk__in=ids[:6]), 'new', attempts=F('attempts') + 1)
+        self.assertEqual(updated, 6)
+        self.assertEqual(self.stats(), {'new': 10})
+        self.assertEqual(sorted(Message.objects.values_list('attempts', flat=True)), [0] * 4 + [1] * 6)
+        self.assertRebuilt()
+
+    def test_client_delete(self):
+        ids = list(Message.objects.order_by('id').values_list('id', flat=True))
+        counters.update_status(Message.objects.filter(pk__in=ids[:3]), 'sent')
+        Client.objects.filter(clients__in=ids[:5]).delete()
+        self.assertEqual(self.stats(), {'new': 5})
+        self.assertRebuilt()
+
+
+class MessagesPageTest(TestCase):
+    """
+    Страница сообщений детальной статистики рассылки: GET /api/mailing/<id>/?cursor=<id>&limit=<n>
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        create_clients(5)
+        cls.mailing = create_mailing()
+
+    def get(self, query):
+        return APIClient().get('/api/mailing/{}/{}'.format(self.mailing.pk, query))
+
+    def test_pages(self):
+        data = json.loads(b''.join(self.get('?limit=3').streaming_content))
+        self.assertEqual(len(data['messages']), 3)
+        data = json.loads(b''.join(self.get('?limit=3&cursor={}'.format(data['next'])).streaming_content))
+        self.assertEqual(len(data['messages']), 2)
+        self.assertIsNone(data['next'])
+
+    def test_bad_params(self):
+        queries = (('?limit=0', 'limit'), ('?limit=-1', 'limit'), ('?limit=x', 'limit'), ('?cursor=x', 'cursor'))
+        for query, key in queries:
+            response = self.get(query)
+            self.assertEqual(response.status_code, 400, query)
+            self.assertIn(key, response.json(), query)
+
+
+class MailingListTest(TestCase):
+    """
+    Краткая статистика рассылок: GET /api/mailing/ (счетчики сообщений всех рассылок одним запросом) и
+    GET /api/mailing/?page=<n>&page_size=<n>
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        create_clients(4)
+        cls.mailings = [create_mailing() for _ in range(3)]
+        messages = Message.objects.filter(mailing=cls.mailings[0]).order_by('id')
+        counters.update_status(Message.objects.filter(pk__in=list(messages.values_list('id', flat=True)[:3])), 'sent')
+
+    def get(self, query=''):
+        response = APIClient().get('/api/mailing/' + query)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_list(self):
+        with self.assertNumQueries(1):
+            data = self.get()
+        self.assertEqual([mailing['id'] for mailing in data], [mailing.pk for mailing in reversed(self.mailings)])
+        self.assertEqual(data[-1]['messages_status'], {'total': 4, 'new': 1, 'active': 0, 'sent': 3, 'failure': 0,
+                                                       'dead': 0})
+        self.assertEqual(data[0]['messages_status']['new'], 4)
+
+    def test_pages(self):
+        # количество рассылок, id рассылок страницы, счетчики сообщений только рассылок страницы
+        with self.assertNumQueries(3):
+            data = self.get('?page=1&page_size=2')
+        self.assertEqual(data['count'], 3)
+        self.assertEqual([mailing['id'] for mailing in data['results']], [self.mailings[2].pk, self.mailings[1].pk])
+        self.assertIsNotNone(data['next'])
+        data = self.get('?page=2&page_size=2')
+        self.assertEqual([mailing['id'] for mailing in data['results']], [self.mailings[0].pk])
+        self.assertEqual(data['results'][0]['messages_status']['sent'], 3)
+        self.assertIsNone(data['next'])
+        self.assertEqual(APIClient().get('/api/mailing/?page=3&page_size=2').status_code, 404)
+
+
+class ClientImportTest(TestCase):
+    """
+    Импорт клиентов: POST /api/client/import/ с телом CSV или NDJSON
+    """
+
+    def post(self, body, content_type='text/csv'):
+        return APIClient().post('/api/client/import/', body, content_type=content_type)
+
+    def test_csv(self):
+        response = self.post('\ufeffnumber,tag,zone\n79160000001,vip,Europe/Moscow\n'.encode('utf-8'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['inserted'], 1)
+        self.assertEqual(Client.objects.get().tag, 'vip')
+
+    def test_empty_body(self):
+        for content_type in ('text/csv', 'application/x-ndjson'):
+            response = self.post(b'', content_type)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('body', response.json())
+
+    def test_not_utf8(self):
+        response = self.post('number,tag\n79160000001,vip\n'.encode('utf-16'))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('body', response.json())
+        self.assertFalse(Client.objects.exists())
+
+    def test_not_utf8_line(self):
+        bodies = (('text/csv', b'number,tag\n79160000001,vip\n79160000002,\xff\xfe\n79160000003,vip\n'),
+                  ('application/x-ndjson', b'{"number": 79160000004, "tag": "vip"}\n{"tag": "\xff"}\n'))
+        for content_type, body in bodies:
+            response = self.post(body, content_type)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()['rejected'], 1)
+            self.assertEqual(response.json()['errors'], [{'line': 3 if content_type == 'text/csv' else 2,
+                                                          'error': 'Line is not UTF-8 text.'}])
+        self.assertEqual(Client.objects.count(), 3)
+
+    def test_update_batch(self):
+        # существующих клиентов в пачке больше, чем параметров в одном запросе SQLite
+        create_clients(1200)
+        body = ''.join('{},vip\n'.format(79160000000 + i) for i in range(1210)).encode()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post(body)
+        self.assertEqual((response.json()['inserted'], response.json()['updated']), (10, 1200))
+        self.assertEqual(Client.objects.filter(tag='vip').count(), 1210)
+        size = connection.ops.bulk_batch_size(['number'], range(1210))
+        lookups = [query for query in queries if query['sql'].startswith('SELECT') and '"number" IN' in query['sql']]
+        self.assertEqual(len(lookups), -(-1210 // size))
+
+
+class AudienceParseTest(SimpleTestCase):
+    """
+    Разбор фильтра рассылки: выражение, код оператора или тег клиента старого формата
+    """
+
+    def test_legacy(self):
+        self.assertEqual(parse('916'), {'field': 'code', 'lookup': 'exact', 'value': 916})
+        for tag in ('vip', 'black friday', 'sale!', "don't", 'rock and roll', 'not sure'):
+            self.assertEqual(parse(tag), {'field': 'tag', 'lookup': 'exact', 'value': tag})
+
+    def test_expression(self):
+        self.assertEqual(parse('tag = vip or not code = 916'), {'op': 'or', 'args': [
+            {'field': 'tag', 'lookup': 'exact', 'value': 'vip'},
+            {'op': 'not', 'args': [{'field': 'code', 'lookup': 'exact', 'value': 916}]},
+        ]})
+
+    def test_invalid_expression(self):
+        for text in ('code = x', '(tag = vip', 'not zone in (Asia/Omsk'):
+            with self.assertRaises(ValidationError, msg=text):
+                parse(text)
+
+
+class DeliveryWindowTest(TestCase):
+    """
+    Окно доставки по местному времени клиента проверяется при отправке, а не только при создании сообщений
+    """
+
+    def setUp(self):
+        now = timezone.now()
+        hour = now.astimezone(pytz.timezone('Europe/Moscow')).hour
+        # окно доставки, которое сейчас закрыто в часовом поясе клиента
+        self.window = {'window_start': time((hour + 2) % 24), 'window_end': time((hour + 4) % 24)}
+        self.client_zone = Client.objects.create(number=79160000001, code=916, tag='tag', zone='Europe/Moscow')
+
+    def deliver(self, expired_at):
+        now = timezone.now()
+        mailing = create_mailing(audience=False, starts_at=now - timedelta(hours=1), expired_at=expired_at,
+                                 **self.window)
+        message = Message.objects.create(mailing=mailing, client=self.client_zone, starts_at=now - timedelta(hours=1),
+                                         status='active')
+        return message, deliver_batch(batch=load_batch(Message.objects.filter(pk=message.pk)))
+
+    def test_deferred(self):
+        message, summary = self.deliver(timezone.now() + timedelta(days=3))
+        self.assertEqual(summary['deferred'], [message.pk])
+        message.refresh_from_db()
+        self.assertEqual(message.status, 'new')
+        self.assertEqual(message.attempts, 0)
+        local = message.starts_at.astimezone(pytz.timezone('Europe/Moscow'))
+        self.assertEqual(local.time(), self.window['window_start'])
+        self.assertGreater(message.starts_at, timezone.now())
+
+    def test_expired_before_window(self):
+        message, summary = self.deliver(timezone.now() + timedelta(minutes=30))
+        self.assertEqual(summary['failure'], [message.pk])
+
+    def test_unknown_zone(self):
+        at = timezone.now()
+        self.assertEqual(window_starts_at(at, 'Mars/Olympus', time(0), time(23, 59)),
+                         window_starts_at(at, 'Europe/Moscow', time(0), time(23, 59)))
+        response = APIClient().post('/api/client/', {'number': 79160000002, 'tag': 'tag', 'zone': 'Mars/Olympus'},
+                                    format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('zone', response.json())
+
+
+class LeaseTest(TestCase):
+    """
+    Пачка, которая ждала в очереди дольше аренды, не отправляет сообщения, которые sweeper уже вернул в работу
+    """
+
+    def setUp(self):
+        create_clients(3)
+        create_mailing()
+        self.claimed_at = timezone.now().replace(microsecond=123457)
+        counters.update_status(Message.objects.all(), 'active', claimed_at=self.claimed_at)
+        self.batch = load_batch(Message.objects.all())
+
+    def test_renew(self):
+        self.assertEqual(renew_lease(self.batch), set())
+        self.assertFalse(Message.objects.filter(claimed_at=self.claimed_at).exists())
+
+    def test_reclaimed(self):
+        reap_stale(lease=0)
+        # сообщения снова захватил другой диспетчер
+        counters.update_status(Message.objects.all(), 'active', claimed_at=timezone.now())
+        summary = deliver_batch(batch=self.batch)
+        self.assertEqual(sorted(summary['stale']), sorted(Message.objects.values_list('id', flat=True)))
+        self.assertEqual(summary['sent'] + summary['new'] + summary['failure'], [])
+        self.assertEqual(set(Message.objects.values_list('status', flat=True)), {'active'})
+
+
+
+class SweeperTest(StatsMixin, TestCase):
+    """
+    Закончившаяся рассылка (sweeper.expire()): неотправленные сообщения и получатели снимка аудитории получают
+    статус 'failure', счетчики рассылки совпадают с пересчетом
+    """
+
+    def setUp(self):
+        create_clients(6)
+        self.mailing = create_mailing()
+        self.ids = list(Message.objects.order_by('id').values_list('id', flat=True))
+        counters.update_status(Message.objects.filter(pk__in=self.ids[:2]), 'sent')
+        counters.update_status(Message.objects.filter(pk__in=self.ids[2:4]), 'active', claimed_at=timezone.now())
+        # другая рассылка еще идет
+        self.current = create_mailing()
+
+    def test_expire(self):
+        Mailing.objects.filter(pk=self.mailing.pk).update(expired_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(expire(), 4)
+        self.assertEqual(self.stats(), {'sent': 2, 'failure': 4})
+        self.assertEqual(set(Message.objects.filter(pk__in=self.ids[2:]).values_list('status', flat=True)),
+                         {'failure'})
+        self.assertEqual(set(Message.objects.filter(mailing=self.current).values_list('status', flat=True)), {'new'})
+        self.assertRebuilt()
+        self.assertEqual(expire(), 0)
+
+    def test_expire_snapshot(self):
+        # получатели снимка аудитории, до которых не дошла отправка, учитываются без создания сообщений
+        AudienceBlock.objects.create(mailing=self.mailing, clients=pack(self.ids[:3]), count=3)
+        counters.add(self.mailing.pk, 'new', 3)
+        Mailing.objects.filter(pk=self.mailing.pk).update(expired_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(expire(), 7)
+        self.assertEqual(self.stats(), {'sent': 2, 'failure': 7})
+        self.assertFalse(AudienceBlock.objects.exists())
+
+    def test_cancelled(self):
+        # после отмены сообщение вернулось в 'new' (повтор после ошибки отправки)
+        cancel(self.mailing)
+        counters.update_status(Message.objects.filter(mailing=self.mailing, status='active'), 'new')
+        self.assertEqual(self.stats(), {'sent': 2, 'failure': 2, 'new': 2})
+        self.assertEqual(expire(), 2)
+        self.assertEqual(self.stats(), {'sent': 2, 'failure': 4})
+        self.assertRebuilt()
+
+
+
+class DeliveryLogTest(TestCase):
+    """
+    Журнал отправки (DeliveryLog) вместо результатов тасков отправки: ротация старых записей пачками с выгрузкой
+    в NDJSON (python manage.py rotate_delivery_log) и переключатели записи журнала и результатов тасков
+    """
+
+    def setUp(self):
+        now = timezone.now()
+        DeliveryLog.objects.bulk_create(
+            [DeliveryLog(message_id=i, mailing_id=1, status='sent', code=200, latency=0.1, attempt=1,
+                         created_at=now - timedelta(days=40, minutes=i)) for i in range(5)]
+            + [DeliveryLog(message_id=i, mailing_id=1, status='sent', code=200, latency=0.1, attempt=1,
+                           created_at=now - timedelta(days=1)) for i in range(5, 8)])
+
+    @mock.patch('mailing.sweeper.ROTATE_BATCH', 2)
+    def test_rotate(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'delivery_log.ndjson')
+            call_command('rotate_delivery_log', '--days', '30', '--archive', path, stdout=io.StringIO())
+            with open(path, encoding='utf-8') as archive:
+                entries = [json.loads(line) for line in archive]
+        self.assertEqual(sorted(entry['message_id'] for entry in entries), list(range(5)))
+        self.assertEqual(sorted(DeliveryLog.objects.values_list('message_id', flat=True)), [5, 6, 7])
+        self.assertEqual(rotate_log(timezone.now()), 3)
+        self.assertFalse(DeliveryLog.objects.exists())
+
+    def test_switches(self):
+        log = [(1, 1, 'sent', 200, 0.1, 1, 0)]
+        with mock.patch.dict('mailing.delivery.DELIVERY_LOG', enabled=False):
+            self.assertEqual(write_log(log), 0)
+        self.assertEqual(write_log(log), 1)
+        # результаты тасков отправки по умолчанию не хранятся
+        self.assertTrue(tasks.send_batch.ignore_result)
+        with mock.patch('mailing.tasks.current_task') as current_task:
+            tasks.task_state('SUCCESS', {'message id': 1})
+            current_task.update_state.assert_not_called()
+            with mock.patch('mailing.tasks.STORE_RESULTS', True):
+                tasks.task_state('SUCCESS', {'message id': 1})
+            current_task.update_state.assert_called_once_with(state='SUCCESS', meta=json.dumps({'message id': 1}))
+
+
+@mock.patch('mailing.views.start')
+class MailingStateTest(StatsMixin, TestCase):
+    """
+    Пауза, возобновление и отмена рассылки: POST /api/mailing/<id>/pause|resume|cancel/. Пачка, которая ждала
+    в очереди, отбрасывается без отправки.
+    """
+
+    def setUp(self):
+        create_clients(5)
+        self.mailing = create_mailing()
+        self.claimed = list(Message.objects.order_by('id').values_list('id', flat=True)[:2])
+        counters.update_status(Message.objects.filter(pk__in=self.claimed), 'active', claimed_at=timezone.now())
+        self.batch = load_batch(Message.objects.filter(pk__in=self.claimed))
+
+    def post(self, action):
+        return APIClient().post('/api/mailing/{}/{}/'.format(self.mailing.pk, action))
+
+    def test_pause_resume(self, start):
+        response = self.post('pause')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['state'], 'paused')
+        # захваченные сообщения могут отправляться прямо сейчас: пауза их не трогает
+        self.assertEqual(self.stats(), {'new': 3, 'active': 2})
+        self.assertEqual(self.post('pause').status_code, 400)
+
+        summary = deliver_batch(batch=self.batch)
+        self.assertEqual(sorted(summary['stale']), self.claimed)
+        self.assertEqual(self.stats(), {'new': 5})
+
+        response = self.post('resume')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['state'], 'active')
+        start.assert_called()
+
+    def test_cancel(self, start):
+        response = self.post('cancel')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['messages'], 3)
+        self.assertEqual(self.stats(), {'failure': 3, 'active': 2})
+        # пачка ждала в очереди: воркер отбрасывает ее и закрывает ее сообщения
+        summary = deliver_batch(batch=self.batch)
+        self.assertEqual(sorted(summary['stale']), self.claimed)
+        self.assertEqual(self.stats(), {'failure': 5})
+        self.assertEqual(self.post('resume').status_code, 400)
+
+    def test_cancel_in_flight(self, start):
+        self.post('cancel')
+        # пачка уже отправлялась: результаты отправки записываются
+        write_outcome({'sent': self.claimed})
+        self.assertEqual(self.stats(), {'failure': 3, 'sent': 2})
+        self.assertEqual(set(Message.objects.filter(pk__in=self.claimed).values_list('status', flat=True)), {'sent'})
+
+    def test_reschedule_in_flight(self, start):
+        starts_at = timezone.now() + timedelta(minutes=30)
+        response = APIClient().put('/api/mailing/{}/'.format(self.mailing.pk), {'starts_at': starts_at.isoformat()},
+                                   format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.stats(), {'new': 3, 'active': 2})
+        self.assertEqual(set(Message.objects.values_list('starts_at', flat=True)), {starts_at})
+        write_outcome({'sent': self.claimed})
+        self.assertEqual(self.stats(), {'new': 3, 'sent': 2})
+
+
+class SnapshotTest(StatsMixin, TestCase):
+    """
+    Снимок аудитории большой рассылки (./snapshot.py): упаковка id клиентов, создание сообщений из блоков по доле
+    захвата, закрытие блоков и пересчет счетчиков
+    """
+
+    def setUp(self):
+        create_clients(1200)
+        self.mailing = create_mailing(audience=False)
+        with mock.patch.dict(SNAPSHOT, min_audience=1000):
+            build_audience(self.mailing, batch=1000)
+
+    def test_pack(self):
+        for ids in ([], [1], list(range(1, 1001)), [3, 4, 5, 9, 100, 101, 2 ** 40]):
+            self.assertEqual(unpack(pack(ids)), ids)
+
+    def test_materialize(self):
+        self.assertEqual(AudienceBlock.objects.filter(mailing=self.mailing).count(), 2)
+        # первый блок-- больше 999 id клиентов (ограничение параметров запроса SQLite), от второго блока остается
+        # часть сверх доли захвата
+        self.assertEqual(materialize(self.mailing.pk, limit=1100), 1100)
+        self.assertEqual(list(AudienceBlock.objects.values_list('count', flat=True)), [100])
+        self.assertEqual(self.stats(), {'new': 1200})
+        self.assertRebuilt()
+        # клиенты, удаленные после создания снимка, пропускаются
+        Client.objects.filter(pk=Client.objects.order_by('-id').values_list('id', flat=True).first()).delete()
+        self.assertEqual(materialize(self.mailing.pk, limit=5000), 99)
+        self.assertEqual(Message.objects.count(), 1199)
+        self.assertFalse(AudienceBlock.objects.exists())
+        self.assertEqual(self.stats(), {'new': 1199})
+        self.assertRebuilt()
+
+    def test_close(self):
+        materialize(self.mailing.pk, limit=500)
+        self.assertEqual(close(AudienceBlock.objects.filter(mailing=self.mailing), 'failure'), 700)
+        self.assertFalse(AudienceBlock.objects.exists())
+        self.assertEqual(self.stats(), {'new': 500, 'failure': 700})
+
+
+class ShardedDispatcherTest(TestCase):
+    """
+    Шардированные диспетчеры (./dispatcher.py): шарды делятся между живыми диспетчерами без пересечений и
+    отпускаются при остановке по SIGTERM
+    """
+
+    def test_balance(self):
+        first = ShardedDispatcher(dispatch=None, shards=8, name='first')
+        second = ShardedDispatcher(dispatch=None, shards=8, name='second')
+        self.assertEqual(first.balance(), list(range(8)))
+        # второй диспетчер получает шарды, которые первый отпускает на следующем проходе
+        self.assertEqual(second.balance(), [])
+        first.balance()
+        second.balance()
+        self.assertEqual(len(first.owned), 4)
+        self.assertEqual(len(second.owned), 4)
+        self.assertFalse(set(first.owned) & set(second.owned))
+        self.assertEqual(sorted(first.owned + second.owned), list(range(8)))
+
+    def test_sigterm(self):
+        passes = list()
+
+        def dispatch(shards):
+            passes.append(shards)
+            os.kill(os.getpid(), signal.SIGTERM)
+            return 1
+
+        dispatcher = ShardedDispatcher(dispatch=dispatch, shards=4, name='first')
+        dispatcher.run(interval=60)
+        self.assertEqual(passes, [(list(range(4)), 4)])
+        self.assertFalse(ShardLease.objects.exclude(owner='').exists())
+        self.assertFalse(Dispatcher.objects.exists())
+        self.assertIsNot(signal.getsignal(signal.SIGTERM), dispatcher.stop)
+
+
+@mock.patch('mailing.tasks.CLAIM_BATCH', 10)
+@mock.patch('mailing.tasks.batch_signature')
+class DispatchTest(TestCase):
+    """
+    Порция захвата диспетчера делится между рассылками: доля, которую рассылка не добрала, достается остальным
+    """
+
+    def setUp(self):
+        Client.objects.bulk_create([Client(number=79160000000 + i, code=916, tag='tag{}'.format(i // 20))
+                                    for i in range(21)])
+        now = timezone.now()
+        self.early = create_mailing(expired_at=now + timedelta(days=1), filter='tag0')
+        # у рассылки, которая заканчивается позже, только повтор с задержкой: захватывать пока нечего
+        self.late = create_mailing(expired_at=now + timedelta(days=2), filter='tag1')
+        Message.objects.filter(mailing=self.late).update(next_attempt_at=now + timedelta(hours=1))
+
+    def test_leftover_share(self, batch_signature):
+        materialized, claimed, _ = dispatch()
+        self.assertEqual(claimed, 10)
+        self.assertEqual(Message.objects.filter(mailing=self.early, status='active').count(), 10)
+
+    def test_send(self, batch_signature):
+        batch_signature.return_value.apply_async.return_value.id = 'task-id'
+        send()
+        self.assertEqual(Message.objects.filter(mailing=self.early, status='active').count(), 20)
+        self.assertEqual(Message.objects.get(mailing=self.late).status, 'new')
+
+
+@mock.patch('mailing.tasks.start')
+@mock.patch('mailing.views.build_audience')
+class MailingJobTest(TestCase):
+    """
+    Фоновое создание аудитории рассылки (./jobs.py): ключ идемпотентности, прогресс задания, продолжение с места
+    остановки и повтор после ошибки
+    """
+
+    def setUp(self):
+        create_clients(25)
+        now = timezone.now()
+        self.data = {'starts_at': now.isoformat(), 'expired_at': (now + timedelta(hours=1)).isoformat(),
+                     'text': 'text', 'filter': 'tag'}
+
+    def post(self, data, key='key-1'):
+        return APIClient().post('/api/mailing/', data, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_idempotency(self, build_audience, start):
+        first = self.post(self.data).json()
+        self.assertEqual(self.post(self.data).json(), first)
+        self.assertEqual(Mailing.objects.count(), 1)
+        build_audience.delay.assert_called_once_with(first['job']['id'])
+        # ключ проверяется до данных запроса: повтор с другими данными-- ошибка ключа, а не полей рассылки
+        response = self.post(dict(self.data, text=''))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(list(response.json()), ['idempotency_key'])
+        self.assertEqual(self.post(dict(self.data, text=''), key='key-2').status_code, 400)
+
+    def test_progress_and_resume(self, build_audience, start):
+        job_id = self.post(self.data).json()['job']['id']
+        self.assertEqual(jobs.step(job_id, batch=10), 10)
+        response = APIClient().get('/api/mailing/job/{}/'.format(job_id)).json()
+        self.assertEqual((response['status'], response['total'], response['done']), ('running', 25, 10))
+        # исполнитель задания пропал: задание продолжает tasks.sweep с места остановки
+        self.assertEqual(jobs.stale(lease=-1), [job_id])
+        self.assertEqual(tasks.build_audience.apply(args=(job_id,)).get(), {'job': job_id, 'processed': 15})
+        job = MailingJob.objects.get(pk=job_id)
+        self.assertEqual((job.status, job.done), ('done', 25))
+        self.assertEqual(Message.objects.count(), 25)
+        self.assertEqual(MailingStat.objects.get(status='new').count, 25)
+
+    def test_retry(self, build_audience, start):
+        job_id = self.post(self.data).json()['job']['id']
+        insert_messages = fanout.insert_messages
+        errors = [OperationalError('database is locked')]
+
+        def flaky(*args):
+            if errors:
+                raise errors.pop()
+            return insert_messages(*args)
+
+        with mock.patch('mailing.jobs.insert_messages', side_effect=flaky):
+            tasks.build_audience.apply(args=(job_id,))
+        job = MailingJob.objects.get(pk=job_id)
+        self.assertEqual((job.status, job.done, job.attempts), ('done', 25, 1))
+        self.assertEqual(Message.objects.count(), 25)
+
+    def test_failed(self, build_audience, start):
+        job_id = self.post(self.data).json()['job']['id']
+        with mock.patch('mailing.jobs.insert_messages', side_effect=OperationalError('database is locked')):
+            self.assertTrue(tasks.build_audience.apply(args=(job_id,)).failed())
+        job = MailingJob.objects.get(pk=job_id)
+        self.assertEqual((job.status, job.attempts), ('failed', jobs.ATTEMPTS))
+        self.assertFalse(Message.objects.exists())
+
+
+class DeliveryTest(StatsMixin, TransactionTestCase):
+    """
+    Отправка пачки (delivery.deliver_batch()) на заглушку принимающего сервера (benchmark.StubServer): успешная
+    отправка, повтор с задержкой после ошибок сервера, circuit breaker. Лимит скорости обращается к БД из отдельного
+    потока, поэтому тест без общей транзакции.
+    """
+
+    def setUp(self):
+        create_clients(20)
+        self.mailing = create_mailing()
+        self.ids = list(Message.objects.order_by('id').values_list('id', flat=True))
+
+    def deliver(self, error_rate=0.0):
+        counters.update_status(Message.objects.filter(status='new'), 'active', claimed_at=timezone.now())
+        server = StubServer(latency=0.001, error_rate=error_rate)
+        try:
+            with mock.patch('mailing.delivery.URL', server.start()):
+                return deliver_batch(batch=load_batch(Message.objects.filter(status='active')))
+        finally:
+            server.stop()
+
+    def test_post_messages(self):
+        server = StubServer(latency=0.001, error_rate=1.0)
+        try:
+            payloads = [{'id': message_id, 'phone': 79160000000, 'text': 'text'} for message_id in self.ids[:3]]
+            responses = asyncio.run(post_messages(payloads, url=server.start()))
+        finally:
+            server.stop()
+        self.assertEqual(responses, {message_id: 500 for message_id in self.ids[:3]})
+
+    def test_sent(self):
+        summary = self.deliver()
+        self.assertEqual(sorted(summary['sent']), self.ids)
+        self.assertEqual(self.stats(), {'sent': 20})
+        self.assertEqual(DeliveryLog.objects.filter(status='sent', code=200, attempt=1).count(), 20)
+
+    def test_retry(self):
+        Message.objects.filter(pk=self.ids[0]).update(attempts=RETRY['attempts'] - 1)
+        started = timezone.now()
+        summary = self.deliver(error_rate=1.0)
+        self.assertEqual(summary['dead'], self.ids[:1])
+        self.assertEqual(sorted(summary['new']), self.ids[1:])
+        self.assertEqual(self.stats(), {'new': 19, 'dead': 1})
+        # повтор не раньше половины и не позже полной задержки первой попытки (jitter)
+        for attempts, next_attempt_at in Message.objects.filter(status='new').values_list('attempts',
+                                                                                          'next_attempt_at'):
+            self.assertEqual(attempts, 1)
+            self.assertGreaterEqual(next_attempt_at, started + timedelta(seconds=RETRY['base_delay'] / 2))
+            self.assertLessEqual(next_attempt_at, timezone.now() + timedelta(seconds=RETRY['base_delay']))
+
+    def test_circuit_breaker(self):
+        # все 20 запросов окна-- ошибки: отправка приостанавливается
+        self.deliver(error_rate=1.0)
+        self.assertTrue(TokenBucket().is_open())
+        Message.objects.update(next_attempt_at=None)
+        summary = self.deliver()
+        self.assertEqual(sorted(summary['new']), self.ids)
+        self.assertEqual(set(Message.objects.values_list('attempts', flat=True)), {1})
+        self.assertEqual(self.stats(), {'new': 20})
+        # пауза закончилась: отправка возобновляется
+        RateLimit.objects.update(open_until=timezone.now())
+        self.assertFalse(TokenBucket().is_open())
+        self.assertEqual(sorted(self.deliver()['sent']), self.ids)
+        self.assertEqual(self.stats(), {'sent': 20})
+
+
+class WriteBackTest(StatsMixin, TransactionTestCase):
+    """
+    Запись статусов сообщений из буфера воркера (writeback.StatusBuffer): по размеру буфера, по времени фоновым
+    потоком, повтор после ошибки записи, свой буфер в каждом процессе воркера и запись при остановке воркера.
+    Фоновый поток пишет в БД через свое соединение, поэтому тест без общей транзакции.
+    """
+
+    def setUp(self):
+        create_clients(5)
+        self.mailing = create_mailing()
+        counters.update_status(Message.objects.all(), 'active', claimed_at=timezone.now())
+        self.ids = list(Message.objects.order_by('id').values_list('id', flat=True))
+
+    def test_size(self):
+        buffer = StatusBuffer({'size': 3, 'interval': 60})
+        buffer.add({'sent': self.ids[:2]})
+        self.assertEqual(self.stats(), {'active': 5})
+        buffer.add({'sent': self.ids[2:3]}, failed=[(self.ids[3], 0)])
+        self.assertEqual(self.stats(), {'active': 1, 'sent': 3, 'new': 1})
+        self.assertEqual((buffer.size, buffer.oldest), (0, None))
+
+    def test_interval(self):
+        written = threading.Event()
+
+        def write(*args):
+            write_outcome(*args)
+            written.set()
+
+        buffer = StatusBuffer({'size': 1000, 'interval': 0.05})
+        with mock.patch('mailing.writeback.write_outcome', side_effect=write):
+            buffer.add({'sent': self.ids})
+            self.assertTrue(written.wait(5))
+        self.assertEqual(self.stats(), {'sent': 5})
+
+    def test_failed_write(self):
+        buffer = StatusBuffer({'size': 1000, 'interval': 60})
+        buffer.add({'sent': self.ids[:2]}, log=[(self.ids[0], self.mailing.pk, 'sent', 200, 0.1, 1, 0)])
+        with mock.patch('mailing.writeback.write_outcome', side_effect=OperationalError('database is locked')), \
+                self.assertLogs('mailing.writeback', 'ERROR'):
+            self.assertEqual(buffer.flush(), 0)
+        self.assertEqual((buffer.statuses, buffer.size, len(buffer.log)), ({'sent': self.ids[:2]}, 2, 1))
+        self.assertIsNotNone(buffer.oldest)
+        self.assertEqual(self.stats(), {'active': 5})
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(self.stats(), {'active': 3, 'sent': 2})
+        self.assertEqual(DeliveryLog.objects.count(), 1)
+
+    def test_fork(self):
+        buffer = StatusBuffer({'size': 1000, 'interval': 60})
+        with mock.patch('mailing.writeback.os.getpid', return_value=100):
+            buffer.add({'sent': self.ids[:2]})
+        parent = buffer.timer
+        # дочерний процесс после fork: результаты родителя не его, фоновый поток родителя не унаследован
+        with mock.patch('mailing.writeback.os.getpid', return_value=101):
+            buffer.add({'sent': self.ids[2:3]})
+        self.assertEqual((buffer.pid, buffer.statuses, buffer.size), (101, {'sent': self.ids[2:3]}, 1))
+        self.assertIsNot(buffer.timer, parent)
+        self.assertTrue(buffer.timer.is_alive())
+
+    def test_worker_shutdown(self):
+        buffer = StatusBuffer({'size': 1000, 'interval': 60})
+        buffer.add({'sent': self.ids})
+        with mock.patch('mailing.tasks.buffer', buffer):
+            worker_process_shutdown.send(sender=None, pid=os.getpid(), exitcode=0)
+        self.assertEqual(self.stats(), {'sent': 5})
+
+
+class SchedulerTest(TestCase):
+    """
+    Планировщик запуска рассылок (scheduler.DeadlineScheduler): загрузка расписания из БД, пропуск устаревших
+    записей heap после изменения рассылки, время сна до ближайшей рассылки
+    """
+
+    def setUp(self):
+        create_clients(3)
+        self.now = timezone.now()
+        self.mailing = create_mailing(starts_at=self.now + timedelta(minutes=10))
+        self.scheduler = DeadlineScheduler(dispatch=mock.Mock())
+
+    def test_load(self):
+        snapshot = create_mailing(audience=False, starts_at=self.now + timedelta(minutes=20))
+        with mock.patch.dict(SNAPSHOT, min_audience=1):
+            build_audience(snapshot)
+        paused = create_mailing(state='paused')
+        create_mailing(starts_at=self.now - timedelta(hours=2), expired_at=self.now - timedelta(hours=1))
+        self.assertTrue(AudienceBlock.objects.filter(mailing=snapshot).exists())
+        self.assertTrue(Message.objects.filter(mailing=paused).exists())
+        self.scheduler.load()
+        self.assertEqual(self.scheduler.planned, {self.mailing.pk: self.mailing.starts_at,
+                                                  snapshot.pk: snapshot.starts_at})
+
+    def test_edited(self):
+        self.scheduler.load()
+        # рассылку перенесли на 20 минут позже: прежняя запись остается в heap, но пропускается
+        later = self.now + timedelta(minutes=30)
+        Message.objects.update(starts_at=later)
+        self.scheduler.refresh(self.mailing.pk)
+        self.assertEqual(len(self.scheduler.heap), 2)
+        self.assertEqual(self.scheduler.due(self.now + timedelta(minutes=15)), [])
+        self.assertEqual(self.scheduler.heap, [(later, self.mailing.pk)])
+        self.assertEqual(self.scheduler.due(later), [self.mailing.pk])
+        self.assertEqual(self.scheduler.planned, {})
+
+    def test_timeout(self):
+        self.assertEqual(self.scheduler.timeout(self.now), MAX_IDLE)
+        self.scheduler.push(self.mailing.pk, self.now + timedelta(seconds=10))
+        self.assertEqual(self.scheduler.timeout(self.now), 10)
+        self.assertEqual(self.scheduler.timeout(self.now + timedelta(seconds=20)), 0)
+        # устаревшая запись на вершине heap не укорачивает сон
+        self.scheduler.push(self.mailing.pk, self.now + timedelta(seconds=100))
+        self.assertEqual(self.scheduler.timeout(self.now), 100)
+        self.scheduler.push(self.mailing.pk, self.now + timedelta(hours=1))
+        self.assertEqual(self.scheduler.timeout(self.now), MAX_IDLE)
+
+    def test_tick(self):
+        later = self.now + timedelta(minutes=30)
+        first = Message.objects.order_by('id').first()
+        Message.objects.filter(pk=first.pk).update(starts_at=later)
+        Message.objects.exclude(pk=first.pk).update(starts_at=self.now - timedelta(minutes=1))
+        self.scheduler.load()
+        # до следующего сообщения больше MAX_IDLE: сон не дольше MAX_IDLE
+        self.assertEqual(self.scheduler.tick(), MAX_IDLE)
+        self.scheduler.dispatch.assert_called_once_with(self.mailing.pk)
+        # наступившие сообщения уже переданы в отправку: рассылка запланирована на следующее сообщение
+        self.assertEqual(self.scheduler.planned, {self.mailing.pk: later})
+
+
+@mock.patch.dict('mailing.metrics._pending', clear=True)
+class MetricsTest(TestCase):
+    """
+    Метрики Prometheus (./metrics.py): запись накопленных метрик процесса в общую таблицу и эндпоинт /metrics
+    """
+
+    def lines(self):
+        response = APIClient().get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        return response.content.decode().splitlines()
+
+    def test_render(self):
+        create_clients(3)
+        create_mailing()
+        # только метрики теста, без отрезков этапов создания рассылки
+        metrics._pending.clear()
+        metrics.inc('mailing_messages_delivered_total', 3)
+        metrics.inc('mailing_batches_queued_total', queue='mailing.urgent')
+        metrics.observe('mailing_http_latency_seconds', [0.5, 0.25, 20])
+        self.assertEqual(metrics.flush(), 16)
+        # следующая запись прибавляется к значению серии
+        metrics.inc('mailing_messages_delivered_total', 2)
+        self.assertEqual(metrics.flush(), 1)
+        lines = self.lines()
+        for line in ('# HELP mailing_messages_delivered_total Messages accepted by the provider (HTTP 200).',
+                     '# TYPE mailing_messages_delivered_total counter',
+                     'mailing_messages_delivered_total 5',
+                     'mailing_batches_queued_total{queue="mailing.urgent"} 1',
+                     '# TYPE mailing_http_latency_seconds histogram',
+                     'mailing_http_latency_seconds_bucket{le="0.005"} 0',
+                     'mailing_http_latency_seconds_bucket{le="0.25"} 1',
+                     'mailing_http_latency_seconds_bucket{le="0.5"} 2',
+                     'mailing_http_latency_seconds_bucket{le="+Inf"} 3',
+                     'mailing_http_latency_seconds_sum 20.75',
+                     'mailing_http_latency_seconds_count 3',
+                     '# TYPE mailing_messages gauge',
+                     'mailing_messages{status="new"} 3'):
+            self.assertIn(line, lines)
+        # одна пара HELP/TYPE на гистограмму, а не на каждую ее серию
+        self.assertEqual(lines.count('# TYPE mailing_http_latency_seconds histogram'), 1)
+        self.assertFalse([line for line in lines if line.startswith('# TYPE mailing_http_latency_seconds_')])
+
+    def test_failed_flush(self):
+        metrics.inc('mailing_messages_delivered_total', 3)
+        with mock.patch('mailing.metrics.Metric.objects.filter', side_effect=OperationalError('database is locked')), \
+                self.assertLogs('mailing.metrics', 'ERROR'):
+            self.assertEqual(metrics.flush(), 0)
+        self.assertFalse(Metric.objects.exists())
+        # изменения вернулись в процесс и не потерялись вместе с прибавкой, накопленной после ошибки
+        metrics.inc('mailing_messages_delivered_total', 2)
+        self.assertEqual(metrics.flush(), 1)
+        self.assertIn('mailing_messages_delivered_total 5', self.lines())
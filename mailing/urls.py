@@ -1,6 +1,6 @@
 from django.urls import path
 
-from .views import ClientView, MailingView
+from .views import ClientView, ClientImportView, MailingView, MailingAudienceView, MailingJobView, MailingStateView
 
 
 app_name = 'mailing'
@@ -8,6 +8,12 @@ app_name = 'mailing'
 urlpatterns = [
     path('client/', ClientView.as_view()),
     path('client/<int:pk>/', ClientView.as_view()),
+    path('client/import/', ClientImportView.as_view()),
     path('mailing/', MailingView.as_view()),
-    path('mailing/<int:pk>/', MailingView.as_view())
+    path('mailing/<int:pk>/', MailingView.as_view()),
+    path('mailing/audience/', MailingAudienceView.as_view()),
+    path('mailing/job/<int:pk>/', MailingJobView.as_view()),
+    path('mailing/<int:pk>/pause/', MailingStateView.as_view(), {'action': 'pause'}),
+    path('mailing/<int:pk>/resume/', MailingStateView.as_view(), {'action': 'resume'}),
+    path('mailing/<int:pk>/cancel/', MailingStateView.as_view(), {'action': 'cancel'}),
 ]
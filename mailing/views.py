@@ -1,14 +1,28 @@
 import json
-from django.utils import timezone
-from django.http import JsonResponse
+from itertools import chain
+from django.db import transaction
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.generics import get_object_or_404
+from rest_framework.pagination import PageNumberPagination
 
-from .models import Mailing, Client, Message
+from .models import Mailing, MailingJob, Client, Message, operator_code
 from .serializers import ClientSerializer, MailingSerializer, StatsMailingSerializer, StatsMailingPKSerializer
-from .tasks import send
+from .tasks import build_audience, start
+from .fanout import reschedule
+from .imports import import_clients, read_csv, read_ndjson
+from .audience import compile_filter
+from .lifecycle import ACTIONS, TRANSITIONS
+from .jobs import find, fingerprint, progress, submit
+from . import metrics
+
+# messages read from database by one chunk during streaming detail statistics of mailing
+MESSAGES_CHUNK = 2000
+# max page size (?limit=) of messages in detail statistics of mailing
+MESSAGES_MAX_LIMIT = 100000
 
 
 class ClientView(APIView):
@@ -22,7 +36,7 @@ class ClientView(APIView):
         """
 
         client = request.data
-        client['code'] = int(client['number']) // 10_000_000 - 7_000
+        client['code'] = operator_code(client['number'])
         serializer = ClientSerializer(data=client)
         if serializer.is_valid(raise_exception=True):
             client = serializer.save()
@@ -57,6 +71,90 @@ class ClientView(APIView):
         return JsonResponse(data, content_type='application/json', status=status.HTTP_200_OK)
 
 
+def stream_messages(mailing, messages, limit=None):
+    """
+    Streaming JSON of mailing detail statistics: mailing fields, then its messages with client number (one joined
+    query, read by chunks), then 'next'-- cursor of the next page of messages, if page is full.
+    """
+
+    yield json.dumps(mailing)[:-1] + ', "messages": ['
+    rows = messages.values_list('id', 'client__number', 'status').iterator(chunk_size=MESSAGES_CHUNK)
+    count, last = 0, None
+    for message_id, number, message_status in rows:
+        prefix = ', ' if count else ''
+        yield prefix + json.dumps({'id': message_id, 'client': number, 'status': message_status})
+        count, last = count + 1, message_id
+    next_cursor = last if limit is not None and count == limit else None
+    yield '], "next": {}}}'.format(json.dumps(next_cursor))
+
+
+class ClientImportView(APIView):
+    """
+    Bulk import of clients from CSV or NDJSON request body.
+    """
+
+    def post(self, request):
+        """
+        Streaming import of clients: rows are read from request body line by line, validated and saved by batches.
+        Existing clients (by unique number) are updated, new ones are created, 'code' is calculated from 'number'.
+        Body format: CSV (Content-Type: text/csv, columns number,tag,zone with optional header line)
+        or NDJSON (Content-Type: application/x-ndjson, one client json object per line).
+        """
+
+        content_type = request.content_type.split(';')[0].strip()
+        if content_type in ('text/csv', 'application/csv'):
+            read = read_csv
+        elif content_type in ('application/x-ndjson', 'application/jsonl', 'application/json-seq'):
+            read = read_ndjson
+        else:
+            raise ValidationError({'content_type': 'Use text/csv or application/x-ndjson request body.'})
+        # the first line is checked before anything is saved: empty body or not UTF-8 text (e.g. UTF-16 with BOM).
+        # Other lines that are not UTF-8 are rejected rows of import summary
+        lines = iter(request.stream if request.stream is not None else ())
+        first = next(lines, b'')
+        if not first:
+            raise ValidationError({'body': 'Request body is empty.'})
+        try:
+            first.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            raise ValidationError({'body': 'Request body must be UTF-8 text.'})
+        summary = import_clients(read(chain((first,), lines)))
+        return JsonResponse(summary, content_type='application/json', status=status.HTTP_200_OK)
+
+
+class MailingAudienceView(APIView):
+    """
+    Dry run of mailing filter.
+    """
+
+    def post(self, request):
+        """
+        Count clients matching mailing filter without creating mailing and its messages.
+        """
+
+        serializer = MailingSerializer(data=request.data, partial=True)
+        serializer.is_valid(raise_exception=True)
+        if 'filter' not in serializer.validated_data:
+            raise ValidationError({'filter': 'This field is required.'})
+        mailing = Mailing(filter=serializer.validated_data['filter'])
+        data = {
+            'filter': mailing.filter,
+            'audience': json.loads(compile_filter(mailing.filter)),
+            'count': mailing.clients().count(),
+        }
+        return JsonResponse(data, content_type='application/json', status=status.HTTP_200_OK)
+
+
+class MailingPagination(PageNumberPagination):
+    """
+    Optional pagination of mailings statistics: /api/mailing/?page=2&page_size=50
+    """
+
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
 class MailingView(APIView):
     """
     View, create, update and delete Mailing with attributes to database.
@@ -70,81 +168,107 @@ class MailingView(APIView):
         """
         if 'pk' in self.kwargs:
             pk = self.kwargs['pk']
-            query = get_object_or_404(Mailing, pk=pk)
+            query = get_object_or_404(Mailing.objects.with_messages_status(), pk=pk)
             serializer = StatsMailingPKSerializer(query)
-            return JsonResponse(serializer.data, content_type='application/json', status=status.HTTP_200_OK)
-        else:
-            query = Mailing.objects.order_by('-id')
+            messages, limit = self.messages_page(pk)
+            return StreamingHttpResponse(stream_messages(serializer.data, messages, limit),
+                                         content_type='application/json', status=status.HTTP_200_OK)
+
+        # messages status counts of all listed mailings are calculated by one aggregate query
+        query = Mailing.objects.with_messages_status().order_by('-id')
+        if MailingPagination.page_query_param not in self.request.query_params:
             serializer = StatsMailingSerializer(query, many=True)
             return JsonResponse(serializer.data, content_type='application/json', status=status.HTTP_200_OK, safe=False)
 
+        # paginate by plain mailing ids, then aggregate messages only for mailings of this page
+        paginator = MailingPagination()
+        page = paginator.paginate_queryset(Mailing.objects.order_by('-id').values_list('id', flat=True),
+                                           self.request, view=self)
+        serializer = StatsMailingSerializer(query.filter(pk__in=page), many=True)
+        data = paginator.get_paginated_response(serializer.data).data
+        return JsonResponse(data, content_type='application/json', status=status.HTTP_200_OK)
+
+    def messages_page(self, pk):
+        """
+        Messages of mailing for detail statistics, filtered by query params:
+        ?status=sent-- only messages with this status, ?cursor=<id>-- messages after this id, ?limit=<n>-- page size
+        (at most MESSAGES_MAX_LIMIT).
+        """
+
+        params = self.request.query_params
+        messages = Message.objects.filter(mailing=pk).order_by('id')
+        if 'status' in params:
+            if params['status'] not in dict(Message.STATUS):
+                raise ValidationError({'status': 'Unknown message status.'})
+            messages = messages.filter(status=params['status'])
+        if 'cursor' in params:
+            try:
+                messages = messages.filter(id__gt=int(params['cursor']))
+            except ValueError:
+                raise ValidationError({'cursor': 'Cursor must be an integer.'})
+        limit = None
+        if 'limit' in params:
+            try:
+                limit = int(params['limit'])
+            except ValueError:
+                raise ValidationError({'limit': 'Limit must be an integer.'})
+            if limit < 1:
+                raise ValidationError({'limit': 'Limit must be a positive integer.'})
+            limit = min(limit, MESSAGES_MAX_LIMIT)
+            messages = messages[:limit]
+        return messages, limit
+
     def post(self, request):
         """
         Adding new mailing to database with its attributes.
+        Clients of mailing are found and its messages are created in background (see ./jobs.py), response has id of
+        this job: /api/mailing/job/<id>/ shows its progress. Request with 'Idempotency-Key' header already used
+        returns the same mailing and job instead of creating a new mailing.
         """
 
-        mailing = request.data
-        serializer = MailingSerializer(data=mailing)
-        if serializer.is_valid(raise_exception=True):
+        serializer = MailingSerializer(data=request.data)
+        key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+        # retry of request already accepted returns its result even if the same data would not be valid now
+        job, created = find(key), False
+        if job is None:
+            serializer.is_valid(raise_exception=True)
             # validators in ./models.py
-            mailing = serializer.save()
-        # find client by mailing filter
-        if mailing.filter.isnumeric():
-            # find by code number
-            filter = int(mailing.filter)
-            if 0 < filter <= 999:
-                filter_min_value = filter * 10000000 + 70000000000
-                filter_max_value = (filter + 1) * 10000000 + 70000000000
-                clients = Client.objects.filter(number__gte=filter_min_value, number__lt=filter_max_value)
-        else:
-            # find by tag
-            clients = Client.objects.filter(tag=mailing.filter)
-
-        # Create message by each client.
-        # Next, its messages need to send to clients (Celery tasks)
-        for client in clients:
-            message = Message()
-            message.starts_at = mailing.starts_at
-            message.client = client
-            message.mailing = mailing
-            message.save()
-        # send mailing by id, if 'starts_at' time has come and 'expired_at' time is not over
-        # send now
-        now = timezone.now()
-        if mailing.starts_at <= now < mailing.expired_at:
-            # run celery.task.group
-            send.delay(mailing.pk)
+            job, created = submit(serializer, key=key)
+        if not created and job.fingerprint != fingerprint(serializer.initial_data):
+            raise ValidationError({'idempotency_key': 'This key is already used with other mailing data.'})
+        if created:
+            # find clients by mailing filter and create message by each client in bulk, then send mailing by id,
+            # if 'starts_at' time has come and 'expired_at' time is not over, or send it later (Celery tasks)
+            build_audience.delay(job.pk)
+            metrics.flush()
 
         # info to REST API client of successfull create mailing.
-        return JsonResponse(serializer.data, content_type='application/json', status=status.HTTP_200_OK)
+        data = dict(MailingSerializer(job.mailing).data, job={'id': job.pk, 'status': job.status})
+        return JsonResponse(data, content_type='application/json', status=status.HTTP_200_OK)
 
     def put(self, request, pk):
         """
         Update mailing attributes.
-        If starts_at field has been updated, than update 'starts_at' field of each 'new' message of this mailing
+        If starts_at field or delivery window has been updated, than update 'starts_at' field of all not sent messages
+        of this mailing by one UPDATE (see ./fanout.py) and drop their batches already queued with the old schedule.
+        Messages of cancelled mailing are not rescheduled.
         """
         mailing = get_object_or_404(Mailing, pk=pk)
         data = request.data
 
         serializer = MailingSerializer(instance=mailing, data=data, partial=True)
         if serializer.is_valid(raise_exception=True):
-            start = serializer.validated_data.get('starts_at')
-
-            # update starts_at time field of 'new' messages if this field from mailing has been changed
-            if start != mailing.starts_at:
-                messages = Message.objects.filter(mailing=pk).exclude(status='sent')
-                for message in messages:
-                    message.starts_at = start
-                    message.status = 'new'
-                    message.save()
-            # all changed data is valid. Save mailing
-            mailing = serializer.save()
-        # send mailing by id, if 'starts_at' time has come and 'expired_at' time is not over
-        # send now
-        now = timezone.now()
-        if mailing.starts_at <= now < mailing.expired_at:
-            # run celery.task.group
-            send.delay(mailing.pk)
+            changed = [field for field in ('starts_at', 'window_start', 'window_end')
+                       if field in serializer.validated_data
+                       and serializer.validated_data[field] != getattr(mailing, field)]
+            with transaction.atomic():
+                # all changed data is valid. Save mailing
+                mailing = serializer.save()
+                # update starts_at time field of not sent messages if schedule of mailing has been changed
+                if changed and mailing.state != 'cancelled':
+                    reschedule(mailing)
+        # send mailing by id, if 'starts_at' time has come and 'expired_at' time is not over, or send it later
+        start(mailing)
 
         # info to REST API client of successfull update mailing
         return JsonResponse(serializer.data, content_type='application/json', status=status.HTTP_200_OK)
@@ -164,3 +288,59 @@ class MailingView(APIView):
             "text": mailing.text[:50],
         }
         return JsonResponse(data, content_type='application/json', status=status.HTTP_200_OK)
+
+
+class MailingStateView(APIView):
+    """
+    Pause, resume or cancel mailing: /api/mailing/<pk>/pause/, /api/mailing/<pk>/resume/, /api/mailing/<pk>/cancel/
+    """
+
+    def post(self, request, pk, action):
+        """
+        Change mailing state (see ./lifecycle.py). Cancel marks new messages as 'failure' by one UPDATE.
+        Batches of this mailing already queued for workers are dropped without sending, their messages are returned
+        to 'new' by the worker on pause and marked 'failure' on cancel. Batches already being sent finish and write
+        their results.
+        """
+
+        with transaction.atomic():
+            mailing = get_object_or_404(Mailing.objects.select_for_update(), pk=pk)
+            if mailing.state not in TRANSITIONS[action]:
+                raise ValidationError({'state': 'Cannot {} {} mailing.'.format(action, mailing.state)})
+            messages = ACTIONS[action](mailing)
+        start(mailing)
+        data = {
+            'id': mailing.pk,
+            'state': mailing.state,
+            'version': mailing.version,
+            'messages': messages,
+        }
+        return JsonResponse(data, content_type='application/json', status=status.HTTP_200_OK)
+
+
+class MailingJobView(APIView):
+    """
+    Progress of background creation of mailing clients and messages: /api/mailing/job/<pk>/
+    """
+
+    def get(self, request, pk):
+        """
+        Job status, clients processed of total, rate (clients per second) and estimated time to finish (seconds).
+        """
+
+        job = get_object_or_404(MailingJob, pk=pk)
+        return JsonResponse(progress(job), content_type='application/json', status=status.HTTP_200_OK)
+
+
+class MetricsView(APIView):
+    """
+    Mailing pipeline metrics in Prometheus text format.
+    """
+
+    def get(self, request):
+        """
+        Counters and histograms of all API, scheduler and worker processes (see ./metrics.py) and current state
+        of mailings.
+        """
+
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
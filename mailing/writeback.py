@@ -0,0 +1,108 @@
+import logging
+import os
+import threading
+from time import monotonic, sleep
+
+from django.db import close_old_connections
+
+from project.settings import CELERY_SETTINGS_FBRQ
+from . import metrics
+from .delivery import write_outcome
+
+logger = logging.getLogger(__name__)
+
+# настройки записи статусов: сколько результатов отправки копить и как долго (сек) держать их в памяти воркера
+WRITEBACK = CELERY_SETTINGS_FBRQ['writeback']
+
+
+class StatusBuffer:
+    """
+    Буфер результатов отправки одного процесса воркера: статусы сообщений копятся в памяти и записываются в БД
+    группами-- одна команда UPDATE ... WHERE id IN (...) на каждый новый статус (и на каждое количество попыток
+    для повторной отправки, delivery.retry_later()), журнал отправки-- одной командой INSERT. Запись выполняется
+    при накоплении 'size' результатов либо не позже чем через 'interval' секунд фоновым потоком.
+    До записи сообщения остаются в статусе 'active': если воркер упадет, не записанные результаты потеряются, а
+    сообщения вернет в статус 'new' периодический обход (sweeper.reap_stale) после истечения аренды.
+    """
+
+    def __init__(self, settings=WRITEBACK):
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.statuses = dict()
+        self.failed = list()
+        self.log = list()
+        self.size = 0
+        self.oldest = None
+        self.pid = None
+        self.timer = None
+
+    def add(self, outcome, failed=(), log=()):
+        """
+        outcome-- {статус: список id сообщений}, failed-- список (id сообщения, количество прежних попыток) для
+        повторной отправки, log-- записи журнала отправки (delivery.write_log()). Записывает буфер в БД, если он
+        заполнен.
+        """
+
+        with self.lock:
+            self._start()
+            self._merge(outcome, failed, log)
+            full = self.size >= self.settings['size']
+        if full:
+            self.flush()
+
+    def _merge(self, outcome, failed, log):
+        for status, ids in outcome.items():
+            self.statuses.setdefault(status, list()).extend(ids)
+            self.size += len(ids)
+        self.failed.extend(failed)
+        self.size += len(failed)
+        self.log.extend(log)
+        if self.oldest is None and self.size:
+            self.oldest = monotonic()
+
+    def flush(self):
+        """
+        Запись всех накопленных статусов. Если запись не удалась, результаты остаются в буфере до следующей попытки.
+        Возвращает количество записанных результатов.
+        """
+
+        with self.lock:
+            statuses, failed, log = self.statuses, self.failed, self.log
+            self.statuses, self.failed, self.log, self.size, self.oldest = dict(), list(), list(), 0, None
+        written = sum(map(len, statuses.values())) + len(failed)
+        if not written and not log:
+            return 0
+        try:
+            with metrics.span('write_back'):
+                write_outcome(statuses, failed, log)
+        except Exception:
+            logger.exception('Status write-back failed, %s results are kept in buffer', written)
+            with self.lock:
+                self._merge(statuses, failed, log)
+            return 0
+        return written
+
+    def _start(self):
+        """
+        Фоновый поток записи по времени, свой в каждом процессе воркера (после fork поток родителя не наследуется).
+        """
+
+        if self.pid == os.getpid():
+            return None
+        self.pid = os.getpid()
+        self.statuses, self.failed, self.log, self.size, self.oldest = dict(), list(), list(), 0, None
+        self.timer = threading.Thread(target=self._run, name='status-writeback', daemon=True)
+        self.timer.start()
+
+    def _run(self):
+        interval = self.settings['interval']
+        while True:
+            sleep(interval / 2)
+            oldest = self.oldest
+            if oldest is not None and monotonic() - oldest >= interval:
+                self.flush()
+                close_old_connections()
+
+
+# буфер текущего процесса воркера, см. tasks.send_batch() и tasks.send_message()
+buffer = StatusBuffer()
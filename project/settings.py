@@ -5,6 +5,8 @@ Django settings for REST project.
 from pathlib import Path
 from datetime import timedelta
 
+from kombu import Queue
+
 # Импорт секретного ключа для Django проекта и JWT- Token для сервера https://probe.fbrq.cloud
 from project.secret_key import FABRIKA_JWT, DJANGO_SECRET
 
@@ -41,7 +43,7 @@ ALLOWED_HOSTS = ["127.0.0.1"]
 # Application definition
 
 INSTALLED_APPS = [
-    'mailing',
+    'mailing.apps.MailingConfig',
     'rest_framework',
     'django.contrib.admin',
     'django.contrib.auth',
@@ -145,10 +147,19 @@ CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'Europe/Moscow'
+# очереди отправки (mailing.priority): срочные пачки рассылок, которые скоро закончатся, и все остальные. Воркер без
+# флага -Q слушает обе очереди
+CELERY_TASK_QUEUES = (Queue('mailing.urgent'), Queue('celery'))
+CELERY_TASK_DEFAULT_QUEUE = 'celery'
+# рассылки запускает планировщик mailing.scheduler (python manage.py run_scheduler), beat-- страховочный обход
 CELERY_BEAT_SCHEDULE = {
-    'send_mailing_every_30_sec': {
+    'send_mailing_every_60_sec': {
         'task': 'send',
-        'schedule': timedelta(seconds=30)
+        'schedule': timedelta(seconds=60)
+    },
+    'sweep_messages_every_60_sec': {
+        'task': 'sweep',
+        'schedule': timedelta(seconds=60)
     },
 }
 
@@ -160,6 +171,82 @@ CELERY_SETTINGS_FBRQ = {
         'Accept': 'application/json',
         'Content-type': 'application/json',
     },
+    # максимальное количество одновременных запросов к серверу (mailing.delivery)
+    'concurrency': 100,
+    # количество сообщений в одном таске отправки send_batch (mailing.tasks)
+    'chunk': 500,
+    # время (сек), через которое сообщение в статусе 'active' считается брошенным и возвращается в 'new'
+    # (mailing.sweeper). Должно быть больше времени отправки одной пачки на минимальной скорости
+    'lease': 600,
+    # адаптивный лимит скорости отправки, сообщений в секунду, общий для всех воркеров (mailing.ratelimit)
+    'rate_limit': {
+        'initial': 300,  # начальная скорость
+        'min': 10,  # минимальная скорость
+        'max': 5000,  # максимальная скорость
+        'increase': 20,  # прибавка скорости, если сервер отвечает быстро и без ошибок
+        'decrease': 0.5,  # множитель скорости при ошибках и таймаутах сервера
+        'latency': 0.5,  # среднее время ответа сервера (сек), при котором скорость еще можно увеличивать
+        'burst': 1.0,  # запас токенов, в секундах на текущей скорости
+    },
+    # хранить результаты тасков отправки в CELERY_RESULT_BACKEND (mailing.tasks), вместо них ведется журнал отправки
+    'store_results': False,
+    # журнал попыток отправки (mailing.models.DeliveryLog): записей, удаляемых одной командой при ротации, и срок
+    # хранения записей для python manage.py rotate_delivery_log
+    'delivery_log': {
+        'enabled': True,
+        'batch': 1000,
+        'retention_days': 30,
+    },
+    # запись статусов сообщений из воркера группами (mailing.writeback): при накоплении 'size' результатов либо
+    # через 'interval' сек. Время 'interval' должно быть намного меньше времени аренды 'lease'
+    'writeback': {
+        'size': 1000,
+        'interval': 1.0,
+    },
+    # параллельные диспетчеры (mailing.dispatcher, python manage.py run_dispatcher): количество шардов сообщений,
+    # время аренды шарда диспетчером (сек) и пауза (сек) между проходами диспетчера, если захватывать нечего
+    'dispatch': {
+        'shards': 8,
+        'lease': 30,
+        'interval': 1.0,
+    },
+    # очередность отправки (mailing.priority): рассылки захватываются по возрастанию времени окончания, каждая получает
+    # равную долю захвата. Пачки рассылок, до окончания которых осталось не больше 'urgent' сек, идут в очередь
+    # 'urgent_queue', остальные-- в 'bulk_queue'. Несрочные сообщения не захватываются, пока в работе ('active') не
+    # меньше 'in_flight' сообщений
+    'priority': {
+        'urgent': 3600,
+        'urgent_queue': 'mailing.urgent',
+        'bulk_queue': 'celery',
+        'in_flight': 50_000,
+    },
+    # снимок аудитории вместо сообщений (mailing.snapshot): рассылка с аудиторией не меньше 'min_audience' клиентов
+    # хранит упакованные id клиентов, сообщения создаются диспетчером блоками по 'block' получателей
+    'snapshot': {
+        'enabled': True,
+        'min_audience': 100_000,
+        'block': 10_000,
+    },
+    # метрики Prometheus (mailing.metrics, эндпоинт /metrics): сбор метрик, запись временных отрезков этапов
+    # рассылки в лог 'mailing.spans', как часто (сек) таск send_message записывает метрики в БД
+    'metrics': {
+        'enabled': True,
+        'spans': False,
+        'interval': 5.0,
+    },
+    # повторная отправка сообщения с экспоненциальной задержкой (mailing.delivery)
+    'retry': {
+        'attempts': 5,  # количество попыток, после которого сообщение получает статус 'dead'
+        'base_delay': 30,  # задержка перед первой повторной попыткой, сек (далее удваивается)
+        'max_delay': 3600,  # максимальная задержка, сек
+    },
+    # приостановка всей отправки при большой доле ошибок принимающего сервера (mailing.ratelimit)
+    'circuit_breaker': {
+        'threshold': 0.5,  # доля ошибок и таймаутов в окне, при которой отправка приостанавливается
+        'min_requests': 20,  # минимальное количество запросов в окне для принятия решения
+        'window': 60,  # длительность окна подсчета ошибок, сек
+        'cooldown': 60,  # на сколько секунд приостанавливается отправка
+    },
 }
 
 REST_FRAMEWORK = {
@@ -17,9 +17,12 @@ from django.contrib import admin
 from django.urls import path, include
 from django.views.generic import TemplateView
 
+from mailing.views import MetricsView
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('mailing.urls')),
+    path('metrics', MetricsView.as_view()),
     path('docs/', TemplateView.as_view(
                             template_name='swagger-ui.html',
                             extra_context={'schema_url': 'openapi-schema'}